@@ -0,0 +1,80 @@
+"""
+E-stop benchmark: time from `e_stop()` / `e_stop_now()` call to MQTT publish.
+
+The message broker client is replaced with a stand-in that records when
+`publish()` is called, so only time spent in farmbot-py is measured.
+
+Run from the repository root:
+    python benchmarks/bench_e_stop.py
+"""
+
+import os
+import sys
+import time
+import statistics
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from farmbot import Farmbot
+
+RUNS = 20
+TOKEN = {
+    "token": {
+        "encoded": "encoded_token_value",
+        "unencoded": {
+            "iss": "//my.farm.bot",
+            "mqtt": "mqtt_url",
+            "bot": "device_0",
+        },
+    },
+}
+
+
+class StandInClient():
+    """Message broker client that records when a message is published."""
+    published_at = None
+
+    def __init__(self, *_args, **_kwargs):
+        self.on_message = None
+
+    def __getattr__(self, _name):
+        return lambda *_args, **_kwargs: None
+
+    def publish(self, *_args, **_kwargs):
+        """Record the publish time."""
+        StandInClient.published_at = time.perf_counter()
+
+
+def new_farmbot():
+    """Farmbot with a token, no output, and no response wait."""
+    fb = Farmbot()
+    fb.set_token(TOKEN)
+    fb.set_verbosity(0)
+    fb.set_timeout(0, "all")
+    return fb
+
+
+def time_to_wire(command):
+    """Median seconds from calling `command()` to publish."""
+    durations = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        command()
+        durations.append(StandInClient.published_at - start)
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    with patch("paho.mqtt.client.Client", StandInClient):
+        fb = new_farmbot()
+        publish_seconds = time_to_wire(fb.e_stop)
+
+        fb = new_farmbot()
+        fb.open_control_channel()
+        control_seconds = time_to_wire(lambda: fb.e_stop_now(timeout=0.01))
+        time.sleep(0.05)  # let response timeouts finish
+
+    print(f"e_stop() (publish path):          {publish_seconds * 1e3:8.3f} ms (median)")
+    print(f"e_stop_now() (control channel):   {control_seconds * 1e3:8.3f} ms (median)")
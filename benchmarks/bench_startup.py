@@ -0,0 +1,74 @@
+"""
+Startup benchmark: `import farmbot` and `Farmbot()` construction time.
+
+Dependencies such as `requests`, `paho.mqtt.client` and `orjson`/`ujson`
+are imported where first used, not at module level, to keep startup fast.
+
+Run from the repository root:
+    python benchmarks/bench_startup.py
+"""
+
+import os
+import sys
+import timeit
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORT_RUNS = 20
+CONSTRUCT_RUNS = 10000
+
+IMPORT_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+import farmbot
+print(time.perf_counter() - start)
+print(int("requests" in sys.modules), int("paho.mqtt.client" in sys.modules))
+"""
+
+
+def import_time():
+    """Median `import farmbot` time in fresh interpreters."""
+    durations = []
+    heavy_imports = None
+    for _ in range(IMPORT_RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            cwd=ROOT, capture_output=True, text=True, check=True).stdout.split("\n")
+        durations.append(float(output[0]))
+        heavy_imports = output[1]
+    return statistics.median(durations), heavy_imports
+
+
+def construct_time():
+    """Mean `Farmbot()` construction time."""
+    total = timeit.timeit(
+        "Farmbot()",
+        setup="from farmbot import Farmbot",
+        number=CONSTRUCT_RUNS)
+    return total / CONSTRUCT_RUNS
+
+
+def first_use_time():
+    """Mean time to construct `Farmbot()` and access every subsystem."""
+    total = timeit.timeit(
+        "fb = Farmbot(); [getattr(fb, name) for name in NAMES]",
+        setup="\n".join([
+            "from farmbot import Farmbot",
+            "NAMES = ['api', 'basic', 'broker', 'camera', 'info', 'jobs',",
+            "         'messages', 'movements', 'peripherals', 'resources',",
+            "         'tools']",
+        ]),
+        number=CONSTRUCT_RUNS)
+    return total / CONSTRUCT_RUNS
+
+
+if __name__ == "__main__":
+    seconds, imports = import_time()
+    print(f"import farmbot:            {seconds * 1e3:8.2f} ms (median)")
+    print(f"  requests, paho imported: {imports}")
+    print(f"Farmbot():                 {construct_time() * 1e6:8.2f} us")
+    print(f"Farmbot() + subsystems:    {first_use_time() * 1e6:8.2f} us")
@@ -0,0 +1,50 @@
+"""
+JSON encoding and decoding with the fastest installed library.
+"""
+
+import json
+import functools
+
+BACKENDS = ("orjson", "ujson", "json")
+
+
+@functools.lru_cache(maxsize=None)
+def backend():
+    """Name and module of the first installed library in BACKENDS."""
+    import importlib
+    for name in BACKENDS:
+        try:
+            return name, importlib.import_module(name)
+        except ImportError:
+            continue
+    return "json", json
+
+
+def encode(value):
+    """Compact UTF-8 JSON bytes, e.g., for message broker payloads."""
+    name, module = backend()
+    if name == "orjson":
+        return module.dumps(value, option=module.OPT_NON_STR_KEYS)
+    if name == "ujson":
+        return module.dumps(
+            value, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+    return json.dumps(
+        value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(value, indent=None):
+    """JSON text: compact, or indented for printing."""
+    name, module = backend()
+    if indent is None:
+        return encode(value).decode("utf-8")
+    if name == "orjson" and indent == 2:
+        option = module.OPT_NON_STR_KEYS | module.OPT_INDENT_2
+        return module.dumps(value, option=option).decode("utf-8")
+    if name == "ujson":
+        return module.dumps(value, indent=indent, escape_forward_slashes=False)
+    return json.dumps(value, indent=indent)
+
+
+def loads(data):
+    """Decode JSON text or bytes."""
+    return backend()[1].loads(data)
@@ -0,0 +1,120 @@
+"""
+Status tree diff and JSON Patch (RFC 6902) functions.
+"""
+
+
+def difference(next_state, prev_state, removed=False):
+    """Find the new and changed values between two states.
+
+    Returns (diff, is_different). Removed keys set is_different, and
+    with `removed` are included in diff as None, as in a JSON Merge
+    Patch (RFC 7396). Use `json_patch` to tell removals from None values.
+    """
+    if not isinstance(next_state, dict) or not isinstance(prev_state, dict):
+        return next_state, next_state != prev_state
+    if next_state is prev_state:
+        return {}, False
+
+    diff = {}
+    is_different = len(next_state) != len(prev_state)
+    if removed:
+        for key in prev_state:
+            if key not in next_state:
+                diff[key] = None
+                is_different = True
+    for key, next_value in next_state.items():
+        if key not in prev_state:
+            diff[key] = next_value
+            is_different = True
+            continue
+        prev_value = prev_state[key]
+        # Identical and equal subtrees are skipped without walking them in Python
+        if next_value is prev_value or next_value == prev_value:
+            continue
+        is_different = True
+        if isinstance(next_value, dict) and isinstance(prev_value, dict):
+            diff[key] = difference(next_value, prev_value, removed)[0]
+        else:
+            diff[key] = next_value
+    return diff, is_different
+
+
+def escape(key):
+    """Escape a key for use in a JSON Pointer."""
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def unescape(token):
+    """Unescape a JSON Pointer token."""
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def json_patch(prev_state, next_state, path=""):
+    """Return RFC 6902 operations that change prev_state into next_state.
+
+    Only unequal dictionaries are compared key by key.
+    Other changed values (including lists) are replaced whole.
+    """
+    if next_state is prev_state:
+        return []
+    if not isinstance(next_state, dict) or not isinstance(prev_state, dict):
+        if next_state == prev_state:
+            return []
+        return [{"op": "replace", "path": path, "value": next_state}]
+
+    operations = []
+    for key in prev_state:
+        if key not in next_state:
+            operations.append({"op": "remove", "path": f"{path}/{escape(key)}"})
+    for key, next_value in next_state.items():
+        key_path = f"{path}/{escape(key)}"
+        if key not in prev_state:
+            operations.append({"op": "add", "path": key_path, "value": next_value})
+            continue
+        prev_value = prev_state[key]
+        if next_value is prev_value or next_value == prev_value:
+            continue
+        if isinstance(next_value, dict) and isinstance(prev_value, dict):
+            operations.extend(json_patch(prev_value, next_value, key_path))
+        else:
+            operations.append({"op": "replace", "path": key_path, "value": next_value})
+    return operations
+
+
+def apply_patch(state, operations):
+    """Return a new state with the operations applied.
+
+    Only containers along changed paths are copied;
+    unchanged subtrees are shared with the original state.
+    """
+    root = {"": state}
+    copied = set()
+    for operation in operations:
+        tokens = [""]
+        if operation["path"] != "":
+            tokens += [unescape(token) for token in operation["path"].split("/")[1:]]
+        parent = root
+        for depth, token in enumerate(tokens[:-1]):
+            key = int(token) if isinstance(parent, list) else token
+            child = parent[key]
+            child_id = tuple(tokens[:depth + 1])
+            if child_id not in copied:
+                child = child.copy()
+                parent[key] = child
+                copied.add(child_id)
+            parent = child
+        key = tokens[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == "-" else int(key)
+        op = operation["op"]
+        if op == "remove":
+            del parent[key]
+        elif op == "add" and isinstance(parent, list):
+            parent.insert(key, operation["value"])
+        elif op in ["add", "replace"]:
+            parent[key] = operation["value"]
+        else:
+            raise ValueError(f"Invalid op: {op} not in ['add', 'replace', 'remove']")
+        # Values from the patch aren't copies, so copy again before changing them
+        copied = {path for path in copied if path[:len(tokens)] != tuple(tokens)}
+    return root[""]
@@ -0,0 +1,154 @@
+"""
+Columnar export of API records.
+"""
+
+import os
+import csv
+import json
+import codecs
+
+from . import codec
+
+EXPORT_FORMATS = ["csv", "npz", "parquet"]
+SEPARATORS = " \t\n\r,"
+
+
+def skip_separators(text, position):
+    """Position of the next character that isn't whitespace or a comma."""
+    while position < len(text) and text[position] in SEPARATORS:
+        position += 1
+    return position
+
+
+def iter_json_array(chunks):
+    """Yield the items of a JSON array as its text chunks arrive."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            position = skip_separators(buffer, position)
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Expected a JSON array.")
+                started = True
+                position += 1
+            elif buffer[position] == "]":
+                return
+            else:
+                try:
+                    item, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    # Incomplete item: wait for more text
+                    break
+                yield item
+        buffer = buffer[position:]
+    raise ValueError("Incomplete JSON array.")
+
+
+def decode_chunks(chunks, encoding="utf-8"):
+    """Decode byte chunks to text, handling characters split across chunks."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def is_number(value):
+    """Check if a value is stored as a number."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ColumnBuilder():
+    """Record values collected into one list per key."""
+
+    def __init__(self):
+        self.columns = {}
+        self.count = 0
+
+    def append(self, record):
+        """Add a record. Nested values are stored as JSON text."""
+        for key, value in record.items():
+            if key not in self.columns:
+                self.columns[key] = [None] * self.count
+            if isinstance(value, (dict, list)):
+                value = codec.dumps(value)
+            self.columns[key].append(value)
+        self.count += 1
+        for values in self.columns.values():
+            if len(values) < self.count:
+                values.append(None)
+
+    def kind(self, key):
+        """Column kind: 'number' if all values are numbers or missing, else 'string'."""
+        values = self.columns[key]
+        if all(value is None or is_number(value) for value in values):
+            return "number"
+        return "string"
+
+    def strings(self, key):
+        """Column values as text."""
+        return ["" if value is None else str(value) for value in self.columns[key]]
+
+    def write_csv(self, path):
+        """Write columns to a CSV file."""
+        with open(path, "w", newline="", encoding="utf-8") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(self.columns.keys())
+            writer.writerows(zip(*[
+                ["" if value is None else value for value in values]
+                for values in self.columns.values()]))
+
+    def write_npz(self, path):
+        """Write columns to a NumPy .npz file."""
+        try:
+            import numpy
+        except ImportError as exception:
+            raise ImportError("Exporting .npz files requires numpy.") from exception
+        arrays = {}
+        for key, values in self.columns.items():
+            if self.kind(key) == "number":
+                if all(isinstance(value, int) for value in values):
+                    arrays[key] = numpy.array(values, dtype=numpy.int64)
+                else:
+                    arrays[key] = numpy.array(
+                        [numpy.nan if value is None else value for value in values],
+                        dtype=numpy.float64)
+            else:
+                arrays[key] = numpy.array(self.strings(key), dtype=str)
+        numpy.savez(path, **arrays)
+
+    def write_parquet(self, path):
+        """Write columns to a Parquet file."""
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as exception:
+            raise ImportError("Exporting .parquet files requires pyarrow.") from exception
+        arrays = {}
+        for key, values in self.columns.items():
+            if self.kind(key) == "number":
+                arrays[key] = pyarrow.array(values)
+            else:
+                arrays[key] = pyarrow.array(
+                    [None if value is None else str(value) for value in values],
+                    type=pyarrow.string())
+        pyarrow.parquet.write_table(pyarrow.table(arrays), path)
+
+    def write(self, path, export_format):
+        """Write columns to a file in the given format."""
+        getattr(self, f"write_{export_format}")(path)
+
+
+def export_format_for(path, export_format=None):
+    """Validated export format, from the file extension if not given."""
+    if export_format is None:
+        export_format = os.path.splitext(path)[1].lstrip(".").lower()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Invalid format: {export_format} not in {EXPORT_FORMATS}")
+    return export_format
@@ -4,43 +4,27 @@ ApiConnect class.
 
 # └── functions/api.py
 #     ├── [API] get_token()
+#     ├── [API] refresh_token()
+#     ├── [API] set_token_store()
+#     ├── [API] start_session()
 #     ├── [API] check_token()
 #     ├── [API] request_handling()
-#     └── [API] request()
+#     ├── [API] request()
+#     └── [API] stream()
 
-import json
-from html.parser import HTMLParser
-import requests
+import time
+import threading
 
+from ..state import track_calls, untracked
+from .. import codec
+from ..tracing import set_attribute
+from ..token_store import TokenStore, seconds_until_refresh
 
-class HTMLResponseParser(HTMLParser):
-    """Response parser for HTML content."""
-
-    def __init__(self):
-        super().__init__()
-        self.is_header = False
-        self.headers = []
-
-    def read(self, data):
-        """Read the headers from the HTML content."""
-        self.is_header = False
-        self.headers = []
-        self.reset()
-        self.feed(data)
-        return " ".join(self.headers)
-
-    def handle_starttag(self, tag, attrs):
-        """Detect headers."""
-        if tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-            self.is_header = True
-
-    def handle_data(self, data):
-        """Add header data to the list."""
-        if self.is_header:
-            self.headers.append(data.strip())
-            self.is_header = False
+REFRESH_RETRY = 60  # seconds between token refresh attempts after a failure
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes
 
 
+@track_calls
 class ApiConnect():
     """Connect class for FarmBot API."""
 
@@ -49,14 +33,18 @@ class ApiConnect():
 
     def _request(self, **kwargs):
         """Internal method to make requests."""
+        import requests
         response = None
+        session = self.state.session
         try:
-            response = requests.request(
+            stream = {"stream": True} if kwargs.get("stream") else {}
+            response = (requests if session is None else session).request(
                 method=kwargs["method"],
                 url=kwargs["url"],
                 headers=kwargs["headers"],
                 json=kwargs["json"],
-                timeout=kwargs["timeout"])
+                timeout=kwargs["timeout"],
+                **stream)
         except requests.exceptions.RequestException as e:
             if isinstance(e, requests.exceptions.SSLError):
                 self.state.error = "ERROR: The server does not support SSL."
@@ -71,9 +59,39 @@ class ApiConnect():
             self.state.error = f"ERROR: An unexpected error occurred: {e}"
         return response
 
+    def _record_request(self, labels, response, seconds, received=None):
+        """Internal method to record request metrics."""
+        metrics = self.state.metrics
+        metrics.observe("api_request_seconds", seconds, labels)
+        status = "none" if response is None else response.status_code
+        set_attribute("status", status)
+        metrics.increment("api_requests_total", {**labels, "status": status})
+        if response is None or not 200 <= status < 300:
+            metrics.increment("api_errors_total", labels)
+            return
+        if received is None:
+            content = getattr(response, "content", None)
+            received = len(content) if isinstance(content, bytes) else None
+        if received is not None:
+            metrics.increment("api_bytes_received_total", labels, received)
+        body = getattr(getattr(response, "request", None), "body", None)
+        if isinstance(body, (bytes, str)):
+            metrics.increment("api_bytes_sent_total", labels, len(body))
+
     def get_token(self, email, password, server="https://my.farm.bot"):
         """Get FarmBot authorization token. Server is 'https://my.farm.bot' by default."""
         self.state.ssl = "https" in server
+        store = self.state.token_store
+        if store is not None:
+            self.state.token_source = (server, email)
+            token = store.load(server, email)
+            if token is not None:
+                self.state.token = token
+                self.state.error = None
+                description = f"Using stored token for {server}."
+                self.state.print_status(description=description)
+                self.schedule_token_refresh()
+                return token
         headers = {'content-type': 'application/json'}
         user = {'user': {'email': email, 'password': password}}
         timeout = self.state.timeout["api"]
@@ -85,11 +103,12 @@ class ApiConnect():
             timeout=timeout)
         if response is not None:
             if response.status_code == 200:
-                self.state.token = response.json()
+                self.state.token = codec.loads(response.content)
                 self.state.error = None
                 description = f"Successfully fetched token from {server}."
                 self.state.print_status(description=description)
-                return response.json()
+                self.store_token()
+                return self.state.token
             if response.status_code == 404:
                 self.state.error = "HTTP ERROR: The server address does not exist."
             elif response.status_code == 422:
@@ -102,17 +121,104 @@ class ApiConnect():
         self.state.print_status(description=self.state.error)
         return self.state.error
 
+    def refresh_token(self):
+        """Exchange the current token for a new one before it expires."""
+        self.state.check_token()
+        token = self.state.token["token"]
+        http_part = "https" if self.state.ssl else "http"
+        server = f'{http_part}:{token["unencoded"]["iss"]}'
+        if self.state.token_source is not None:
+            server = self.state.token_source[0]
+        headers = {'authorization': token['encoded'],
+                   'content-type': 'application/json'}
+        response = self._request(
+            method='GET',
+            url=f'{server}/api/tokens',
+            headers=headers,
+            json=None,
+            timeout=self.state.timeout["api"])
+        if response is not None and response.status_code == 200:
+            self.state.token = codec.loads(response.content)
+            self.state.error = None
+            description = f"Successfully refreshed token from {server}."
+            self.state.print_status(description=description)
+            self.store_token()
+            return self.state.token
+        if response is not None:
+            code = response.status_code
+            self.state.error = f"HTTP ERROR: Unexpected status code {code}"
+        self.state.print_status(description=self.state.error)
+        self.schedule_token_refresh(retry=True)
+        return self.state.error
+
+    def set_token_store(self, path, refresh_margin):
+        """Reuse tokens saved at `path` and refresh them before expiration."""
+        self.cancel_token_refresh()
+        if path is None:
+            self.state.token_store = None
+            return
+        self.state.token_store = TokenStore(path, refresh_margin)
+
+    @untracked
+    def store_token(self):
+        """Save the current token and schedule its refresh."""
+        store = self.state.token_store
+        if store is None:
+            return
+        if self.state.token_source is not None:
+            store.save(*self.state.token_source, self.state.token)
+        self.schedule_token_refresh()
+
+    @untracked
+    def schedule_token_refresh(self, retry=False):
+        """Refresh the current token in the background before it expires."""
+        self.cancel_token_refresh()
+        store = self.state.token_store
+        if store is None:
+            return
+        delay = seconds_until_refresh(self.state.token, store.refresh_margin)
+        if delay is None:
+            return
+        if retry:
+            delay = max(delay + store.refresh_margin, 0)
+            delay = min(delay, REFRESH_RETRY)
+            if delay == 0:
+                return
+        timer = threading.Timer(max(delay, 0), self.refresh_token)
+        timer.daemon = True
+        timer.start()
+        self.state.token_refresh_timer = timer
+
+    @untracked
+    def cancel_token_refresh(self):
+        """Cancel any scheduled token refresh."""
+        if self.state.token_refresh_timer is not None:
+            self.state.token_refresh_timer.cancel()
+            self.state.token_refresh_timer = None
+
+    def start_session(self, pool_size=10):
+        """Reuse pooled connections for API requests."""
+        import requests
+        with self.state.lock:
+            if self.state.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.state.session = session
+        return self.state.session
+
     @staticmethod
     def parse_text(text):
         """Parse response text."""
         if '<html' in text:
+            from .html_response import HTMLResponseParser
             parser = HTMLResponseParser()
             return parser.read(text)
         return text
 
     def request_handling(self, response, make_request):
         """Handle errors associated with different endpoint errors."""
-
         error_messages = {
             404: "The specified endpoint does not exist.",
             400: "The specified ID is invalid or you do not have access to it.",
@@ -140,24 +246,27 @@ class ApiConnect():
             self.state.error = f"UNEXPECTED ERROR {code}: {text}"
 
         try:
-            response.json()
-        except (json.JSONDecodeError, requests.exceptions.RequestException):
+            body = codec.loads(response.content)
+        except ValueError:
             self.state.error += f" ({text})"
         else:
-            self.state.error += f" ({json.dumps(response.json(), indent=2)})"
+            self.state.error += f" ({codec.dumps(body, indent=2)})"
 
         self.state.print_status(description=self.state.error)
         return response.status_code
 
-    def request(self, method, endpoint, database_id, payload=None):
-        """Make requests to API endpoints using different methods."""
-
+    def _prepare_request(self, method, endpoint, database_id):
+        """Internal method to check the token and build the request URL and headers."""
         self.state.check_token()
+        set_attribute("method", method)
+        set_attribute("endpoint", endpoint)
 
-        # use 'GET' method to view endpoint data
-        # use 'POST' method to overwrite/create new endpoint data
-        # use 'PATCH' method to edit endpoint data (used for new logs)
-        # use 'DELETE' method to delete endpoint data
+        store = self.state.token_store
+        if store is not None:
+            remaining = seconds_until_refresh(
+                self.state.token, store.refresh_margin)
+            if remaining is not None and remaining <= 0:
+                self.refresh_token()
 
         token = self.state.token["token"]
         iss = token["unencoded"]["iss"]
@@ -168,15 +277,32 @@ class ApiConnect():
 
         headers = {'authorization': token['encoded'],
                    'content-type': 'application/json'}
+        return url, headers
+
+    def request(self, method, endpoint, database_id, payload=None):
+        """Make requests to API endpoints using different methods."""
+        import requests
+
+        # use 'GET' method to view endpoint data
+        # use 'POST' method to overwrite/create new endpoint data
+        # use 'PATCH' method to edit endpoint data (used for new logs)
+        # use 'DELETE' method to delete endpoint data
+
+        url, headers = self._prepare_request(method, endpoint, database_id)
         make_request = not self.state.dry_run or method == "GET"
         if make_request:
             timeout = self.state.timeout["api"]
+            start_time = time.perf_counter()
             response = self._request(
                 method=method,
                 url=url,
                 headers=headers,
                 json=payload,
                 timeout=timeout)
+            self._record_request(
+                {"method": method, "endpoint": endpoint},
+                response,
+                time.perf_counter() - start_time)
         else:
             response = requests.Response()
             response.status_code = 200
@@ -186,7 +312,43 @@ class ApiConnect():
             self.state.error = None
             description = "Successfully fetched request contents."
             self.state.print_status(description=description)
-            return response.json()
+            return codec.loads(response.content)
         description = "There was an error processing the request..."
         self.state.print_status(description=description)
         return self.state.error
+
+    def stream(self, endpoint, chunk_size=STREAM_CHUNK_SIZE):
+        """Request a list endpoint and return an iterator over its records as they arrive."""
+        url, headers = self._prepare_request("GET", endpoint, None)
+        labels = {"method": "GET", "endpoint": endpoint}
+        start_time = time.perf_counter()
+        response = self._request(
+            method="GET",
+            url=url,
+            headers=headers,
+            json=None,
+            timeout=self.state.timeout["api"],
+            stream=True)
+        if response is None or response.status_code != 200:
+            self._record_request(labels, response, time.perf_counter() - start_time)
+            if response is not None:
+                self.request_handling(response, True)
+            return None
+        self.state.error = None
+
+        def records():
+            from ..export import iter_json_array, decode_chunks
+            received = 0
+
+            def chunks():
+                nonlocal received
+                for chunk in response.iter_content(chunk_size):
+                    received += len(chunk)
+                    yield chunk
+            try:
+                yield from iter_json_array(decode_chunks(chunks()))
+            finally:
+                response.close()
+                self._record_request(
+                    labels, response, time.perf_counter() - start_time, received)
+        return records()
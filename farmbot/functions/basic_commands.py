@@ -5,18 +5,22 @@ BasicCommands class.
 # └── functions/basic_commands.py
 #     ├── [BROKER] wait()
 #     ├── [BROKER] e_stop()
+#     ├── [BROKER] e_stop_now()
 #     ├── [BROKER] unlock()
 #     ├── [BROKER] reboot()
 #     └── [BROKER] shutdown()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 
 
+@track_calls
 class BasicCommands():
     """Basic commands class."""
 
+    broker = subsystem(BrokerConnect)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
         self.state = state
 
     def wait(self, duration):
@@ -47,6 +51,19 @@ class BasicCommands():
         stop_message = self.broker.wrap_message(stop_message, priority=9000)
         self.broker.publish(stop_message)
 
+    def e_stop_now(self, timeout=None):
+        """E-stops immediately via the control channel. Returns a Future of the response."""
+
+        stop_message = {
+            "kind": "emergency_lock",
+            "args": {}
+        }
+
+        stop_message = self.broker.wrap_message(stop_message, priority=9000)
+        future = self.broker.publish_now(stop_message, timeout)
+        self.state.print_status(description="Sent emergency stop on control channel.")
+        return future
+
     def unlock(self):
         """Unlocks a locked (E-stopped) device."""
 
@@ -8,29 +8,83 @@ BrokerConnect class.
 #     ├── [BROKER] publish()
 #     ├── [BROKER] start_listen()
 #     ├── [BROKER] stop_listen()
-#     └── [BROKER] listen()
+#     ├── [BROKER] listen()
+#     ├── [BROKER] subscribe()
+#     ├── [BROKER] unsubscribe()
+#     ├── [BROKER] watch()
+#     ├── [BROKER] unwatch()
+#     ├── [BROKER] stream()
+#     ├── [BROKER] start_session()
+#     ├── [BROKER] end_session()
+#     ├── [BROKER] open_control_channel()
+#     ├── [BROKER] close_control_channel()
+#     └── [BROKER] publish_now()
 
 import time
 import math
-import json
-import uuid
+import itertools
 import functools
+import threading
 from datetime import datetime
-import paho.mqtt.client as mqtt
 
+from ..state import track_calls, untracked, response_label
+from .. import codec
+from ..tracing import set_attribute
+from ..diff import difference, json_patch, escape
+from ..stream import MessageStream, MAX_BUFFERED_MESSAGES
+from ..timeouts import command_timeout, MOVEMENT_KINDS, VARIABLE_KINDS
 
+SESSION_CHANNELS = ("from_device", "status", "logs")
+# The network loop reconnects, doubling the delay after each failed attempt
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 60
+# Commands safe to send again if the connection drops before a response
+REPLAY_KINDS = ["read_status", "emergency_lock", "emergency_unlock", "sync"]
+# Commands whose responses are read when sent, so plans can't record them
+RESPONSE_KINDS = ["read_status", "read_pin"]
+
+
+def path_overlaps(path, pointer):
+    """Check if a change at one JSON Pointer affects the value at another."""
+    return (path == pointer
+            or path.startswith(pointer + "/")
+            or pointer.startswith(path + "/")
+            or "" in [path, pointer])
+
+
+@track_calls
 class BrokerConnect():
     """Broker connection class."""
 
     def __init__(self, state):
         self.state = state
         self.client = None
+        self.lock = threading.RLock()
+        # Held while listeners are added or removed and the network loop is
+        # started or stopped, so a stop can't follow another thread's start.
+        # Callbacks on the network thread never take it, since stopping the
+        # loop waits for that thread.
+        self.loop_lock = threading.RLock()
+        self.handlers = {}
+        self.ack_times = {}
+        self.ids = itertools.count(1)
+        self.subscribers = {}
+        self.watchers = {}
+        self.watch_subscription = None
+        self.last_status = None
+        self.session_channels = []
+        self.waiters = []
+        self.topics = set()
+        self.in_flight = {}
+        self.failed_labels = set()
+        self.disconnected_at = None
 
     def connect(self):
         """Establish persistent connection to send messages via message broker."""
 
         self.state.check_token()
 
+        import paho.mqtt.client as mqtt
         self.client = mqtt.Client()
         self.client.username_pw_set(
             username=self.state.token["token"]["unencoded"]["bot"],
@@ -42,6 +96,11 @@ class BrokerConnect():
             port=1883,
             keepalive=60
         )
+        self.client.reconnect_delay_set(
+            min_delay=RECONNECT_MIN_DELAY,
+            max_delay=RECONNECT_MAX_DELAY)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
 
         self.client.loop_start()
 
@@ -50,12 +109,16 @@ class BrokerConnect():
     def disconnect(self):
         """Disconnect from the message broker."""
 
+        if len(self.session_channels) > 0:
+            self.end_session()
         if self.client is not None:
+            self.client.on_disconnect = None
             self.client.loop_stop()
             self.client.disconnect()
             description = "Disconnected from message broker."
             self.state.print_status(description=description)
 
+    @untracked
     def wrap_message(self, message, priority=None):
         """Wrap message in CeleryScript format."""
         rpc = {
@@ -74,8 +137,26 @@ class BrokerConnect():
     def publish(self, message):
         """Publish messages containing CeleryScript via the message broker."""
 
-        if self.client is None:
-            self.connect()
+        recording = self.state.recording
+        steps = message["body"] if message["kind"] == "rpc_request" else [message]
+        if message["kind"] == "rpc_request" and "priority" in message["args"]:
+            # Priority commands (e.g., e-stop) are always sent right away
+            recording = None
+        if recording is not None:
+            kind = steps[0]["kind"]
+            if kind in RESPONSE_KINDS:
+                raise ValueError(
+                    f"Can't record {kind}: its response is read when sent.")
+            recording.extend(steps)
+            self.state.print_status(
+                description=f"Recorded {steps[0]['kind']} step.",
+                update_only=True)
+            return
+
+        with self.lock:
+            # Sessions publish on their own connection
+            if self.client is None and self.state.broker_session is None:
+                self.connect()
 
         rpc = message
         if rpc["kind"] != "rpc_request":
@@ -85,20 +166,33 @@ class BrokerConnect():
             if self.state.test_env:
                 rpc["args"]["label"] = "test"
             else:
+                import uuid
                 rpc["args"]["label"] = uuid.uuid4().hex
+        label = rpc["args"]["label"]
+        set_attribute("kind", rpc["body"][0]["kind"])
+        set_attribute("label", label)
 
         self.state.print_status(description="Publishing to 'from_clients'")
         self.state.print_status(endpoint_json=rpc, update_only=True)
+        response = None
         if self.state.dry_run:
             self.state.print_status(
                 description="Sending disabled, message not sent.",
                 update_only=True)
         else:
-            self.listen("from_device", publish_payload=rpc)
-
-        response = self.state.last_messages.get("from_device", [])
-        if len(response) > 0:
-            if response[-1]["content"]["kind"] == "rpc_ok":
+            with self.state.lock:
+                self.state.pending_labels.add(label)
+            try:
+                self.listen("from_device", publish_payload=rpc)
+            finally:
+                # Get the response while the label is still pending so
+                # other threads getting their responses don't remove it
+                with self.state.lock:
+                    response = self.state.get_response(label)
+                    self.state.pending_labels.discard(label)
+
+        if response is not None:
+            if response["content"]["kind"] == "rpc_ok":
                 self.state.print_status(
                     description="Success response received.",
                     update_only=True)
@@ -108,6 +202,9 @@ class BrokerConnect():
                     description="Error response received.",
                     update_only=True)
                 self.state.error = "RPC error response received."
+                self.state.metrics.increment(
+                    "broker_rpc_errors_total",
+                    {"kind": rpc["body"][0]["kind"]})
 
         self.state.last_published = rpc
 
@@ -119,28 +216,38 @@ class BrokerConnect():
         diff_only = options.get("diff_only")
         filters = options.get("filters", {})
 
-        if self.client is None:
-            self.connect()
+        with self.lock:
+            if self.client is None:
+                self.connect()
 
-        def add_message(key, topic, content):
-            """Add message to last_messages."""
-            if key not in self.state.last_messages:
-                self.state.last_messages[key] = []
+        def add_message(key, topic, content, stored):
+            """Add message to last_messages once per received message."""
+            if key in stored:
+                return
+            stored.add(key)
             if topic is None:
-                self.state.last_messages[key].append(content)
+                self.state.add_message(key, content)
                 return
-            self.state.last_messages[key].append({
+            self.state.add_message(key, {
                 "topic": topic,
                 "content": content,
             })
 
-        # Set on_message callback
-        def on_message(_client, _userdata, msg):
-            """on_message callback"""
-            channel_key = msg.topic.split("/")[2]
-            payload = json.loads(msg.payload)
+        def accepts(topic):
+            """Check the channel and topic filter before the payload is decoded."""
+            if channel.split("/")[0] not in ["#", topic.split("/")[2]]:
+                return False
+            if filters.get("topic", "") not in topic:
+                self.state.print_status(
+                    description="x",
+                    update_only=True,
+                    end="")
+                return False
+            return True
 
-            if not self.match({"topic": msg.topic, "content": payload}, filters):
+        def on_message(topic, channel_key, payload, stored):
+            """Handle a message received while listening."""
+            if not self.match({"topic": topic, "content": payload}, filters):
                 self.state.print_status(
                     description="x",
                     update_only=True,
@@ -148,14 +255,14 @@ class BrokerConnect():
                 return
 
             if channel == "#":
-                add_message(channel, msg.topic, payload)
-            add_message(channel_key, msg.topic, payload)
+                add_message(channel, topic, payload, stored)
+            add_message(channel_key, topic, payload, stored)
 
             for key in path:
                 payload = payload[key]
             path_channel = f"{channel_key}_excerpt"
             if len(path) > 0:
-                add_message(path_channel, None, payload)
+                add_message(path_channel, None, payload, stored)
 
             if diff_only:
                 key = path_channel if len(path) > 0 else channel_key
@@ -167,57 +274,441 @@ class BrokerConnect():
                     else:
                         current = last_messages[-1]["content"]
                         previous = last_messages[-2]["content"]
-                    diff, _is_different = difference(current, previous)
+                    diff, _is_different = difference(current, previous, removed=True)
                     payload = diff
-                    add_message(f"{channel_key}_diffs", None, payload)
+                    add_message(f"{channel_key}_diffs", None, payload, stored)
 
+            if not self.state.printing():
+                return
             self.state.print_status(description="", update_only=True)
             description = "New message"
             if len(path) > 0:
                 description += f" {'.'.join(path)}"
             if diff_only:
                 description += " diff"
-            description += f" from {msg.topic}"
+            description += f" from {topic}"
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             description += f" ({timestamp})"
             self.state.print_status(
                 endpoint_json=payload,
                 description=description)
 
-        self.client.on_message = on_message
+        with self.loop_lock:
+            with self.lock:
+                self.handlers[threading.get_ident()] = (accepts, on_message)
+            self.client.on_message = self._on_message
 
-        # Subscribe to channel
-        device_id_str = self.state.token["token"]["unencoded"]["bot"]
-        self.client.subscribe(f"bot/{device_id_str}/{channel}")
+            # Subscribe to channel
+            self.subscribe_topic(channel)
+
+            # Start listening
+            self.client.loop_start()
         description = f"Connected to message broker channel '{channel}'"
         if channel == "#":
             description = "Connected to all message broker channels"
         self.state.print_status(description=description)
-
-        # Start listening
-        self.client.loop_start()
         description = f"Now listening to message broker channel '{channel}'"
         if channel == "#":
             description = "Now listening to all message broker channels"
         self.state.print_status(description=description)
 
+    def _on_message(self, _client, _userdata, msg):
+        """Internal on_message callback delivering messages to listeners."""
+        channel_key = msg.topic.split("/")[2]
+        labels = {"channel": channel_key}
+        self.state.metrics.increment("broker_messages_received_total", labels)
+        self.state.metrics.increment(
+            "broker_bytes_received_total", labels, len(msg.payload))
+
+        with self.lock:
+            handlers = list(self.handlers.values())
+            subscribers = [
+                (callback, raw) for channel, callback, raw in self.subscribers.values()
+                if channel.split("/")[0] in ["#", channel_key]]
+            waiting = any(waiter["channel"] == channel_key for waiter in self.waiters)
+        handlers = [on_message for accepts, on_message in handlers if accepts(msg.topic)]
+        for callback, raw in subscribers:
+            if raw:
+                callback(msg.topic, msg.payload)
+        subscribers = [callback for callback, raw in subscribers if not raw]
+
+        # Only decode messages something will read
+        acks = channel_key == "from_device" and len(self.state.pending_labels) > 0
+        if not (handlers or subscribers or waiting or acks):
+            return
+        payload = codec.loads(msg.payload)
+
+        if channel_key == "status":
+            self.state.known_position.reported(payload)
+
+        label = None
+        if channel_key == "from_device":
+            label = response_label({"content": payload})
+            if label in self.state.pending_labels:
+                self.ack_times[label] = time.perf_counter()
+
+        with self.lock:
+            waiters = [
+                waiter for waiter in self.waiters
+                if waiter["channel"] == channel_key and waiter["label"] in [None, label]]
+            for waiter in waiters:
+                self.waiters.remove(waiter)
+        if len(waiters) > 0:
+            self.state.add_message(channel_key, {
+                "topic": msg.topic,
+                "content": payload,
+            })
+            for waiter in waiters:
+                waiter["event"].set()
+                if "future" in waiter:
+                    waiter["future"].set_result(payload)
+
+        stored = set()
+        for handler in handlers:
+            handler(msg.topic, channel_key, payload, stored)
+        for callback in subscribers:
+            callback(msg.topic, payload)
+
+    @untracked
+    def subscribe_topic(self, channel):
+        """Subscribe to a channel, remembering it for resubscription after reconnecting."""
+        device_id_str = self.state.token["token"]["unencoded"]["bot"]
+        topic = f"bot/{device_id_str}/{channel}"
+        with self.lock:
+            self.topics.add(topic)
+        self.client.subscribe(topic)
+
+    def _on_connect(self, _client, _userdata, *_args):
+        """Internal on_connect callback restoring subscriptions and in-flight commands."""
+        with self.lock:
+            disconnected_at = self.disconnected_at
+            self.disconnected_at = None
+            topics = sorted(self.topics)
+            replays = [command["rpc"] for command in self.in_flight.values()
+                       if not command["sent"]
+                       or command["rpc"]["body"][0]["kind"] in REPLAY_KINDS]
+            for command in self.in_flight.values():
+                command["sent"] = True
+        if disconnected_at is None:
+            return
+
+        downtime = time.monotonic() - disconnected_at
+        self.state.metrics.increment("broker_reconnects_total")
+        self.state.metrics.increment("broker_downtime_seconds_total", value=downtime)
+        self.state.print_status(
+            description=f"Reconnected to message broker after {downtime:.1f} seconds.")
+        for topic in topics:
+            self.client.subscribe(topic)
+        device_id_str = self.state.token["token"]["unencoded"]["bot"]
+        for rpc in replays:
+            self.state.metrics.increment(
+                "broker_rpc_replays_total", {"kind": rpc["body"][0]["kind"]})
+            self.client.publish(
+                f"bot/{device_id_str}/from_clients", payload=codec.encode(rpc))
+
+    def _on_disconnect(self, _client, _userdata, *_args):
+        """Internal on_disconnect callback failing in-flight commands that can't be resent."""
+        with self.lock:
+            if self.disconnected_at is not None:
+                return
+            self.disconnected_at = time.monotonic()
+            failed = [label for label, command in self.in_flight.items()
+                      if command["sent"]
+                      and command["rpc"]["body"][0]["kind"] not in REPLAY_KINDS]
+            for label in failed:
+                self.in_flight.pop(label)
+            self.failed_labels.update(failed)
+            waiters = [waiter for waiter in self.waiters if waiter["label"] in failed]
+        self.state.metrics.increment("broker_disconnects_total")
+        self.state.print_status(description="Lost connection to message broker.")
+        for waiter in waiters:
+            waiter["event"].set()
+
+    @untracked
+    def listening(self):
+        """Check if any listener, subscriber, or session still needs the network loop."""
+        with self.lock:
+            return (len(self.handlers) > 0
+                    or len(self.subscribers) > 0
+                    or len(self.session_channels) > 0)
+
     def stop_listen(self):
         """End subscription to all message broker channels."""
 
-        self.client.loop_stop()
+        with self.loop_lock:
+            with self.lock:
+                self.handlers.pop(threading.get_ident(), None)
+            if not self.listening():
+                self.client.loop_stop()
 
         self.state.print_status(
             description="Stopped listening to all message broker channels.")
 
+    def subscribe(self, channel, callback, raw=False):
+        """Call `callback(topic, payload)` for each message on a channel until unsubscribed.
+
+        With `raw=True`, the payload is passed as received (bytes)
+        and isn't decoded for this subscriber.
+        """
+        with self.loop_lock:
+            with self.lock:
+                if self.client is None:
+                    self.connect()
+                subscription_id = next(self.ids)
+                self.subscribers[subscription_id] = (channel, callback, raw)
+            self.client.on_message = self._on_message
+
+            self.subscribe_topic(channel)
+            self.client.loop_start()
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        """Stop calling a subscribed callback."""
+        with self.loop_lock:
+            with self.lock:
+                self.subscribers.pop(subscription_id, None)
+            if not self.listening() and self.client is not None:
+                self.client.loop_stop()
+
+    def watch(self, path, callback, predicate=None):
+        """Call `callback(value)` when the status tree value at a path changes.
+
+        All watchers share one `status` subscription. Each status is compared
+        to the previous one once, and only watchers with a changed value at
+        their path (and a true `predicate(value)`, if given) are called.
+        """
+        keys = [key for key in (path or "").split(".") if key != ""]
+        pointer = "".join(f"/{escape(key)}" for key in keys)
+        with self.loop_lock, self.lock:
+            watch_id = next(self.ids)
+            self.watchers[watch_id] = (keys, pointer, callback, predicate)
+            if self.watch_subscription is None:
+                self.watch_subscription = self.subscribe("status", self._on_status)
+        description = f"Watching status path `{'.'.join(keys)}`"
+        self.state.print_status(description=description)
+        return watch_id
+
+    def unwatch(self, watch_id):
+        """Remove a watcher. The status subscription ends with the last watcher."""
+        with self.lock:
+            self.watchers.pop(watch_id, None)
+            subscription_id = None
+            if len(self.watchers) == 0:
+                subscription_id = self.watch_subscription
+                self.watch_subscription = None
+                self.last_status = None
+        if subscription_id is not None:
+            self.unsubscribe(subscription_id)
+
+    def stream(self, channel="#", filters=None, path=None,
+               duration=None, max_size=MAX_BUFFERED_MESSAGES):
+        """Return an iterator (and async iterator) of messages as they arrive."""
+        message_stream = MessageStream(
+            self, channel, filters, path, duration, max_size)
+        description = f"Streaming message broker channel '{channel}'"
+        if channel == "#":
+            description = "Streaming all message broker channels"
+        self.state.print_status(description=description)
+        return message_stream
+
+    def start_session(self, channels=SESSION_CHANNELS):
+        """Keep the network loop and channel subscriptions up between commands.
+
+        While a session is active, published commands wait for their
+        responses on the session subscriptions instead of subscribing,
+        starting, and stopping the network loop for each command.
+        """
+        with self.loop_lock:
+            with self.lock:
+                if self.client is None:
+                    self.connect()
+                self.client.on_message = self._on_message
+                for channel in channels:
+                    if channel not in self.session_channels:
+                        self.subscribe_topic(channel)
+                        self.session_channels.append(channel)
+            self.client.loop_start()
+        self.state.broker_session = self
+        channel_list = ", ".join(f"'{channel}'" for channel in self.session_channels)
+        self.state.print_status(
+            description=f"Started message broker session for {channel_list}")
+
+    def end_session(self):
+        """Stop the session network loop and subscriptions."""
+        if self.state.broker_session is self:
+            self.state.broker_session = None
+        with self.loop_lock:
+            with self.lock:
+                channels = self.session_channels
+                self.session_channels = []
+            if self.client is not None:
+                device_id_str = self.state.token["token"]["unencoded"]["bot"]
+                for channel in channels:
+                    topic = f"bot/{device_id_str}/{channel}"
+                    with self.lock:
+                        self.topics.discard(topic)
+                    self.client.unsubscribe(topic)
+                if not self.listening():
+                    self.client.loop_stop()
+        self.state.print_status(description="Ended message broker session.")
+
+    @untracked
+    def add_waiter(self, channel, label=None):
+        """Register a transient waiter for the next matching session message."""
+        waiter = {"channel": channel, "label": label, "event": threading.Event()}
+        with self.lock:
+            self.waiters.append(waiter)
+        return waiter
+
+    @untracked
+    def remove_waiter(self, waiter):
+        """Remove a waiter that may not have received a message. Returns True if removed."""
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                return True
+        return False
+
+    def open_control_channel(self):
+        """Connect a separate client for urgent commands ahead of time.
+
+        The client stays connected and subscribed to `from_device`,
+        so `publish_now()` only has to send.
+        """
+        with self.state.lock:
+            control = self.state.control_channel
+            if control is None:
+                control = BrokerConnect(self.state)
+                control.connect()
+                control.client.on_message = control._on_message
+                control.subscribe_topic("from_device")
+                self.state.control_channel = control
+        return control
+
+    def close_control_channel(self):
+        """Disconnect the control channel client."""
+        with self.state.lock:
+            control = self.state.control_channel
+            self.state.control_channel = None
+        if control is not None:
+            control.disconnect()
+
+    def publish_now(self, message, timeout=None):
+        """Publish a command on the control channel without waiting (QoS 1).
+
+        Returns a `concurrent.futures.Future` resolved with the response
+        content, or failed with TimeoutError if none arrives in time.
+        """
+        from concurrent.futures import Future
+        future = Future()
+        rpc = message
+        if rpc["kind"] != "rpc_request":
+            rpc = self.wrap_message(rpc)
+        kind = rpc["body"][0]["kind"]
+        if self.state.dry_run:
+            self.state.print_status(
+                description="Sending disabled, message not sent.",
+                update_only=True)
+            future.set_result(None)
+            return future
+
+        control = self.open_control_channel()
+        if rpc["args"]["label"] == "":
+            if self.state.test_env:
+                rpc["args"]["label"] = "test"
+            else:
+                import uuid
+                rpc["args"]["label"] = uuid.uuid4().hex
+        waiter = control.add_waiter("from_device", rpc["args"]["label"])
+        waiter["future"] = future
+
+        device_id_str = self.state.token["token"]["unencoded"]["bot"]
+        payload = codec.encode(rpc)
+        control.client.publish(
+            f"bot/{device_id_str}/from_clients", payload=payload, qos=1)
+        sent_at = time.perf_counter()
+
+        labels = {"kind": kind}
+        self.state.metrics.increment("broker_publish_total", labels)
+        self.state.metrics.increment("broker_bytes_sent_total", labels, len(payload))
+
+        def expire():
+            """Fail the future if no response arrived."""
+            if control.remove_waiter(waiter):
+                self.state.metrics.increment("broker_rpc_timeouts_total", labels)
+                future.set_exception(TimeoutError(
+                    f"No response to {kind} after {timer.interval} seconds."))
+
+        def record(done):
+            """Record response time and cancel the timeout."""
+            timer.cancel()
+            if not done.cancelled() and done.exception() is None:
+                seconds = time.perf_counter() - sent_at
+                self.state.metrics.observe("broker_rpc_seconds", seconds, labels)
+                self.state.round_trips.add(kind, seconds)
+        if timeout is None:
+            timeout = self.state.timeout["listen"]
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+        future.add_done_callback(record)
+        return future
+
+    @untracked
+    def command_timeout(self, message):
+        """Seconds to wait for a command's response, adapted to the command.
+
+        Movement estimates need the `firmware_config` cached by `preload()`.
+        """
+        return command_timeout(
+            message,
+            self.state.timeout,
+            self.state.round_trips,
+            self.state.fetch_cache("firmware_config"),
+            self.state.known_position.get(),
+            self.state.fixed_timeouts)
+
+    def _on_status(self, _topic, status):
+        """Internal status subscriber calling watchers with changed values."""
+        with self.lock:
+            previous = self.last_status
+            self.last_status = status
+            watchers = list(self.watchers.values())
+        if previous is None:
+            changed = [""]
+        else:
+            changed = [operation["path"] for operation in json_patch(previous, status)]
+        if len(changed) == 0:
+            return
+
+        for keys, pointer, callback, predicate in watchers:
+            if not any(path_overlaps(path, pointer) for path in changed):
+                continue
+            value = status
+            for key in keys:
+                if not isinstance(value, dict) or key not in value:
+                    value = None
+                    break
+                value = value[key]
+            try:
+                if predicate is None or predicate(value):
+                    callback(value)
+            except Exception as exception:
+                description = f"Watcher for `{'.'.join(keys)}` failed: {exception!r}"
+                self.state.print_status(description=description)
+
+    @untracked
     def clear_last_messages(self, key):
         """Clear last messages from a channel."""
-        if key == "#":
-            self.state.last_messages = {"#": []}
-            return
-        self.state.last_messages[key] = []
-        self.state.last_messages[f"{key}_excerpt"] = []
-        self.state.last_messages[f"{key}_diffs"] = []
+        with self.state.lock:
+            if key == "#":
+                self.state.last_messages = {"#": []}
+                return
+            self.state.last_messages[key] = []
+            self.state.last_messages[f"{key}_excerpt"] = []
+            self.state.last_messages[f"{key}_diffs"] = []
 
+    @untracked
     def match(self, message, filters):
         """Check if message matches filters."""
         if filters.get("topic", '') not in message["topic"]:
@@ -225,11 +716,21 @@ class BrokerConnect():
         for path, value in filters.get("content", {}).items():
             content = message["content"]
             for key in path.split("."):
+                if not isinstance(content, dict) or key not in content:
+                    return False
                 content = content[key]
             if str(value) not in str(content):
                 return False
         return True
 
+    @untracked
+    def received(self, channel, stop_count, label=None):
+        """Check if enough messages (or the response to `label`) arrived."""
+        messages = self.state.last_messages.get(channel, [])
+        if label is None:
+            return len(messages) > (stop_count - 1)
+        return any(response_label(message) == label for message in messages)
+
     @staticmethod
     def stop_listen_upon_interrupt(func):
         """Decorator to stop listening upon KeyboardInterrupt."""
@@ -255,18 +756,19 @@ class BrokerConnect():
         filters = message_options.get("filters", {})
         filters = {"topic": '', "content": {}, **filters}
         # Prepare duration option
-        timeout_key = "listen"
-        if message.get("kind") in ["move", "find_home", "calibrate"]:
-            timeout_key = "movements"
-        duration_seconds = duration or self.state.timeout[timeout_key]
+        duration_seconds = duration or self.state.timeout["listen"]
+        if publish and not duration:
+            duration_seconds = self.command_timeout(message)
         if message.get("kind") == "wait":
             duration_seconds += message["args"]["milliseconds"] / 1000
         if stop_count > 1:
             duration_seconds = math.inf
         # Prepare label matching
+        label = None
         if publish and publish_payload["args"]["label"] != "":
             # If a label is provided, verify the label matches
-            filters["content"]["args.label"] = publish_payload["args"]["label"]
+            label = publish_payload["args"]["label"]
+            filters["content"]["args.label"] = label
         if message.get("kind") == "read_status":
             # Getting the RPC response to read_status isn't as important as
             # returning the status as soon as possible, since the device
@@ -274,56 +776,115 @@ class BrokerConnect():
             # read_status command isn't received.
             channel = "status"
             filters = {"topic": 'status', "content": {}}
+            label = None
 
         # Print status message
-        description = "Listening to message broker"
-        if channel != "#":
-            description += f" channel '{channel}'"
-        if duration_seconds != math.inf:
-            description += f" for {duration_seconds} seconds"
-        filter_strs = []
-        if filters["topic"]:
-            filter_strs.append(f" for `{filters['topic']}` in topic")
-        for k, v in filters["content"].items():
-            filter_strs.append(f" for `{v}` in `{k}`")
-        description += " and".join(filter_strs)
-        if message_options.get("diff_only"):
-            description += " for diffs"
-        if message_options.get("path"):
-            description += f" at path `{message_options['path']}`"
-        plural = "s are" if stop_count > 1 else " is"
-        description += f" until {stop_count} message{plural} received"
-        description += "..."
-        self.state.print_status(description=description)
+        if self.state.printing():
+            description = "Listening to message broker"
+            if channel != "#":
+                description += f" channel '{channel}'"
+            if duration_seconds != math.inf:
+                description += f" for {duration_seconds} seconds"
+            filter_strs = []
+            if filters["topic"]:
+                filter_strs.append(f" for `{filters['topic']}` in topic")
+            for k, v in filters["content"].items():
+                filter_strs.append(f" for `{v}` in `{k}`")
+            description += " and".join(filter_strs)
+            if message_options.get("diff_only"):
+                description += " for diffs"
+            if message_options.get("path"):
+                description += f" at path `{message_options['path']}`"
+            plural = "s are" if stop_count > 1 else " is"
+            description += f" until {stop_count} message{plural} received"
+            description += "..."
+            self.state.print_status(description=description)
+
+        set_attribute("channel", channel)
+
+        if publish:
+            # Wait for a turn to send: higher priority commands go first
+            labels = {"kind": message.get("kind")}
+            waited = self.state.outgoing.acquire(publish_payload["args"].get("priority", 0))
+            if waited > 0:
+                self.state.metrics.observe("broker_queue_seconds", waited, labels)
+            if labels["kind"] in MOVEMENT_KINDS:
+                self.state.known_position.commanded(message)
 
         # Start listening
-        start_time = datetime.now()
-        self.start_listen(channel, {**message_options, "filters": filters})
-        if not self.state.test_env:
+        start_time = time.monotonic()
+        session = self.state.broker_session if publish else None
+        if session is not None and channel not in session.session_channels:
+            session = None
+        waiter = None
+        if session is None:
+            self.start_listen(channel, {**message_options, "filters": filters})
+        if not self.state.test_env and label is None:
+            # Responses are matched by label instead, since other
+            # threads may be waiting for their own responses.
             self.clear_last_messages(channel)
+        if session is not None:
+            # Session subscriptions are already up: only register a waiter
+            waiter = session.add_waiter(channel, label)
+        publisher = session or self
         if publish:
-            time.sleep(0.1)  # wait for start_listen to be ready
+            if session is None:
+                time.sleep(0.1)  # wait for start_listen to be ready
             device_id_str = self.state.token["token"]["unencoded"]["bot"]
             publish_topic = f"bot/{device_id_str}/from_clients"
-            self.client.publish(
-                publish_topic,
-                payload=json.dumps(publish_payload))
+            payload = codec.encode(publish_payload)
+            import paho.mqtt.client as mqtt
+            with publisher.lock:
+                info = publisher.client.publish(publish_topic, payload=payload)
+                publisher.in_flight[publish_payload["args"]["label"]] = {
+                    "rpc": publish_payload,
+                    # Unsent commands are sent after reconnecting
+                    "sent": getattr(info, "rc", None) != mqtt.MQTT_ERR_NO_CONN,
+                }
+            sent_at = time.perf_counter()
+            self.state.metrics.increment("broker_publish_total", labels)
+            self.state.metrics.increment(
+                "broker_bytes_sent_total", labels, len(payload))
         self.state.print_status(update_only=True, description="", end="")
-        while (datetime.now() - start_time).seconds < duration_seconds:
-            self.state.print_status(update_only=True, description=".", end="")
-            time.sleep(0.25)
-            last_messages = self.state.last_messages.get(channel, [])
-            if len(last_messages) > (stop_count - 1):
-                seconds = (datetime.now() - start_time).seconds
-                prefix = f"{stop_count} messages"
-                if stop_count == 1:
-                    prefix = "Message"
-                description = f"{prefix} received after {seconds} seconds"
+        failed = False
+        if waiter is not None:
+            waiter["event"].wait(
+                None if duration_seconds == math.inf else duration_seconds)
+            session.remove_waiter(waiter)
+            if self.received(channel, 1, label):
+                seconds = time.monotonic() - start_time
                 self.state.print_status(
-                    description=description,
+                    description=f"Message received after {seconds:.2f} seconds",
                     update_only=True)
-                break
-        if len(self.state.last_messages.get(channel, [])) == 0:
+        else:
+            while time.monotonic() - start_time < duration_seconds:
+                self.state.print_status(update_only=True, description=".", end="")
+                time.sleep(0.25)
+                if publish and publish_payload["args"]["label"] in publisher.failed_labels:
+                    break
+                if self.received(channel, stop_count, label):
+                    seconds = time.monotonic() - start_time
+                    prefix = f"{stop_count} messages"
+                    if stop_count == 1:
+                        prefix = "Message"
+                    description = f"{prefix} received after {seconds:.2f} seconds"
+                    self.state.print_status(
+                        description=description,
+                        update_only=True)
+                    break
+        if publish:
+            with publisher.lock:
+                rpc_label = publish_payload["args"]["label"]
+                publisher.in_flight.pop(rpc_label, None)
+                failed = rpc_label in publisher.failed_labels
+                publisher.failed_labels.discard(rpc_label)
+        if failed and not self.received(channel, 1, label):
+            self.state.print_status(
+                description="Connection lost before a response was received.",
+                update_only=True)
+            self.state.error = "Lost connection to message broker."
+            self.state.metrics.increment("broker_rpc_failures_total", labels)
+        elif not self.received(channel, 1, label):
             self.state.print_status(description="", update_only=True)
             secs = duration_seconds
             description = f"Did not receive message after {secs} seconds"
@@ -331,43 +892,23 @@ class BrokerConnect():
                 description=description,
                 update_only=True)
             self.state.error = "Timed out waiting for RPC response."
+            set_attribute("timed_out", True)
+            if publish:
+                self.state.metrics.increment(
+                    "broker_rpc_timeouts_total", labels)
         else:
             self.state.error = None
-
-        self.stop_listen()
-
-
-def difference(next_state, prev_state):
-    """Find the difference between two states."""
-    is_different = False
-    diff = {}
-
-    if next_state != prev_state:
-        is_different = True
-
-    if not isinstance(next_state, dict) or not isinstance(prev_state, dict):
-        return next_state, is_different
-
-    for key, next_value in next_state.items():
-        if key not in prev_state:
-            diff[key] = next_value
-            is_different = True
-            continue
-        prev_value = prev_state[key]
-        if next_value != prev_value:
-            if isinstance(next_value, dict) and isinstance(prev_value, dict):
-                nested_diff, nested_is_different = difference(
-                    next_value,
-                    prev_value)
-                if nested_is_different:
-                    diff[key] = nested_diff
-                    is_different = True
-            else:
-                diff[key] = next_value
-                is_different = True
-
-    for key in prev_state:
-        if key not in next_state:
-            is_different = True
-
-    return diff, is_different
+            if publish:
+                received_at = (session or self).ack_times.pop(
+                    label, time.perf_counter())
+                self.state.metrics.observe(
+                    "broker_rpc_seconds", received_at - sent_at, labels)
+                if labels["kind"] not in MOVEMENT_KINDS + VARIABLE_KINDS:
+                    self.state.round_trips.add(labels["kind"], received_at - sent_at)
+
+        if publish and labels["kind"] in MOVEMENT_KINDS:
+            self.state.known_position.finished(
+                not failed and self.received(channel, 1, label))
+
+        if waiter is None:
+            self.stop_listen()
@@ -7,14 +7,17 @@ Camera class.
 #     ├── [BROKER] take_photo()
 #     └── [BROKER] photo_grid()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 
 
+@track_calls
 class Camera():
     """Camera class."""
 
+    broker = subsystem(BrokerConnect)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
         self.state = state
 
     def calibrate_camera(self):
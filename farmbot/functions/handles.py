@@ -0,0 +1,154 @@
+"""
+ResourceHandle classes.
+"""
+
+# └── functions/handles.py
+#     ├── [API] ResourceHandle.resolve()
+#     ├── [BROKER] PeripheralHandle.write()
+#     ├── [BROKER] PeripheralHandle.toggle()
+#     ├── [BROKER] SensorHandle.read()
+#     └── [BROKER] SequenceHandle.run()
+
+from ..state import track_calls, subsystem
+from .broker import BrokerConnect
+from .information import Information
+from .resources import Resources
+
+
+def named_pin(pin_type, pin_id):
+    """Named pin argument referring to a peripheral or sensor by id."""
+    return {
+        "kind": "named_pin",
+        "args": {
+            "pin_type": pin_type,
+            "pin_id": pin_id,
+        }
+    }
+
+
+@track_calls
+class ResourceHandle():
+    """Resource found by name on first use and referenced by id afterwards."""
+
+    endpoint = None
+    name_key = "label"
+
+    broker = subsystem(BrokerConnect)
+    info = subsystem(Information)
+
+    def __init__(self, state, name, parent=None):
+        self.state = state
+        self.name = name
+        self.parent = parent
+        self.resource = None
+
+    def _prepare(self, resource):
+        """Build the message arguments used for each call."""
+
+    def resolve(self):
+        """Returns the resource, searching for it by name only on first use."""
+        if self.resource is None:
+            resource = self.info.get_resource_by_name(
+                self.endpoint, self.name, self.name_key)
+            if resource is None:
+                return None
+            self._prepare(resource)
+            self.resource = resource
+        return self.resource
+
+    def reset(self):
+        """Forget the resolved resource so the next call searches again."""
+        self.resource = None
+
+
+@track_calls
+class PeripheralHandle(ResourceHandle):
+    """Peripheral handle."""
+
+    endpoint = "peripherals"
+
+    def _prepare(self, resource):
+        self.pin = named_pin("Peripheral", resource["id"])
+        self.mode = resource["mode"]
+
+    def write(self, value, mode=None):
+        """Set peripheral value and mode."""
+        self.state.print_status(description=f"Setting {self.name} to {value}.")
+        if self.resolve() is None:
+            return
+        pin_mode = self.mode
+        if mode is not None:
+            pin_mode = self.info.convert_mode_to_number(mode)
+
+        write_message = {
+            "kind": "write_pin",
+            "args": {
+                "pin_value": value,
+                "pin_mode": pin_mode,
+                "pin_number": self.pin,
+            }
+        }
+
+        self.broker.publish(write_message)
+
+    def toggle(self):
+        """Toggles the peripheral between `on` and `off`."""
+        self.state.print_status(description=f"Toggling {self.name}.")
+        if self.resolve() is None:
+            return
+
+        toggle_message = {
+            "kind": "toggle_pin",
+            "args": {
+                "pin_number": self.pin,
+            }
+        }
+
+        self.broker.publish(toggle_message)
+
+
+@track_calls
+class SensorHandle(ResourceHandle):
+    """Sensor handle."""
+
+    endpoint = "sensors"
+
+    def _prepare(self, resource):
+        self.pin = named_pin("Sensor", resource["id"])
+        self.mode = resource["mode"]
+
+    def read(self):
+        """Reads the sensor."""
+        self.state.print_status(description=f"Reading {self.name} sensor...")
+        if self.resolve() is None:
+            return
+
+        read_message = {
+            "kind": "read_pin",
+            "args": {
+                "pin_mode": self.mode,
+                "label": "---",
+                "pin_number": self.pin,
+            }
+        }
+
+        self.broker.publish(read_message)
+
+
+@track_calls
+class SequenceHandle(ResourceHandle):
+    """Sequence handle."""
+
+    endpoint = "sequences"
+    name_key = "name"
+
+    resources = subsystem(Resources)
+
+    def run(self, **kwargs):
+        """Executes the sequence."""
+        self.state.print_status(description=f"Running {self.name} sequence.")
+        sequence = self.resolve()
+        if sequence is None:
+            return
+
+        self.resources.execute(sequence["id"], **kwargs)
@@ -0,0 +1,33 @@
+"""
+HTMLResponseParser class.
+"""
+
+from html.parser import HTMLParser
+
+
+class HTMLResponseParser(HTMLParser):
+    """Response parser for HTML content."""
+
+    def __init__(self):
+        super().__init__()
+        self.is_header = False
+        self.headers = []
+
+    def read(self, data):
+        """Read the headers from the HTML content."""
+        self.is_header = False
+        self.headers = []
+        self.reset()
+        self.feed(data)
+        return " ".join(self.headers)
+
+    def handle_starttag(self, tag, attrs):
+        """Detect headers."""
+        if tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+            self.is_header = True
+
+    def handle_data(self, data):
+        """Add header data to the list."""
+        if self.is_header:
+            self.headers.append(data.strip())
+            self.is_header = False
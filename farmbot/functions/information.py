@@ -10,21 +10,73 @@ Information class.
 #     ├── [API] safe_z()
 #     ├── [API] garden_size()
 #     ├── [API] curve()
+#     ├── [API] fetch_endpoints()
+#     ├── [API] resolve_many()
+#     ├── [API] preload()
+#     ├── [API] sync_mirror()
+#     ├── [API] sync_cache()
+#     ├── [API] get_points_table()
+#     ├── [API] export()
 #     ├── [BROKER] measure_soil_height()
 #     ├── [BROKER] read_status()
 #     ├── [BROKER] read_pin()
 #     └── [BROKER] read_sensor()
 
+from ..state import track_calls, subsystem
+from ..mirror import MIRROR_ENDPOINTS
+from ..points import PointsTable
+from ..export import ColumnBuilder, export_format_for
 from .broker import BrokerConnect
 from .api import ApiConnect
 
+PRELOAD_ENDPOINTS = (
+    "sequences",
+    "peripherals",
+    "sensors",
+    "tools",
+    "points",
+    "fbos_config",
+    "firmware_config",
+)
 
+# Above this many changed records, download the whole endpoint instead
+MAX_RECORD_REQUESTS = 10
+
+
+def filter_resources(resources, query=None):
+    """Resources with matching values for each query key."""
+    if query is not None:
+        for key, value in query.items():
+            resources = [res for res in resources if res[key] == value]
+    return resources
+
+
+def find_resource(resources, resource_name, name_key="label", query=None):
+    """First resource with the given name, or None."""
+    for resource in filter_resources(resources, query):
+        if resource[name_key] == resource_name:
+            return resource
+    return None
+
+
+def manifest_changes(records, manifest_records):
+    """Ids of new or changed records and of deleted records."""
+    cached = {record["id"]: record.get("updated_at") for record in records}
+    current = dict(manifest_records)
+    changed = [record_id for record_id, updated_at in current.items()
+               if record_id not in cached or cached[record_id] != updated_at]
+    removed = cached.keys() - current.keys()
+    return changed, removed
+
+
+@track_calls
 class Information():
     """Information class."""
 
+    broker = subsystem(BrokerConnect)
+    api = subsystem(ApiConnect)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.api = ApiConnect(state)
         self.state = state
 
     def api_get(self, endpoint, database_id=None, payload=None, data_print=True):
@@ -96,7 +148,9 @@ class Information():
         """Returns the highest safe point along the z-axis."""
         self.state.print_status(description="Retrieving safe z value...")
 
-        config_data = self.api_get('fbos_config')
+        config_data = self.state.fetch_cache("fbos_config")
+        if config_data is None:
+            config_data = self.api_get('fbos_config')
         z_value = config_data["safe_height"]
 
         self.state.print_status(
@@ -107,7 +161,9 @@ class Information():
         """Return size of garden bed."""
         self.state.print_status(description="Retrieving garden size...")
 
-        json_data = self.api_get('firmware_config')
+        json_data = self.state.fetch_cache("firmware_config")
+        if json_data is None:
+            json_data = self.api_get('firmware_config')
 
         x_steps = json_data['movement_axis_nr_steps_x']
         x_mm = json_data['movement_step_per_mm_x']
@@ -127,6 +183,38 @@ class Information():
         self.state.print_status(endpoint_json=garden_size, update_only=True)
         return garden_size
 
+    def get_points_table(self):
+        """Returns all points as a compact PointsTable."""
+        self.state.print_status(description="Retrieving points table...")
+
+        points = self.state.fetch_cache("points")
+        if points is None:
+            points = self.api_get("points", data_print=False)
+        if not isinstance(points, list):
+            return None
+
+        table = PointsTable(points)
+        self.state.print_status(
+            description=f"Stored {len(table)} points.", update_only=True)
+        return table
+
+    def export(self, endpoint, path, export_format=None):
+        """Download records into columns and write them to a CSV, .npz or .parquet file."""
+        export_format = export_format_for(path, export_format)
+        self.state.print_status(description=f"Exporting {endpoint} to {path}...")
+
+        records = self.api.stream(endpoint)
+        if records is None:
+            return None
+        columns = ColumnBuilder()
+        for record in records:
+            columns.append(record)
+        columns.write(path, export_format)
+
+        self.state.print_status(
+            description=f"Exported {columns.count} records.", update_only=True)
+        return columns.count
+
     def get_curve(self, curve_id):
         """Retrieve curve data from the API and return a curve object with extras."""
         self.state.print_status(description="Preparing curve information...")
@@ -226,26 +314,175 @@ class Information():
         self.state.print_status(
             description=f"Searching for {resource_name} in {endpoint}.")
         resources = self.state.fetch_cache(endpoint)
-        if resources is None:
-            resources = self.api_get(endpoint, data_print=False)
-        else:
+        mirror = self.state.mirror
+        if resources is None and self.state.fetch_cache(endpoint, stale=True):
+            # Update previously cleared records instead of downloading them all
+            self.sync_cache([endpoint])
+            resources = self.state.fetch_cache(endpoint)
+        if resources is not None:
             self.state.print_status(
                 description=f"Using {len(resources)} cached items.")
-        if query is not None:
-            for key, value in query.items():
-                resources = [res for res in resources if res[key] == value]
-        names = [resource[name_key] for resource in resources]
-        if resource_name not in names:
+        else:
+            if mirror is not None and mirror.has(endpoint):
+                found = mirror.query(endpoint, **{**(query or {}), name_key: resource_name})
+                if len(found) > 0:
+                    self.state.print_status(
+                        description="Found in local mirror.", update_only=True)
+                    return found[0]
+            # Not cached or mirrored (or added since the last mirror sync)
+            resources = self.api_get(endpoint, data_print=False)
+
+        resource = find_resource(resources, resource_name, name_key, query)
+        if resource is None:
+            names = [res[name_key] for res in filter_resources(resources, query)]
             error = f"ERROR: '{resource_name}' not in {endpoint}: {names}."
             self.state.print_status(description=error, update_only=True)
             self.state.error = error
-            self.state.clear_cache(endpoint)
+            self.state.expire_cache(endpoint)
             return None
 
         self.state.save_cache(endpoint, resources)
-        resource = [p for p in resources if p[name_key] == resource_name][0]
         return resource
 
+    def sync_cache(self, endpoints=None):
+        """Update cached endpoints with only new, changed and deleted records."""
+        if endpoints is None:
+            with self.state.lock:
+                endpoints = [*self.state.resource_cache, *self.state.stale_cache]
+        self.state.print_status(description="Syncing cached records...")
+
+        manifest = self.api_get("device/sync", data_print=False)
+        if not isinstance(manifest, dict):
+            return None
+
+        changes = {}
+        for endpoint in endpoints:
+            records = self.state.fetch_cache(endpoint, stale=True)
+            if records is None or not isinstance(manifest.get(endpoint), list):
+                continue
+            changed, removed = manifest_changes(records, manifest[endpoint])
+            if len(changed) > MAX_RECORD_REQUESTS:
+                records = self.api_get(endpoint, data_print=False)
+                if not isinstance(records, list):
+                    return None
+            else:
+                updates = {}
+                for record_id in changed:
+                    record = self.api_get(endpoint, record_id, data_print=False)
+                    if not isinstance(record, dict):
+                        return None
+                    updates[record_id] = record
+                records = [updates.pop(record["id"], record) for record in records
+                           if record["id"] not in removed]
+                records.extend(updates.values())
+            self.state.save_cache(endpoint, records)
+            changes[endpoint] = {"updated": len(changed), "removed": len(removed)}
+
+        self.state.print_status(endpoint_json=changes, update_only=True)
+        return changes
+
+    def fetch_endpoints(self, endpoints):
+        """Cache uncached endpoints, downloading those not synced or mirrored concurrently."""
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+
+        endpoints = [endpoint for endpoint in dict.fromkeys(endpoints)
+                     if self.state.fetch_cache(endpoint) is None]
+        stale = [endpoint for endpoint in endpoints
+                 if self.state.fetch_cache(endpoint, stale=True)]
+        if len(stale) > 0:
+            # Update previously cleared records instead of downloading them all
+            self.sync_cache(stale)
+        mirror = self.state.mirror
+        remaining = []
+        for endpoint in endpoints:
+            if self.state.fetch_cache(endpoint) is not None:
+                continue
+            if mirror is not None and mirror.has(endpoint):
+                self.state.save_cache(endpoint, mirror.query(endpoint))
+                continue
+            remaining.append(endpoint)
+        endpoints = remaining
+        if len(endpoints) == 0:
+            return True
+
+        def fetch(endpoint):
+            context = contextvars.copy_context()
+            return context.run(self.api_get, endpoint, data_print=False)
+
+        with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+            results = list(executor.map(fetch, endpoints))
+
+        success = True
+        for endpoint, records in zip(endpoints, results):
+            if isinstance(records, (list, dict)):
+                self.state.save_cache(endpoint, records)
+            else:
+                # api_get returns the error message
+                self.state.error = records
+                success = False
+        return success
+
+    def resolve_many(self, lookups):
+        """Find resources by (endpoint, name, name_key), downloading each endpoint once."""
+        if not self.fetch_endpoints([lookup[0] for lookup in lookups]):
+            return None
+        resources = []
+        for endpoint, resource_name, name_key in lookups:
+            resource = self.get_resource_by_name(endpoint, resource_name, name_key)
+            if resource is None:
+                return None
+            resources.append(resource)
+        return resources
+
+    def preload(self, endpoints=PRELOAD_ENDPOINTS):
+        """Download and cache commonly used endpoints concurrently."""
+        self.state.print_status(
+            description=f"Preloading {len(endpoints)} endpoints...")
+        self.api.start_session(pool_size=len(endpoints))
+        return self.fetch_endpoints(endpoints)
+
+    def sync_mirror(self, endpoints=MIRROR_ENDPOINTS):
+        """Update the local mirror with new, changed and deleted records."""
+        mirror = self.state.mirror
+        if mirror is None:
+            error = "ERROR: No local mirror, please call `set_mirror` first."
+            self.state.print_status(description=error)
+            self.state.error = error
+            return None
+
+        self.state.print_status(
+            description=f"Syncing {len(endpoints)} endpoints to local mirror...")
+        manifest = {}
+        if any(mirror.has(endpoint) for endpoint in endpoints):
+            # Only download records changed since the previous sync
+            manifest = self.api_get("device/sync", data_print=False)
+            if not isinstance(manifest, dict):
+                return None
+
+        changes = {}
+        for endpoint in endpoints:
+            changed = None
+            if mirror.has(endpoint) and isinstance(manifest.get(endpoint), list):
+                changed, removed = manifest_changes(
+                    mirror.versions(endpoint), manifest[endpoint])
+            if changed is None or len(changed) > MAX_RECORD_REQUESTS:
+                records = self.api_get(endpoint, data_print=False)
+                if not isinstance(records, list):
+                    return None
+                changes[endpoint] = mirror.sync(endpoint, records)
+                continue
+            records = []
+            for record_id in changed:
+                record = self.api_get(endpoint, record_id, data_print=False)
+                if not isinstance(record, dict):
+                    return None
+                records.append(record)
+            changes[endpoint] = mirror.update(endpoint, records, removed)
+
+        self.state.print_status(endpoint_json=changes, update_only=True)
+        return changes
+
 
 class Curve:
     """Curve data object for the get_curve() function to return."""
@@ -7,19 +7,22 @@ JobHandling class.
 #     ├── [BROKER] set_job()
 #     └── [BROKER] complete_job()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 
 from .information import Information
 from .resources import Resources
 
 
+@track_calls
 class JobHandling():
     """Job handling class."""
 
+    broker = subsystem(BrokerConnect)
+    info = subsystem(Information)
+    resource = subsystem(Resources)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.info = Information(state)
-        self.resource = Resources(state)
         self.state = state
 
     def get_job(self, job_name=None):
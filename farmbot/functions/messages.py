@@ -8,6 +8,7 @@ MessageHandling class.
 #     ├── [BROKER] debug()
 #     └── [BROKER] toast()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 from .api import ApiConnect
 from .information import Information
@@ -27,13 +28,15 @@ def validate_log_options(message_type, channels):
             raise ValueError(f"Invalid channel: {channel} not in {CHANNELS}")
 
 
+@track_calls
 class MessageHandling():
     """Message handling class."""
 
+    broker = subsystem(BrokerConnect)
+    api = subsystem(ApiConnect)
+    info = subsystem(Information)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.api = ApiConnect(state)
-        self.info = Information(state)
         self.state = state
 
     def log(self, message_str, message_type="info", channels=None):
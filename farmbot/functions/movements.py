@@ -10,6 +10,7 @@ MovementControls class.
 #     ├── [BROKER] find_axis_length()
 #     └── [BROKER] check_position()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 from .information import Information
 
@@ -22,12 +23,14 @@ def validate_axis(axis):
         raise ValueError(f"Invalid axis: {axis} not in {AXES}")
 
 
+@track_calls
 class MovementControls():
     """MovementControls class."""
 
+    broker = subsystem(BrokerConnect)
+    info = subsystem(Information)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.info = Information(state)
         self.state = state
 
     def move(self, x=None, y=None, z=None, safe_z=None, speed=None):
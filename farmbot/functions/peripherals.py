@@ -10,16 +10,19 @@ Peripherals class.
 #     ├── [BROKER] on()
 #     └── [BROKER] off()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 from .information import Information
 
 
+@track_calls
 class Peripherals():
     """Peripherals class."""
 
+    broker = subsystem(BrokerConnect)
+    info = subsystem(Information)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.info = Information(state)
         self.state = state
 
     def control_servo(self, pin, angle):
@@ -0,0 +1,110 @@
+"""
+Plan class.
+"""
+
+# └── functions/plans.py
+#     ├── [API] upload()
+#     └── [BROKER] run()
+
+from ..state import track_calls, subsystem
+from .information import Information
+from .resources import Resources
+
+
+def content_hash(name, color, body):
+    """Hash of the content of a sequence."""
+    import json
+    import hashlib
+    content = json.dumps(
+        {"name": name, "color": color, "body": body}, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+@track_calls
+class Plan():
+    """Commands recorded as a sequence, uploaded once and run with one RPC.
+
+    Commands sent within the `with` block are recorded instead of sent.
+    Commands that read a response (i.e., `get_xyz()`) raise ValueError,
+    and priority commands (i.e., `e_stop()`) are sent right away.
+    """
+
+    info = subsystem(Information)
+    resources = subsystem(Resources)
+
+    def __init__(self, state, name, color="gray", parent=None):
+        self.state = state
+        self.parent = parent
+        self.name = name
+        self.color = color
+        self.body = []
+        self.previous_recording = None
+
+    def __enter__(self):
+        self.previous_recording = self.state.recording
+        self.state.recording = self.body
+        return self
+
+    def __exit__(self, *exception_info):
+        self.state.recording = self.previous_recording
+        self.previous_recording = None
+
+    def content_hash(self):
+        """Hash of the recorded sequence."""
+        return content_hash(self.name, self.color, self.body)
+
+    def sequence_name(self):
+        """Name of the uploaded sequence, unique to the recorded steps."""
+        return f"{self.name} [{self.content_hash()[:8]}]"
+
+    def upload(self):
+        """Uploads the recorded steps as a sequence if not already uploaded."""
+        digest = self.content_hash()
+        with self.state.lock:
+            sequence_id = self.state.plan_ids.get(digest)
+        if sequence_id is not None:
+            return sequence_id
+
+        sequence_name = self.sequence_name()
+        self.state.print_status(description=f"Uploading {sequence_name}.")
+
+        sequences = self.state.fetch_cache("sequences")
+        if sequences is None:
+            sequences = self.info.api_get("sequences", data_print=False)
+        if not isinstance(sequences, list):
+            return None
+        existing = [seq for seq in sequences if seq["name"] == sequence_name]
+        if len(existing) > 0:
+            sequence_id = existing[0]["id"]
+            self.state.print_status(
+                description=f"Found existing sequence {sequence_id}.",
+                update_only=True)
+        else:
+            sequence = self.info.api_post("sequences", {
+                "name": sequence_name,
+                "color": self.color,
+                "kind": "sequence",
+                "args": {
+                    "locals": {"kind": "scope_declaration", "args": {}},
+                },
+                "body": self.body,
+            })
+            if not isinstance(sequence, dict):
+                return None
+            sequence_id = sequence["id"]
+            sequences = [*sequences, sequence]
+
+        self.state.save_cache("sequences", sequences)
+        with self.state.lock:
+            self.state.plan_ids[digest] = sequence_id
+        return sequence_id
+
+    def run(self, **kwargs):
+        """Executes the recorded steps on the device as a single sequence."""
+        self.state.print_status(description=f"Running {self.name} plan.")
+
+        sequence_id = self.upload()
+        if sequence_id is None:
+            return
+
+        self.resources.execute(sequence_id, **kwargs)
@@ -5,12 +5,14 @@ Resources class.
 # └── functions/resources.py
 #     ├── [BROKER] sort_points()
 #     ├── [BROKER] sequence()
+#     ├── [BROKER] execute()
 #     ├── [BROKER] get_seed_tray_cell()
 #     ├── [BROKER] detect_weeds()
 #     ├── [BROKER] lua()
 #     ├── [BROKER] if_statement()
 #     └── [BROKER] assertion()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 from .information import Information
 
@@ -48,12 +50,14 @@ def validate_if_statement_args(named_pin_type, variable, operator):
         raise ValueError(msg)
 
 
+@track_calls
 class Resources():
     """Resources class."""
 
+    broker = subsystem(BrokerConnect)
+    info = subsystem(Information)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.info = Information(state)
         self.state = state
 
     # TODO: mark_as()
@@ -63,7 +67,7 @@ class Resources():
     def sequence(self, sequence_name, **kwargs):
         """Executes a predefined sequence."""
         self.state.print_status(
-            description="Running {sequence_name} sequence.")
+            description=f"Running {sequence_name} sequence.")
 
         sequence = self.info.get_resource_by_name(
             endpoint="sequences",
@@ -72,10 +76,14 @@ class Resources():
         if sequence is None:
             return
 
+        self.execute(sequence["id"], **kwargs)
+
+    def execute(self, sequence_id, **kwargs):
+        """Executes a sequence by id."""
         sequence_message = {
             "kind": "execute",
             "args": {
-                "sequence_id": sequence["id"],
+                "sequence_id": sequence_id,
             }
         }
         if "cs_body" in kwargs:
@@ -199,11 +207,26 @@ class Resources():
         self.state.print_status(description="Executing if statement.")
 
         validate_if_statement_args(named_pin_type, variable, operator)
+
+        lookups = []
         if named_pin_type is not None:
             endpoint = named_pin_type.lower() + "s"
-            resource = self.info.get_resource_by_name(endpoint, variable)
-            if resource is None:
-                return
+            lookups.append((endpoint, variable, "label"))
+        sequence_names = {
+            "_then": then_sequence_name,
+            "_else": else_sequence_name,
+        }
+        sequence_keys = []
+        for key, sequence_name in sequence_names.items():
+            if sequence_name is not None:
+                lookups.append(("sequences", sequence_name, "name"))
+                sequence_keys.append(key)
+        resources = self.info.resolve_many(lookups)
+        if resources is None:
+            return
+
+        if named_pin_type is not None:
+            resource = resources.pop(0)
             variable = {
                 "kind": "named_pin",
                 "args": {
@@ -223,23 +246,11 @@ class Resources():
             }
         }
 
-        sequence_names = {
-            "_then": then_sequence_name,
-            "_else": else_sequence_name,
-        }
-        for key, sequence_name in sequence_names.items():
-            if sequence_name is not None:
-                sequence = self.info.get_resource_by_name(
-                    endpoint="sequences",
-                    resource_name=sequence_name,
-                    name_key="name")
-                if sequence is None:
-                    return
-                sequence_id = sequence["id"]
-                if_statement_message["args"][key] = {
-                    "kind": "execute",
-                    "args": {"sequence_id": sequence_id},
-                }
+        for key, sequence in zip(sequence_keys, resources):
+            if_statement_message["args"][key] = {
+                "kind": "execute",
+                "args": {"sequence_id": sequence["id"]},
+            }
 
         self.broker.publish(if_statement_message)
 
@@ -259,13 +270,11 @@ class Resources():
         }
 
         if recovery_sequence_name is not None:
-            sequence = self.info.get_resource_by_name(
-                endpoint="sequences",
-                resource_name=recovery_sequence_name,
-                name_key="name")
-            if sequence is None:
+            resources = self.info.resolve_many(
+                [("sequences", recovery_sequence_name, "name")])
+            if resources is None:
                 return
-            recovery_sequence_id = sequence["id"]
+            recovery_sequence_id = resources[0]["id"]
             assertion_message["args"]["_then"] = {
                 "kind": "execute",
                 "args": {"sequence_id": recovery_sequence_id},
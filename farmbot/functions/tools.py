@@ -9,16 +9,19 @@ ToolControls class.
 #     ├── [BROKER] water()
 #     └── [BROKER] dispense()
 
+from ..state import track_calls, subsystem
 from .broker import BrokerConnect
 from .resources import Resources
 
 
+@track_calls
 class ToolControls():
     """Tool controls class."""
 
+    broker = subsystem(BrokerConnect)
+    resource = subsystem(Resources)
+
     def __init__(self, state):
-        self.broker = BrokerConnect(state)
-        self.resource = Resources(state)
         self.state = state
 
     # TODO: verify_tool()
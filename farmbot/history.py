@@ -0,0 +1,99 @@
+"""
+StatusHistory class.
+"""
+
+import sys
+import time
+import bisect
+import threading
+
+from .diff import json_patch, apply_patch
+
+KEYFRAME_INTERVAL = 60  # entries between full copies of the status tree
+
+
+def deep_size(value, seen=None):
+    """Approximate memory used by a value and everything it contains, in bytes."""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_size(key, seen) + deep_size(item, seen)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += deep_size(item, seen)
+    return size
+
+
+class StatusHistory():
+    """Status trees stored as periodic full keyframes with JSON Patches between them."""
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be at least 1.")
+        self.keyframe_interval = keyframe_interval
+        self.lock = threading.Lock()
+        self.timestamps = []
+        self.entries = []
+        self.keyframes = []
+        self.last = None
+        self.subscription_id = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, status, timestamp=None):
+        """Add a status tree at a time in seconds since epoch (now by default).
+
+        Timestamps earlier than the last entry (i.e., after a system clock
+        change) are moved up to the last entry's time to keep them sorted.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            if len(self.timestamps) > 0:
+                timestamp = max(timestamp, self.timestamps[-1])
+            since_keyframe = len(self.entries) - (self.keyframes or [0])[-1]
+            if len(self.entries) == 0 or since_keyframe >= self.keyframe_interval:
+                self.keyframes.append(len(self.entries))
+                self.entries.append(status)
+            else:
+                self.entries.append(json_patch(self.last, status))
+            self.timestamps.append(timestamp)
+            self.last = status
+
+    def receive(self, _topic, status):
+        """Message broker subscriber adding each received status tree."""
+        self.append(status)
+
+    def at(self, timestamp):
+        """Return the status tree at a time, or None if before the first entry."""
+        with self.lock:
+            index = bisect.bisect_right(self.timestamps, timestamp) - 1
+            if index < 0:
+                return None
+            if index == len(self.entries) - 1:
+                return self.last
+            keyframe = self.keyframes[bisect.bisect_right(self.keyframes, index) - 1]
+            patches = self.entries[keyframe + 1:index + 1]
+            status = self.entries[keyframe]
+        for patch in patches:
+            status = apply_patch(status, patch)
+        return status
+
+    def memory_usage(self):
+        """Return approximate bytes used by the history and by the same number of full trees."""
+        with self.lock:
+            stored = deep_size(
+                [self.timestamps, self.entries, self.keyframes, self.last])
+            keyframes = [self.entries[index] for index in self.keyframes]
+            count = len(self.entries)
+        per_tree = sum(deep_size(tree) for tree in keyframes) / max(len(keyframes), 1)
+        return {
+            "entries": count,
+            "keyframes": len(keyframes),
+            "bytes": stored,
+            "full_snapshots_bytes": int(per_tree * count),
+        }
@@ -2,16 +2,23 @@
 Farmbot class.
 """
 
-from .state import State
+from .state import State, subsystem, DEFAULT_TIMEOUTS
+from .tracing import Tracer
+from .history import StatusHistory, KEYFRAME_INTERVAL
+from .stream import MAX_BUFFERED_MESSAGES
+from .token_store import DEFAULT_TOKEN_PATH, REFRESH_MARGIN
+from .mirror import LocalMirror, DEFAULT_MIRROR_PATH, MIRROR_ENDPOINTS
 from .functions.api import ApiConnect
 from .functions.basic_commands import BasicCommands
-from .functions.broker import BrokerConnect
+from .functions.broker import BrokerConnect, SESSION_CHANNELS
 from .functions.camera import Camera
-from .functions.information import Information
+from .functions.handles import PeripheralHandle, SensorHandle, SequenceHandle
+from .functions.information import Information, PRELOAD_ENDPOINTS
 from .functions.jobs import JobHandling
 from .functions.messages import MessageHandling
 from .functions.movements import MovementControls
 from .functions.peripherals import Peripherals
+from .functions.plans import Plan
 from .functions.resources import Resources
 from .functions.tools import ToolControls
 
@@ -22,33 +29,50 @@ class Farmbot():
     """Farmbot class."""
     __version__ = VERSION
 
+    api = subsystem(ApiConnect)
+    basic = subsystem(BasicCommands)
+    broker = subsystem(BrokerConnect)
+    camera = subsystem(Camera)
+    info = subsystem(Information)
+    jobs = subsystem(JobHandling)
+    messages = subsystem(MessageHandling)
+    movements = subsystem(MovementControls)
+    peripherals = subsystem(Peripherals)
+    resources = subsystem(Resources)
+    tools = subsystem(ToolControls)
+
     def __init__(self):
+        # Components are initialized on first use
         self.state = State()
 
-        # Initialize other components without the token initially
-        self.api = ApiConnect(self.state)
-        self.basic = BasicCommands(self.state)
-        self.broker = BrokerConnect(self.state)
-        self.camera = Camera(self.state)
-        self.info = Information(self.state)
-        self.jobs = JobHandling(self.state)
-        self.messages = MessageHandling(self.state)
-        self.movements = MovementControls(self.state)
-        self.peripherals = Peripherals(self.state)
-        self.resources = Resources(self.state)
-        self.tools = ToolControls(self.state)
-
     def set_verbosity(self, value):
         """Set output verbosity level."""
         self.state.verbosity = value
 
+    def set_output(self, output="print"):
+        """Set status output: 'print', 'logging', or an object with a write() method."""
+        self.state.set_output(output)
+
     def set_timeout(self, duration, key="listen"):
-        """Set timeout value in seconds."""
-        if key == "all":
-            for timeout_key in self.state.timeout:
+        """Set timeout value in seconds (None for the default).
+
+        Movement timeouts are estimated from the firmware settings cached
+        by `preload()` unless the 'movements' timeout is set, and other
+        command timeouts from recent round-trip times unless the 'listen'
+        timeout is set.
+        """
+        keys = list(self.state.timeout) if key == "all" else [key]
+        for timeout_key in keys:
+            if duration is None:
+                self.state.timeout[timeout_key] = DEFAULT_TIMEOUTS.get(timeout_key)
+                self.state.fixed_timeouts.discard(timeout_key)
+            else:
                 self.state.timeout[timeout_key] = duration
-        else:
-            self.state.timeout[key] = duration
+                self.state.fixed_timeouts.add(timeout_key)
+
+    def set_rate_limit(self, rate=None, burst=1):
+        """Limit outgoing commands per second (None for no limit)."""
+        self.state.outgoing.set_rate(rate, burst)
 
     def set_token(self, token):
         """Set FarmBot authorization token."""
@@ -58,12 +82,79 @@ class Farmbot():
         """Clear cached records."""
         self.state.clear_cache(endpoint)
 
+    def get_metrics(self):
+        """Return API and message broker call metrics."""
+        return self.state.metrics.snapshot()
+
+    def export_metrics(self, destination=None):
+        """Return metrics in Prometheus text format, optionally writing them to a file or handler."""
+        return self.state.metrics.export(destination)
+
+    def reset_metrics(self):
+        """Clear recorded metrics."""
+        self.state.metrics.reset()
+
+    def set_mirror(self, path=DEFAULT_MIRROR_PATH):
+        """Keep a local SQLite copy of account resources for name lookups and queries."""
+        if self.state.mirror is not None:
+            self.state.mirror.close()
+        self.state.mirror = LocalMirror(path)
+
+    def query_mirror(self, endpoint, **filters):
+        """Query local mirror records. Use (min, max) tuples for ranges."""
+        mirror = self.state.mirror
+        if mirror is None:
+            error = "ERROR: No local mirror, please call `set_mirror` first."
+            self.state.print_status(description=error)
+            self.state.error = error
+            return None
+        return mirror.query(endpoint, **filters)
+
+    def start_tracing(self, exporter=None):
+        """Record a span for each call. The exporter function receives each finished span."""
+        self.state.tracer = Tracer(exporter)
+        return self.state.tracer
+
+    def stop_tracing(self, path=None):
+        """Stop recording spans, optionally writing them to a Chrome trace-event JSON file."""
+        tracer = self.state.tracer
+        self.state.tracer = None
+        if tracer is None:
+            return []
+        if path is not None:
+            tracer.write_chrome_trace(path)
+        return tracer.spans
+
+    def start_status_history(self, keyframe_interval=KEYFRAME_INTERVAL):
+        """Subscribe to status messages and record them as keyframes and patches."""
+        self.stop_status_history()
+        history = StatusHistory(keyframe_interval)
+        history.subscription_id = self.broker.subscribe("status", history.receive)
+        self.state.status_history = history
+        return history
+
+    def stop_status_history(self):
+        """Stop recording status trees and return the history."""
+        history = self.state.status_history
+        self.state.status_history = None
+        if history is not None:
+            self.broker.unsubscribe(history.subscription_id)
+        return history
+
     # api.py
 
     def get_token(self, email, password, server="https://my.farm.bot"):
         """Get FarmBot authorization token. Server is 'https://my.farm.bot' by default."""
         return self.api.get_token(email, password, server)
 
+    def refresh_token(self):
+        """Exchange the current token for a new one before it expires."""
+        return self.api.refresh_token()
+
+    def set_token_store(self, path=DEFAULT_TOKEN_PATH, refresh_margin=REFRESH_MARGIN):
+        """Reuse tokens saved at `path` and refresh them before expiration. None disables."""
+        return self.api.set_token_store(path, refresh_margin)
+
     # basic_commands.py
 
     def wait(self, duration):
@@ -74,6 +165,10 @@ class Farmbot():
         """Emergency locks (E-stops) the Farmduino microcontroller."""
         return self.basic.e_stop()
 
+    def e_stop_now(self, timeout=None):
+        """E-stops immediately and returns a Future of the response."""
+        return self.basic.e_stop_now(timeout)
+
     def unlock(self):
         """Unlocks a locked (E-stopped) device."""
         return self.basic.unlock()
@@ -131,6 +226,47 @@ class Farmbot():
                 }},
         )
 
+    def open_control_channel(self):
+        """Connect ahead of time for low-latency `e_stop_now()`."""
+        return self.broker.open_control_channel()
+
+    def close_control_channel(self):
+        """Disconnect the control channel."""
+        return self.broker.close_control_channel()
+
+    def start_broker_session(self, channels=SESSION_CHANNELS):
+        """Keep message broker subscriptions up between commands."""
+        return self.broker.start_session(channels)
+
+    def end_broker_session(self):
+        """End the persistent message broker session."""
+        return self.broker.end_session()
+
+    def subscribe(self, channel, callback, raw=False):
+        """Call a function with each message received on a message broker channel."""
+        return self.broker.subscribe(channel, callback, raw)
+
+    def unsubscribe(self, subscription_id):
+        """Stop calling a subscribed function."""
+        return self.broker.unsubscribe(subscription_id)
+
+    def watch(self, path, callback, predicate=None):
+        """Call a function when the status tree value at a path changes."""
+        return self.broker.watch(path, callback, predicate)
+
+    def unwatch(self, watch_id):
+        """Remove a status tree watcher."""
+        return self.broker.unwatch(watch_id)
+
+    def stream(self,
+               channel="#",
+               filters=None,
+               path=None,
+               duration=None,
+               max_size=MAX_BUFFERED_MESSAGES):
+        """Iterate over message broker messages as they arrive."""
+        return self.broker.stream(channel, filters, path, duration, max_size)
+
     # camera.py
 
     def calibrate_camera(self):
@@ -141,6 +277,20 @@ class Farmbot():
         """Takes photo using the device camera and uploads it to the web app."""
         return self.camera.take_photo()
 
+    # handles.py
+
+    def peripheral(self, peripheral_name):
+        """Return a handle that finds the peripheral once and reuses its id."""
+        return PeripheralHandle(self.state, peripheral_name, parent=self)
+
+    def sensor(self, sensor_name):
+        """Return a handle that finds the sensor once and reuses its id."""
+        return SensorHandle(self.state, sensor_name, parent=self)
+
+    def sequence_handle(self, sequence_name):
+        """Return a handle that finds the sequence once and reuses its id."""
+        return SequenceHandle(self.state, sequence_name, parent=self)
+
     # information.py
 
     def api_get(self, endpoint, database_id=None, payload=None):
@@ -171,6 +321,26 @@ class Farmbot():
         """Returns the curve data."""
         return self.info.get_curve(curve_id)
 
+    def preload(self, endpoints=PRELOAD_ENDPOINTS):
+        """Download and cache commonly used endpoints concurrently."""
+        return self.info.preload(endpoints)
+
+    def sync_mirror(self, endpoints=MIRROR_ENDPOINTS):
+        """Update the local mirror with new, changed and deleted records."""
+        return self.info.sync_mirror(endpoints)
+
+    def sync_cache(self, endpoints=None):
+        """Update cached records, downloading only new and changed records."""
+        return self.info.sync_cache(endpoints)
+
+    def get_points_table(self):
+        """Returns all points as a compact, filterable PointsTable."""
+        return self.info.get_points_table()
+
+    def export(self, endpoint, path, export_format=None):
+        """Write endpoint records to a CSV, .npz or .parquet file. Format is from the extension by default."""
+        return self.info.export(endpoint, path, export_format)
+
     def measure_soil_height(self):
         """Use the camera to determine soil height at the current location."""
         return self.info.measure_soil_height()
@@ -309,6 +479,12 @@ class Farmbot():
         """Evaluates an expression."""
         return self.resources.assertion(lua_code, assertion_type, recovery_sequence_name)
 
+    # plans.py
+
+    def plan(self, name, color="gray"):
+        """Record commands sent within a `with` block as a sequence to run later."""
+        return Plan(self.state, name, color, parent=self)
+
     # tools.py
 
     def mount_tool(self, tool_name):
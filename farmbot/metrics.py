@@ -0,0 +1,131 @@
+"""
+Metrics class.
+"""
+
+import bisect
+import threading
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PROMETHEUS_PREFIX = "farmbot_"
+
+
+def label_key(labels):
+    """Hashable key for a set of labels."""
+    return tuple(sorted((labels or {}).items()))
+
+
+def format_labels(key, extra=None):
+    """Format labels in Prometheus text format."""
+    pairs = list(key) + list(extra or [])
+    if len(pairs) == 0:
+        return ""
+    label_strs = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        label_strs.append(f'{name}="{value}"')
+    return "{" + ",".join(label_strs) + "}"
+
+
+class Histogram():
+    """Bucketed distribution of observed values."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Record a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return cumulative counts for each bucket upper bound."""
+        total = 0
+        result = []
+        for bound, count in zip([*self.buckets, "+Inf"], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics():
+    """Thread-safe registry of counters and histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, labels=None, value=1):
+        """Add to a counter."""
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """Record a value in a histogram."""
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def reset(self):
+        """Remove all recorded values."""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """Return recorded values as a dictionary."""
+        with self.lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value}
+                       for key, value in series.items()]
+                for name, series in self.counters.items()}
+            histograms = {
+                name: [{
+                    "labels": dict(key),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative()),
+                } for key, histogram in series.items()]
+                for name, series in self.histograms.items()}
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self):
+        """Return recorded values in Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in series.items():
+                    lines.append(f"{metric}{format_labels(key)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                for key, histogram in series.items():
+                    for bound, count in histogram.cumulative():
+                        labels = format_labels(key, [("le", bound)])
+                        lines.append(f"{metric}_bucket{labels} {count}")
+                    labels = format_labels(key)
+                    lines.append(f"{metric}_sum{labels} {histogram.sum}")
+                    lines.append(f"{metric}_count{labels} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, destination=None):
+        """Export Prometheus text to a file path or a handler function."""
+        text = self.to_prometheus()
+        if callable(destination):
+            destination(text)
+        elif destination is not None:
+            with open(destination, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(text)
+        return text
@@ -0,0 +1,170 @@
+"""
+LocalMirror class.
+"""
+
+import os
+import threading
+from datetime import datetime
+
+from . import codec
+
+DEFAULT_MIRROR_PATH = os.path.join(os.path.expanduser("~"), ".farmbot", "mirror.sqlite3")
+MIRROR_ENDPOINTS = (
+    "points",
+    "plants",
+    "tools",
+    "sequences",
+    "sensors",
+    "peripherals",
+    "sensor_readings",
+    "images",
+)
+# record keys stored in indexed columns
+COLUMNS = ("id", "name", "pointer_type", "tool_id", "x", "y", "z")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    endpoint TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT,
+    pointer_type TEXT,
+    tool_id INTEGER,
+    x REAL,
+    y REAL,
+    z REAL,
+    updated_at TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (endpoint, id)
+);
+CREATE INDEX IF NOT EXISTS records_name ON records (endpoint, name);
+CREATE INDEX IF NOT EXISTS records_pointer_type ON records (endpoint, pointer_type);
+CREATE INDEX IF NOT EXISTS records_tool_id ON records (endpoint, tool_id);
+CREATE INDEX IF NOT EXISTS records_xyz ON records (endpoint, x, y, z);
+CREATE TABLE IF NOT EXISTS synced (
+    endpoint TEXT PRIMARY KEY,
+    synced_at TEXT
+);
+"""
+
+
+def record_row(endpoint, record):
+    """Row values for a record."""
+    name = record.get("name", record.get("label"))
+    return (
+        endpoint,
+        record["id"],
+        name,
+        record.get("pointer_type"),
+        record.get("tool_id"),
+        record.get("x"),
+        record.get("y"),
+        record.get("z"),
+        record.get("updated_at"),
+        codec.dumps(record),
+    )
+
+
+def matches(record, filters):
+    """Check if a record matches all filters. Tuple values are (min, max) ranges."""
+    for key, value in filters.items():
+        field = record.get(key)
+        if isinstance(value, tuple):
+            if field is None or not value[0] <= field <= value[1]:
+                return False
+        elif field != value:
+            return False
+    return True
+
+
+class LocalMirror():
+    """SQLite copy of account resources, kept up to date by `updated_at`."""
+
+    def __init__(self, path=DEFAULT_MIRROR_PATH):
+        import sqlite3
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.connection.close()
+
+    def has(self, endpoint):
+        """Check if an endpoint has been synced."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM synced WHERE endpoint = ?", (endpoint,)).fetchone()
+        return row is not None
+
+    def versions(self, endpoint):
+        """Id and `updated_at` of each stored record."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, updated_at FROM records WHERE endpoint = ?",
+                (endpoint,)).fetchall()
+        return [{"id": record_id, "updated_at": updated_at}
+                for record_id, updated_at in rows]
+
+    def _store(self, endpoint, rows, removed, synced_at):
+        """Write rows and delete removed ids. The caller holds the lock."""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+        self.connection.executemany(
+            "DELETE FROM records WHERE endpoint = ? AND id = ?",
+            [(endpoint, record_id) for record_id in removed])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO synced VALUES (?, ?)",
+            (endpoint, synced_at or datetime.now().isoformat()))
+
+    def sync(self, endpoint, records, synced_at=None):
+        """Store new and changed records and remove deleted ones."""
+        with self.lock, self.connection:
+            stored = dict(self.connection.execute(
+                "SELECT id, updated_at FROM records WHERE endpoint = ?",
+                (endpoint,)))
+            changed = [
+                record_row(endpoint, record) for record in records
+                if record["id"] not in stored
+                or record.get("updated_at") is None
+                or stored[record["id"]] != record.get("updated_at")]
+            removed = stored.keys() - {record["id"] for record in records}
+            self._store(endpoint, changed, removed, synced_at)
+        return {"updated": len(changed), "removed": len(removed)}
+
+    def update(self, endpoint, records, removed=(), synced_at=None):
+        """Store the given changed records and remove the given deleted ids."""
+        with self.lock, self.connection:
+            self._store(
+                endpoint, [record_row(endpoint, record) for record in records],
+                removed, synced_at)
+        return {"updated": len(records), "removed": len(removed)}
+
+    def query(self, endpoint, **filters):
+        """Return records matching all filters, using indexes where possible.
+
+        Tuple values are (min, max) ranges, e.g., `query("points", x=(0, 100))`.
+        """
+        clauses = ["endpoint = ?"]
+        params = [endpoint]
+        for key, value in filters.items():
+            column = "name" if key == "label" else key
+            if column not in COLUMNS:
+                continue
+            if isinstance(value, tuple):
+                clauses.append(f"{column} BETWEEN ? AND ?")
+                params.extend(value)
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        sql = f"SELECT data FROM records WHERE {' AND '.join(clauses)} ORDER BY id"
+        with self.lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        records = [codec.loads(data) for (data,) in rows]
+        return [record for record in records if matches(record, filters)]
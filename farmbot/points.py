@@ -0,0 +1,129 @@
+"""
+PointsTable class.
+"""
+
+import sys
+import math
+from array import array
+
+from . import codec
+
+NUMBER_COLUMNS = ("x", "y", "z", "radius")
+STRING_COLUMNS = ("name", "pointer_type", "plant_stage", "openfarm_slug")
+MISSING = -1
+
+
+class StringColumn():
+    """Column of repeated strings stored as codes into a table of unique values."""
+
+    def __init__(self):
+        self.values = []
+        self.lookup = {}
+        self.codes = array("i")
+
+    def code(self, value):
+        """Code for a value, adding it to the table if new."""
+        if value not in self.lookup:
+            if isinstance(value, str):
+                value = sys.intern(value)
+            self.lookup[value] = len(self.values)
+            self.values.append(value)
+        return self.lookup[value]
+
+    def append(self, record, key):
+        """Add the value of a record key."""
+        self.codes.append(self.code(record[key]) if key in record else MISSING)
+
+    def get(self, index):
+        """Return (present, value) for a row."""
+        code = self.codes[index]
+        if code == MISSING:
+            return False, None
+        return True, self.values[code]
+
+
+class PointsTable():
+    """Compact, column-oriented points.
+
+    Ids and coordinates are stored in typed arrays and repeated strings once.
+    Remaining keys (e.g., `meta`) are kept as compact JSON text.
+    """
+
+    def __init__(self, points=()):
+        self.ids = array("q")
+        self.numbers = {key: array("d") for key in NUMBER_COLUMNS}
+        self.strings = {key: StringColumn() for key in STRING_COLUMNS}
+        self.extras = StringColumn()
+        for point in points:
+            self.append(point)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.to_dict(index)
+
+    def __getitem__(self, index):
+        return self.to_dict(index)
+
+    def append(self, point):
+        """Add a point."""
+        self.ids.append(point["id"])
+        for key, column in self.numbers.items():
+            value = point.get(key)
+            column.append(math.nan if value is None else value)
+        for key, column in self.strings.items():
+            column.append(point, key)
+        extras = {key: value for key, value in point.items()
+                  if key != "id" and key not in self.numbers and key not in self.strings}
+        text = codec.dumps(extras)
+        self.extras.codes.append(self.extras.code(text))
+
+    def column(self, key):
+        """Return a column as a list of values."""
+        if key == "id":
+            return list(self.ids)
+        if key in self.numbers:
+            return [None if math.isnan(value) else value for value in self.numbers[key]]
+        if key in self.strings:
+            return [self.strings[key].get(index)[1] for index in range(len(self))]
+        return [self.to_dict(index).get(key) for index in range(len(self))]
+
+    def rows(self, **criteria):
+        """Indexes of points with matching string column values."""
+        indexes = range(len(self))
+        for key, value in criteria.items():
+            if key not in self.strings:
+                raise ValueError(
+                    f"Invalid filter: {key} not in {list(STRING_COLUMNS)}")
+            column = self.strings[key]
+            code = column.lookup.get(value)
+            if code is None:
+                return []
+            indexes = [index for index in indexes if column.codes[index] == code]
+        return list(indexes)
+
+    def filter(self, **criteria):
+        """Return a table of points matching all criteria, e.g., `pointer_type="Plant"`."""
+        table = PointsTable()
+        for index in self.rows(**criteria):
+            table.append(self.to_dict(index))
+        return table
+
+    def to_dict(self, index):
+        """Return a point as a dictionary."""
+        point = {"id": self.ids[index]}
+        for key, column in self.numbers.items():
+            value = column[index]
+            point[key] = None if math.isnan(value) else value
+        for key, column in self.strings.items():
+            present, value = column.get(index)
+            if present:
+                point[key] = value
+        point.update(codec.loads(self.extras.get(index)[1]))
+        return point
+
+    def to_dicts(self):
+        """Return all points as dictionaries."""
+        return list(self)
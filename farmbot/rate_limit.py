@@ -0,0 +1,71 @@
+"""
+OutgoingQueue class.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+
+class OutgoingQueue():
+    """Token bucket rate limit for outgoing messages, served highest priority first.
+
+    With no rate set, messages are sent immediately. Otherwise up to `burst`
+    messages can be sent at once, refilled at `rate` messages per second.
+    Waiting senders take turns by priority, then in arrival order.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.rate = None
+        self.burst = 1
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate=None, burst=1):
+        """Set messages per second (None for no limit) and the largest burst."""
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive.")
+        if burst < 1:
+            raise ValueError("burst must be at least 1.")
+        with self.condition:
+            self.rate = rate
+            self.burst = burst
+            self.tokens = burst
+            self.updated = time.monotonic()
+            self.condition.notify_all()
+
+    def refill(self, now):
+        """Add tokens for the time since the last refill."""
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=0):
+        """Wait for a turn to send. Returns the seconds waited."""
+        with self.condition:
+            if self.rate is None and len(self.waiting) == 0:
+                return 0.0
+            start = time.monotonic()
+            entry = (-priority, next(self.sequence))
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    self.refill(time.monotonic())
+                    first = self.waiting[0] == entry
+                    if first and self.rate is None:
+                        break
+                    if first and self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    timeout = (1 - self.tokens) / self.rate if first else None
+                    self.condition.wait(timeout)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+            return time.monotonic() - start
@@ -1,22 +1,105 @@
 """State management."""
 
-import json
-import inspect
+import types
+import functools
+import threading
+import contextvars
 from datetime import datetime
 
+from . import codec
+from .metrics import Metrics
+from .rate_limit import OutgoingQueue
+from .timeouts import RoundTripTimes, KnownPosition
 
-def get_call_stack_depth():
-    """Return the depth of the current call stack."""
-    depth = 0
-    frame = inspect.currentframe()
-    while frame:
-        depth += 1
-        frame = frame.f_back
-    return depth
+DEFAULT_TIMEOUTS = {
+    "api": 15,
+    "listen": 15,
+    "movements": 120,
+}
+CALL_DEPTH = contextvars.ContextVar("farmbot_call_depth", default=0)
+CURRENT_CALL = contextvars.ContextVar("farmbot_current_call", default=None)
+
+
+def tracked(func):
+    """Record call nesting depth and arguments for status output and tracing."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        depth_token = CALL_DEPTH.set(CALL_DEPTH.get() + 1)
+        call_token = CURRENT_CALL.set((func, (self, *args), kwargs))
+        try:
+            tracer = self.state.tracer
+            if tracer is None:
+                return func(self, *args, **kwargs)
+            name = f"{type(self).__name__}.{func.__name__}"
+            return tracer.trace(name, func, self, *args, **kwargs)
+        finally:
+            CURRENT_CALL.reset(call_token)
+            CALL_DEPTH.reset(depth_token)
+    return wrapper
+
+
+def untracked(func):
+    """Exclude a public helper method from `track_calls`."""
+    func.untracked = True
+    return func
+
+
+def track_calls(cls):
+    """Class decorator applying `tracked` to all public methods except helpers."""
+    for name, attribute in list(vars(cls).items()):
+        if (not name.startswith("_")
+                and isinstance(attribute, types.FunctionType)
+                and not getattr(attribute, "untracked", False)):
+            setattr(cls, name, tracked(attribute))
+    return cls
+
+
+class subsystem():
+    """Subsystem attribute constructed with the shared state on first use.
+
+    Objects with a `parent` (i.e., handles created by a Farmbot) use the
+    parent's subsystem of the same name instead of constructing their own,
+    so they share its message broker connection.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        parent = getattr(instance, "parent", None)
+        if parent is not None:
+            return getattr(parent, self.name)
+        with instance.state.lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.factory(instance.state)
+        return instance.__dict__[self.name]
+
+
+def format_call(func, args, kwargs):
+    """Return the name and given arguments of a call."""
+    import inspect
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arg_strings = []
+    for arg, value in bound.arguments.items():
+        if arg != "self":
+            arg_strings.append(f"{arg}={repr(value)}")
+    arg_str = ", ".join(arg_strings)
+    return f"{func.__name__}({arg_str})"
 
 
 def get_function_call_info():
     """Return the name and given arguments of the function where this is called."""
+    import inspect
+    current_call = CURRENT_CALL.get()
+    if current_call is not None:
+        return format_call(*current_call)
     # back to print_status then back to the function that called print_status
     frame = inspect.currentframe().f_back.f_back
     func_name = frame.f_code.co_name
@@ -29,6 +112,50 @@ def get_function_call_info():
     return f"{func_name}({arg_str})"
 
 
+def response_label(message):
+    """Return the label of an RPC response message, if any."""
+    content = message.get("content")
+    if not isinstance(content, dict):
+        return None
+    args = content.get("args")
+    if not isinstance(args, dict):
+        return None
+    return args.get("label")
+
+
+class PrintOutput():
+    """Write status output to stdout."""
+
+    @staticmethod
+    def enabled():
+        """Output is always written."""
+        return True
+
+    @staticmethod
+    def write(text, end="\n"):
+        """Write text."""
+        print(text, end=end, flush=end == "")
+
+
+class LoggingOutput():
+    """Write status output to a `logging` logger."""
+
+    def __init__(self, logger=None, level=None):
+        import logging
+        self.logger = logger or logging.getLogger("farmbot")
+        self.level = logging.INFO if level is None else level
+
+    def enabled(self):
+        """Check if the logger handles records at the output level."""
+        return self.logger.isEnabledFor(self.level)
+
+    def write(self, text, end="\n"):
+        """Log text, skipping blank lines and progress indicators."""
+        if end == "" or text.strip() == "":
+            return
+        self.logger.log(self.level, "%s", text)
+
+
 NO_TOKEN_ERROR = """
 ERROR: You have no token, please call `get_token`
 using your login credentials and the server you wish to connect to.
@@ -41,46 +168,104 @@ class State():
     NO_TOKEN_ERROR = NO_TOKEN_ERROR.replace("\n", "")
 
     def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
         self.token = None
         self.error = None
         self.last_messages = {}
+        self.pending_labels = set()
         self.last_published = {}
         self.verbosity = 1
         self.json_printing = True
-        self.timeout = {
-            "api": 15,
-            "listen": 15,
-            "movements": 120,
-        }
+        self.timeout = dict(DEFAULT_TIMEOUTS)
+        self.fixed_timeouts = set()
         self.test_env = False
         self.ssl = True
-        self.min_call_stack_depth = 100
+        self.output = PrintOutput()
         self.dry_run = False
         self.resource_cache = {}
+        self.stale_cache = {}
+        self.metrics = Metrics()
+        self.tracer = None
+        self.token_store = None
+        self.token_source = None
+        self.token_refresh_timer = None
+        self.plan_ids = {}
+        self.session = None
+        self.mirror = None
+        self.status_history = None
+        self.broker_session = None
+        self.outgoing = OutgoingQueue()
+        self.control_channel = None
+        self.round_trips = RoundTripTimes()
+        self.known_position = KnownPosition()
+
+    @property
+    def error(self):
+        """Error from the last call made by the current thread."""
+        return getattr(self.local, "error", None)
+
+    @error.setter
+    def error(self, value):
+        self.local.error = value
+
+    @property
+    def last_published(self):
+        """Message last published by the current thread."""
+        return getattr(self.local, "last_published", {})
+
+    @last_published.setter
+    def last_published(self, value):
+        self.local.last_published = value
+
+    @property
+    def recording(self):
+        """Plan steps list the current thread is recording commands into."""
+        return getattr(self.local, "recording", None)
+
+    @recording.setter
+    def recording(self, value):
+        self.local.recording = value
+
+    def set_output(self, output):
+        """Set status output: 'print', 'logging', or an object with write()."""
+        if output == "print":
+            output = PrintOutput()
+        elif output == "logging":
+            output = LoggingOutput()
+        elif not hasattr(output, "write"):
+            raise ValueError(
+                f"Invalid output: {output} not in ['print', 'logging']")
+        self.output = output
+
+    def printing(self):
+        """Check if status output is shown, e.g., before building descriptions."""
+        if self.verbosity < 1:
+            return False
+        return not hasattr(self.output, "enabled") or self.output.enabled()
 
     def print_status(self, endpoint_json=None, description=None, update_only=False, end="\n"):
         """Handle changes to output based on user-defined verbosity."""
-        depth = get_call_stack_depth()
-        if depth < self.min_call_stack_depth:
-            self.min_call_stack_depth = depth
-        top = depth == self.min_call_stack_depth
+        if not self.printing():
+            return
+        output = self.output
+        top = CALL_DEPTH.get() <= 1
         no_end = end == "" and description != ""
         indent = "" if (top or no_end) else " " * 4
 
         if self.verbosity >= 2 and not update_only:
             if top:
-                print()
+                output.write("")
             function = get_function_call_info()
-            print(f"{indent}`{function}` called at {datetime.now()}")
-        if self.verbosity >= 1:
-            if self.verbosity == 1 and not update_only and top:
-                print()
-            if description is not None:
-                print(indent + description, end=end, flush=end == "")
-            if endpoint_json is not None and self.json_printing:
-                json_str = json.dumps(endpoint_json, indent=4)
-                indented_str = indent + json_str.replace("\n", "\n" + indent)
-                print(indented_str)
+            output.write(f"{indent}`{function}` called at {datetime.now()}")
+        if self.verbosity == 1 and not update_only and top:
+            output.write("")
+        if description is not None:
+            output.write(indent + description, end=end)
+        if endpoint_json is not None and self.json_printing:
+            json_str = codec.dumps(endpoint_json, indent=4)
+            indented_str = indent + json_str.replace("\n", "\n" + indent)
+            output.write(indented_str)
 
     def check_token(self):
         """Check if a token is present."""
@@ -89,17 +274,57 @@ class State():
             self.error = self.NO_TOKEN_ERROR
             raise ValueError(self.NO_TOKEN_ERROR)
 
+    def add_message(self, key, message):
+        """Add a received message."""
+        with self.lock:
+            self.last_messages.setdefault(key, []).append(message)
+
+    def get_response(self, label):
+        """Return the RPC response with the given label, leaving it in `last_messages`.
+
+        Other responses no caller is still waiting for are dropped, so
+        `last_messages["from_device"]` ends with the response to the
+        caller's command instead of growing with every command.
+        """
+        with self.lock:
+            responses = self.last_messages.get("from_device", [])
+            response = None
+            for message in reversed(responses):
+                if response_label(message) == label:
+                    response = message
+                    break
+            self.last_messages["from_device"] = [
+                message for message in responses
+                if message is response
+                or response_label(message) in self.pending_labels - {label}]
+        return response
+
     def save_cache(self, endpoint, records):
         """Cache records."""
-        self.resource_cache[endpoint] = records
+        with self.lock:
+            self.resource_cache[endpoint] = records
+            self.stale_cache.pop(endpoint, None)
+
+    def fetch_cache(self, endpoint, stale=False):
+        """Fetch cached records, including cleared records if `stale`."""
+        with self.lock:
+            records = self.resource_cache.get(endpoint)
+            if records is None and stale:
+                records = self.stale_cache.get(endpoint)
+            return records
 
-    def fetch_cache(self, endpoint):
-        """Fetch cached records."""
-        return self.resource_cache.get(endpoint)
+    def expire_cache(self, endpoint):
+        """Move cached records aside to be updated by the next sync."""
+        with self.lock:
+            if endpoint in self.resource_cache:
+                self.stale_cache[endpoint] = self.resource_cache.pop(endpoint)
 
     def clear_cache(self, endpoint=None):
         """Clear the cache."""
-        if endpoint is not None and endpoint in self.resource_cache:
-            del self.resource_cache[endpoint]
-        else:
-            self.resource_cache = {}
+        with self.lock:
+            if endpoint is not None and endpoint in self.resource_cache:
+                del self.resource_cache[endpoint]
+                self.stale_cache.pop(endpoint, None)
+            else:
+                self.resource_cache = {}
+                self.stale_cache = {}
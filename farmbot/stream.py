@@ -0,0 +1,103 @@
+"""
+MessageStream class.
+"""
+
+import time
+import queue
+import threading
+
+MAX_BUFFERED_MESSAGES = 100
+POLL_SECONDS = 0.1  # how often waiting readers check if the stream was closed
+
+
+class MessageStream():
+    """Iterator (and async iterator) over broker messages as they arrive.
+
+    Matching messages wait in a bounded buffer. When it is full, new
+    messages are dropped (and counted in `broker_stream_dropped_total`)
+    so the shared broker callback never waits on a slow consumer.
+    Leaving a `for` loop, reaching `duration`, or calling `close()`
+    ends the subscription.
+    """
+
+    def __init__(self, broker, channel="#", filters=None, path=None,
+                 duration=None, max_size=MAX_BUFFERED_MESSAGES):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1.")
+        self.broker = broker
+        self.filters = {"topic": "", "content": {}, **(filters or {})}
+        self.keys = [key for key in (path or "").split(".") if key != ""]
+        self.deadline = None if duration is None else time.monotonic() + duration
+        self.buffer = queue.Queue(maxsize=max_size)
+        self.closed = threading.Event()
+        self.subscription_id = broker.subscribe(channel, self.put)
+
+    def put(self, topic, payload):
+        """Add a received message to the buffer, or drop it if the buffer is full."""
+        if not self.broker.match({"topic": topic, "content": payload}, self.filters):
+            return
+        for key in self.keys:
+            if not isinstance(payload, dict) or key not in payload:
+                return
+            payload = payload[key]
+        if self.closed.is_set():
+            return
+        try:
+            self.buffer.put_nowait({"topic": topic, "content": payload})
+        except queue.Full:
+            self.broker.state.metrics.increment(
+                "broker_stream_dropped_total", {"channel": topic.split("/")[2]})
+
+    def get(self, timeout=None):
+        """Return the next message, or None if the stream ended or timed out."""
+        wait_until = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.closed.is_set() and self.buffer.empty():
+                return None
+            now = time.monotonic()
+            if self.deadline is not None and now >= self.deadline:
+                self.close()
+                continue
+            limits = [POLL_SECONDS]
+            limits += [limit - now for limit in [self.deadline, wait_until]
+                       if limit is not None]
+            try:
+                return self.buffer.get(timeout=max(min(limits), 0))
+            except queue.Empty:
+                if wait_until is not None and time.monotonic() >= wait_until:
+                    return None
+
+    def close(self):
+        """End the subscription. Buffered messages can still be read."""
+        if not self.closed.is_set():
+            self.closed.set()
+            self.broker.unsubscribe(self.subscription_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exception):
+        self.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                message = self.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                message = await loop.run_in_executor(None, self.get, POLL_SECONDS)
+                if message is not None:
+                    yield message
+                elif self.closed.is_set() and self.buffer.empty():
+                    return
+        finally:
+            self.close()
@@ -0,0 +1,250 @@
+"""
+Adaptive command timeouts.
+"""
+
+import math
+import threading
+from collections import deque
+
+MOVEMENT_KINDS = ["move", "find_home", "calibrate"]
+MOVEMENT_MARGIN = 1.5  # multiple of the estimated movement time
+MOVEMENT_SLACK = 2  # seconds for starting, stopping, and reporting
+RTT_SAMPLES = 100  # recent round-trip times kept per command kind
+RTT_MIN_SAMPLES = 20  # round-trip times needed before they are used
+RTT_MARGIN = 3  # multiple of the 99th percentile round-trip time
+RTT_FLOOR = 1  # shortest round-trip based timeout, in seconds
+AXES = ["x", "y", "z"]
+# Commands taking as long as their arguments say, so round-trip times don't apply
+VARIABLE_KINDS = ["wait", "execute", "execute_script", "lua"]
+
+
+class RoundTripTimes():
+    """Recent command round-trip times with percentiles by command kind."""
+
+    def __init__(self, samples=RTT_SAMPLES):
+        self.lock = threading.Lock()
+        self.samples = samples
+        self.times = {}
+
+    def add(self, kind, seconds):
+        """Record a round-trip time."""
+        with self.lock:
+            if kind not in self.times:
+                self.times[kind] = deque(maxlen=self.samples)
+            self.times[kind].append(seconds)
+
+    def percentile(self, percent, kind=None):
+        """Round-trip time percentile for a kind (or all kinds), or None if too few samples."""
+        with self.lock:
+            if kind is None:
+                times = [seconds for series in self.times.values() for seconds in series]
+            else:
+                times = list(self.times.get(kind, []))
+        if len(times) < RTT_MIN_SAMPLES:
+            return None
+        times.sort()
+        return times[min(math.ceil(len(times) * percent / 100) - 1, len(times) - 1)]
+
+
+class KnownPosition():
+    """Device position for estimating movement distances.
+
+    Reported positions are only taken while no movement is in progress,
+    so statuses from before (or during) a movement don't count as its
+    result. Sending a movement sets its target as the position; axes
+    moved to an unknown place are None until the next reported position.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.axes = {axis: None for axis in AXES}
+        self.moving = 0
+
+    def get(self):
+        """Position by axis (None for unknown axes)."""
+        with self.lock:
+            return dict(self.axes)
+
+    def reported(self, status):
+        """Take the position from a received status."""
+        if not isinstance(status, dict):
+            return
+        position = (status.get("location_data") or {}).get("position")
+        if not isinstance(position, dict):
+            return
+        with self.lock:
+            if self.moving == 0:
+                self.axes = {axis: position.get(axis) for axis in AXES}
+
+    def commanded(self, message):
+        """Start a movement, setting the position to its target."""
+        with self.lock:
+            self.moving += 1
+            if message["kind"] != "move":
+                # Homing and calibration finish at home
+                axis = message["args"].get("axis", "all")
+                for axis_name in AXES if axis == "all" else [axis]:
+                    self.axes[axis_name] = 0
+                return
+            targets = {}
+            for item in message.get("body", []):
+                args = item.get("args", {})
+                if item["kind"] == "axis_overwrite":
+                    operand = args.get("axis_operand", {})
+                    targets[args["axis"]] = None
+                    if operand.get("kind") == "numeric":
+                        targets[args["axis"]] = operand["args"]["number"]
+                elif item["kind"] == "safe_z":
+                    # Ends at safe height unless z is also a target
+                    self.axes["z"] = None
+            self.axes.update(targets)
+
+    def finished(self, completed):
+        """End a movement. The position is unknown if it didn't complete."""
+        with self.lock:
+            self.moving = max(self.moving - 1, 0)
+            if not completed:
+                self.axes = {axis: None for axis in AXES}
+
+
+def axis_seconds(distance, max_speed, min_speed, acceleration_distance):
+    """Seconds to move a distance with a trapezoidal speed profile.
+
+    Speeds are in mm/s. Speed changes linearly from `min_speed` to
+    `max_speed` over `acceleration_distance` mm, and back when stopping.
+    """
+    if distance <= 0:
+        return 0
+    min_speed = min(min_speed, max_speed)
+    if acceleration_distance <= 0 or min_speed == max_speed:
+        return distance / max_speed
+    acceleration = (max_speed ** 2 - min_speed ** 2) / (2 * acceleration_distance)
+    if distance < 2 * acceleration_distance:
+        peak_speed = math.sqrt(min_speed ** 2 + acceleration * distance)
+        return 2 * (peak_speed - min_speed) / acceleration
+    cruise_distance = distance - 2 * acceleration_distance
+    return 2 * (max_speed - min_speed) / acceleration + cruise_distance / max_speed
+
+
+def axis_motion(firmware_config, axis, speed_key="movement_max_spd"):
+    """Axis length and motion limits in mm and mm/s, or None if not configured."""
+    try:
+        steps_per_mm = firmware_config[f"movement_step_per_mm_{axis}"]
+        max_speed = firmware_config[f"{speed_key}_{axis}"] / steps_per_mm
+        min_speed = firmware_config.get(f"movement_min_spd_{axis}", 0) / steps_per_mm
+        acceleration = firmware_config.get(f"movement_steps_acc_dec_{axis}", 0) / steps_per_mm
+        length = firmware_config[f"movement_axis_nr_steps_{axis}"] / steps_per_mm
+    except (KeyError, TypeError, ZeroDivisionError):
+        return None
+    if max_speed <= 0 or length <= 0:
+        return None
+    return {
+        "length": length,
+        "max_speed": max_speed,
+        "min_speed": max(min_speed, 0),
+        "acceleration_distance": acceleration,
+    }
+
+
+def move_seconds(message, firmware_config, position=None):
+    """Estimated seconds for a `move` command, or None if unknown."""
+    targets = {}
+    speeds = {}
+    safe_z = False
+    safe_z_seconds = 0
+    for item in message.get("body", []):
+        args = item.get("args", {})
+        if item["kind"] == "axis_overwrite":
+            operand = args.get("axis_operand", {})
+            targets[args["axis"]] = None
+            if operand.get("kind") == "numeric":
+                targets[args["axis"]] = operand["args"]["number"]
+        elif item["kind"] == "speed_overwrite":
+            speeds[args["axis"]] = args["speed_setting"]["args"]["number"]
+        elif item["kind"] == "safe_z":
+            safe_z = True
+
+    seconds = [0]
+    for axis in AXES:
+        if axis not in targets and not (axis == "z" and safe_z):
+            continue
+        motion = axis_motion(firmware_config, axis)
+        if motion is None:
+            return None
+        scale = speeds.get(axis, 100) / 100
+        max_speed = motion["max_speed"] * scale
+        if axis == "z" and safe_z:
+            # Up to safe height before moving x and y, then down
+            safe_z_seconds = 2 * axis_seconds(
+                motion["length"], max_speed,
+                motion["min_speed"], motion["acceleration_distance"])
+        if axis not in targets:
+            continue
+        distance = motion["length"]
+        current = (position or {}).get(axis)
+        if targets[axis] is not None and current is not None:
+            distance = min(abs(targets[axis] - current), motion["length"])
+        seconds.append(axis_seconds(
+            distance, max_speed,
+            motion["min_speed"], motion["acceleration_distance"]))
+    # Axes move at the same time
+    return max(seconds) + safe_z_seconds
+
+
+def homing_seconds(message, firmware_config):
+    """Estimated seconds for a `find_home` or `calibrate` command, or None if unknown."""
+    axis = message["args"].get("axis", "all")
+    axes = AXES if axis == "all" else [axis]
+    # Calibration finds the far end, then returns home
+    trips = 2 if message["kind"] == "calibrate" else 1
+    scale = message["args"].get("speed", 100) / 100
+    seconds = 0
+    for axis_name in axes:
+        speed_key = "movement_home_spd"
+        if f"{speed_key}_{axis_name}" not in (firmware_config or {}):
+            speed_key = "movement_max_spd"
+        motion = axis_motion(firmware_config, axis_name, speed_key)
+        if motion is None:
+            return None
+        # Axes are homed one at a time
+        seconds += trips * axis_seconds(
+            motion["length"], motion["max_speed"] * scale,
+            motion["min_speed"], motion["acceleration_distance"])
+    return seconds
+
+
+def movement_seconds(message, firmware_config, position=None):
+    """Estimated seconds for a movement command, or None if unknown."""
+    if firmware_config is None or not isinstance(firmware_config, dict):
+        return None
+    if message["kind"] == "move":
+        return move_seconds(message, firmware_config, position)
+    return homing_seconds(message, firmware_config)
+
+
+def command_timeout(message, timeouts, round_trips, firmware_config=None, position=None,
+                    fixed=()):
+    """Seconds to wait for a command's response.
+
+    Movements wait for the estimated movement time (from the firmware
+    speed and acceleration settings) plus margins, falling back to
+    `timeouts["movements"]`. Other commands wait for a multiple of their
+    recent 99th percentile round-trip time, up to `timeouts["listen"]`.
+    Timeouts with keys in `fixed` were set explicitly and are used as given.
+    """
+    kind = message.get("kind")
+    if kind in VARIABLE_KINDS:
+        return timeouts["listen"]
+    if kind in MOVEMENT_KINDS and "movements" in fixed:
+        return timeouts["movements"]
+    if kind not in MOVEMENT_KINDS and "listen" in fixed:
+        return timeouts["listen"]
+    rtt = round_trips.percentile(99, kind if kind not in MOVEMENT_KINDS else None)
+    if kind in MOVEMENT_KINDS:
+        estimate = movement_seconds(message, firmware_config, position)
+        if estimate is None:
+            return timeouts["movements"]
+        return round(estimate * MOVEMENT_MARGIN + MOVEMENT_SLACK + (rtt or 0), 1)
+    if rtt is None:
+        return timeouts["listen"]
+    return min(timeouts["listen"], round(max(rtt * RTT_MARGIN, RTT_FLOOR), 1))
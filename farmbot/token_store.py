@@ -0,0 +1,120 @@
+"""
+TokenStore class.
+"""
+
+import os
+import json
+import time
+import tempfile
+import contextlib
+
+DEFAULT_TOKEN_PATH = os.path.join(os.path.expanduser("~"), ".farmbot", "token.json")
+REFRESH_MARGIN = 60 * 60  # seconds before expiration to refresh a token
+
+
+def token_expiration(token):
+    """Return the expiration time (seconds since epoch) of a token, if known."""
+    try:
+        return token["token"]["unencoded"]["exp"]
+    except (KeyError, TypeError):
+        return None
+
+
+def seconds_until_refresh(token, refresh_margin=REFRESH_MARGIN):
+    """Return the number of seconds until a token should be refreshed."""
+    expiration = token_expiration(token)
+    if expiration is None:
+        return None
+    return expiration - refresh_margin - time.time()
+
+
+class TokenStore():
+    """File-based token store, readable only by the current user."""
+
+    def __init__(self, path=DEFAULT_TOKEN_PATH, refresh_margin=REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = refresh_margin
+
+    @staticmethod
+    def key(server, email):
+        """Key for a token in the store."""
+        return f"{email} {server}"
+
+    def read(self):
+        """Read all stored tokens."""
+        try:
+            with open(self.path, encoding="utf-8") as token_file:
+                tokens = json.load(token_file)
+        except (OSError, ValueError):
+            return {}
+        return tokens if isinstance(tokens, dict) else {}
+
+    def make_directory(self):
+        """Create the store directory, readable only by the current user."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        return directory or "."
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold an exclusive lock on the store across processes."""
+        self.make_directory()
+        flags = os.O_RDWR | os.O_CREAT
+        file_descriptor = os.open(f"{self.path}.lock", flags, 0o600)
+        try:
+            try:
+                import fcntl
+            except ImportError:
+                import msvcrt
+                # Retries for up to 10 seconds before raising OSError
+                msvcrt.locking(file_descriptor, msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    msvcrt.locking(file_descriptor, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+        finally:
+            os.close(file_descriptor)
+
+    def write(self, tokens):
+        """Write all tokens, replacing the file atomically."""
+        directory = self.make_directory()
+        # Each writer uses its own temporary file (created with mode 0o600)
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=directory, prefix=".token-", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as token_file:
+                json.dump(tokens, token_file)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+    def load(self, server, email):
+        """Return a stored token that is not about to expire, or None."""
+        token = self.read().get(self.key(server, email))
+        remaining = seconds_until_refresh(token, self.refresh_margin)
+        if remaining is None or remaining <= 0:
+            return None
+        return token
+
+    def save(self, server, email, token):
+        """Store a token."""
+        with self.locked():
+            tokens = self.read()
+            tokens[self.key(server, email)] = token
+            self.write(tokens)
+
+    def remove(self, server, email):
+        """Remove a stored token."""
+        with self.locked():
+            tokens = self.read()
+            if tokens.pop(self.key(server, email), None) is not None:
+                self.write(tokens)
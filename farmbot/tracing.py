@@ -0,0 +1,109 @@
+"""
+Tracer class.
+"""
+
+import os
+import json
+import time
+import itertools
+import threading
+import contextvars
+
+CURRENT_SPAN = contextvars.ContextVar("farmbot_current_span", default=None)
+SPAN_IDS = itertools.count(1)
+
+
+def set_attribute(key, value):
+    """Set an attribute on the current span, if tracing."""
+    span = CURRENT_SPAN.get()
+    if span is not None:
+        span.attributes[key] = value
+
+
+class Span():
+    """Timed operation within a trace."""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.span_id = next(SPAN_IDS)
+        self.parent_id = None if parent is None else parent.span_id
+        self.attributes = attributes or {}
+        self.thread_id = threading.get_ident()
+        self.start_time = time.time()
+        self.end_time = None
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def end(self):
+        """Mark the span as finished."""
+        self.duration = time.perf_counter() - self._start
+        self.end_time = self.start_time + self.duration
+
+    def to_dict(self):
+        """Return span data as a dictionary."""
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "thread_id": self.thread_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer():
+    """Span recorder with optional exporter."""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start_span(self, name, attributes=None):
+        """Start a span nested within the current span."""
+        span = Span(name, CURRENT_SPAN.get(), attributes)
+        return span, CURRENT_SPAN.set(span)
+
+    def end_span(self, span, context_token):
+        """Finish a span and deliver it to the exporter."""
+        span.end()
+        CURRENT_SPAN.reset(context_token)
+        with self.lock:
+            self.spans.append(span)
+        if self.exporter is not None:
+            self.exporter(span)
+
+    def trace(self, name, func, *args, **kwargs):
+        """Call a function within a span."""
+        span, context_token = self.start_span(name)
+        try:
+            return func(*args, **kwargs)
+        except BaseException as exception:
+            span.attributes["error"] = repr(exception)
+            raise
+        finally:
+            self.end_span(span, context_token)
+
+    def chrome_trace(self):
+        """Return recorded spans in Chrome trace-event format."""
+        process_id = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = [{
+            "name": span.name,
+            "cat": "farmbot",
+            "ph": "X",
+            "ts": span.start_time * 1e6,
+            "dur": span.duration * 1e6,
+            "pid": process_id,
+            "tid": span.thread_id,
+            "args": {key: str(value) for key, value in span.attributes.items()},
+        } for span in spans]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        """Write recorded spans to a Chrome trace-event JSON file."""
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
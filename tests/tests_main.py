@@ -2,13 +2,27 @@
 Farmbot class unit tests.
 '''
 
+import os
 import sys
 import json
+import time
+import asyncio
+import tempfile
+import subprocess
+import threading
 import unittest
+import importlib.util
 from unittest.mock import Mock, patch, call
 import requests
 
 from farmbot import Farmbot
+from farmbot import codec
+from farmbot.export import iter_json_array, decode_chunks, ColumnBuilder
+from farmbot.diff import difference, json_patch, apply_patch
+from farmbot.history import StatusHistory
+from farmbot.rate_limit import OutgoingQueue
+from farmbot.timeouts import axis_seconds, RoundTripTimes
+from farmbot.token_store import TokenStore
 
 MOCK_TOKEN = {
     'token': {
@@ -40,8 +54,9 @@ REQUEST_KWARGS = {
 }
 
 
-JSONDecodeError = requests.exceptions.JSONDecodeError if sys.version_info >= (
-    3, 10) else json.JSONDecodeError
+def json_content(value):
+    '''Encode a mock API response body.'''
+    return json.dumps(value).encode('utf-8')
 
 
 class TestFarmbot(unittest.TestCase):
@@ -61,7 +76,7 @@ class TestFarmbot(unittest.TestCase):
         '''POSITIVE TEST: function called with email, password, and default server'''
         mock_response = Mock()
         expected_token = {'token': 'abc123'}
-        mock_response.json.return_value = expected_token
+        mock_response.content = json_content(expected_token)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -82,7 +97,7 @@ class TestFarmbot(unittest.TestCase):
         '''POSITIVE TEST: function called with email, password, and custom server'''
         mock_response = Mock()
         expected_token = {'token': 'abc123'}
-        mock_response.json.return_value = expected_token
+        mock_response.content = json_content(expected_token)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -195,6 +210,165 @@ class TestFarmbot(unittest.TestCase):
             error_msg='ERROR: An unexpected error occurred: other',
         )
 
+    @staticmethod
+    def helper_expiring_token(seconds, encoded='encoded_token_value'):
+        '''Test helper to create a token expiring in the given seconds'''
+        return {'token': {
+            'unencoded': {**MOCK_TOKEN['token']['unencoded'],
+                          'exp': time.time() + seconds},
+            'encoded': encoded,
+        }}
+
+    @patch('requests.request')
+    def test_get_token_store(self, mock_request):
+        '''get_token: reuse stored token'''
+        token = self.helper_expiring_token(2 * 24 * 60 * 60)
+        mock_response = Mock()
+        mock_response.content = json_content(token)
+        mock_response.status_code = 200
+        mock_request.return_value = mock_response
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'farmbot', 'token.json')
+            self.fb.set_token_store(path)
+            self.fb.set_token(None)
+            self.fb.get_token('email@gmail.com', 'test_pass_123')
+            mock_request.assert_called_once()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            timer = self.fb.state.token_refresh_timer
+            self.assertIsNotNone(timer)
+            mock_request.reset_mock()
+            fb = Farmbot()
+            fb.set_verbosity(0)
+            fb.set_token_store(path)
+            fb.get_token('email@gmail.com', 'test_pass_123')
+            mock_request.assert_not_called()
+            self.assertEqual(fb.state.token, token)
+            fb.set_token_store(None)
+            self.fb.set_token_store(None)
+            self.assertTrue(timer.finished.is_set())
+            self.assertIsNone(self.fb.state.token_refresh_timer)
+
+    @patch('requests.request')
+    def test_get_token_store_expired(self, mock_request):
+        '''get_token: stored token about to expire is not reused'''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'token.json')
+            self.fb.set_token_store(path, refresh_margin=60)
+            self.fb.state.token_store.save(
+                'https://my.farm.bot', 'email@gmail.com',
+                self.helper_expiring_token(30))
+            mock_response = Mock()
+            mock_response.content = json_content(self.helper_expiring_token(600))
+            mock_response.status_code = 200
+            mock_request.return_value = mock_response
+            self.fb.get_token('email@gmail.com', 'test_pass_123')
+            mock_request.assert_called_once()
+            self.fb.state.token_store.remove(
+                'https://my.farm.bot', 'email@gmail.com')
+            self.assertEqual(self.fb.state.token_store.read(), {})
+            self.fb.set_token_store(None)
+
+    def test_token_store_concurrent_processes(self):
+        '''TokenStore: concurrent processes keep each other's tokens'''
+        script = (
+            'import sys\n'
+            'from farmbot.token_store import TokenStore\n'
+            'store = TokenStore(sys.argv[1])\n'
+            'for i in range(50):\n'
+            '    store.save("https://my.farm.bot", f"{sys.argv[2]}@gmail.com", {"i": i})\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'token.json')
+            processes = [
+                subprocess.Popen(
+                    [sys.executable, '-c', script, path, f'user{n}'],
+                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+                for n in range(4)]
+            for process in processes:
+                self.assertEqual(process.wait(timeout=60), 0)
+            with open(path, encoding='utf-8') as token_file:
+                tokens = json.load(token_file)
+            self.assertEqual(len(tokens), 4)
+            self.assertTrue(all(token == {'i': 49} for token in tokens.values()))
+            self.assertEqual(
+                [name for name in os.listdir(directory) if name.endswith('.tmp')], [])
+
+    def test_token_store_windows_lock(self):
+        '''TokenStore: lock with msvcrt where fcntl is unavailable'''
+        mock_msvcrt = Mock(LK_LOCK=1, LK_UNLCK=0)
+        with tempfile.TemporaryDirectory() as directory:
+            store = TokenStore(os.path.join(directory, 'token.json'))
+            with patch.dict(sys.modules, {'fcntl': None, 'msvcrt': mock_msvcrt}):
+                store.save('https://my.farm.bot', 'email@gmail.com', {'i': 0})
+            self.assertEqual(
+                [c.args[1:] for c in mock_msvcrt.locking.mock_calls], [(1, 1), (0, 1)])
+            self.assertEqual(store.read(), {'email@gmail.com https://my.farm.bot': {'i': 0}})
+
+    def test_token_store_write_error(self):
+        '''TokenStore: failed write leaves the stored tokens and no temporary file'''
+        with tempfile.TemporaryDirectory() as directory:
+            store = TokenStore(os.path.join(directory, 'token.json'))
+            store.save('https://my.farm.bot', 'email@gmail.com', {'i': 0})
+            with patch('os.replace', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    store.save('https://my.farm.bot', 'email@gmail.com', {'i': 1})
+            self.assertEqual(store.read(), {'email@gmail.com https://my.farm.bot': {'i': 0}})
+            self.assertEqual(
+                sorted(os.listdir(directory)), ['token.json', 'token.json.lock'])
+
+    @patch('requests.request')
+    def test_refresh_token(self, mock_request):
+        '''refresh_token: exchange token before expiration'''
+        new_token = self.helper_expiring_token(600, 'new_token_value')
+        mock_response = Mock()
+        mock_response.content = json_content(new_token)
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_request.return_value = mock_response
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'token.json')
+            self.fb.set_token_store(path, refresh_margin=60)
+            self.fb.set_token(self.helper_expiring_token(30))
+            self.fb.api_get('device')
+            mock_request.assert_has_calls([call(
+                method='GET',
+                url='https://my.farm.bot/api/tokens',
+                **REQUEST_KWARGS,
+            )])
+            self.assertEqual(
+                mock_request.call_args.kwargs['headers']['authorization'],
+                'new_token_value')
+            self.assertEqual(self.fb.state.token, new_token)
+            self.assertIsNotNone(self.fb.state.token_refresh_timer)
+            self.fb.set_token_store(None)
+
+    @patch('requests.request')
+    def test_refresh_token_error(self, mock_request):
+        '''refresh_token: error schedules retry'''
+        mock_response = Mock()
+        mock_response.status_code = 401
+        mock_request.return_value = mock_response
+        self.fb.set_token_store('unused_path', refresh_margin=60)
+        self.fb.set_token(self.helper_expiring_token(30))
+        result = self.fb.refresh_token()
+        self.assertEqual(result, 'HTTP ERROR: Unexpected status code 401')
+        timer = self.fb.state.token_refresh_timer
+        self.assertIsNotNone(timer)
+        self.assertLessEqual(timer.interval, 30)
+        self.fb.set_token(self.helper_expiring_token(-1))
+        self.fb.refresh_token()
+        self.assertIsNone(self.fb.state.token_refresh_timer)
+        # No expiration, or no token store: no retry
+        self.fb.set_token(MOCK_TOKEN)
+        self.fb.state.token_source = ('https://other.farm.bot', 'email@gmail.com')
+        self.fb.refresh_token()
+        self.assertEqual(
+            mock_request.call_args.kwargs['url'], 'https://other.farm.bot/api/tokens')
+        self.assertIsNone(self.fb.state.token_refresh_timer)
+        self.fb.set_token_store(None)
+        self.fb.refresh_token()
+        self.assertIsNone(self.fb.state.token_refresh_timer)
+
     @patch('requests.request')
     def helper_api_get_error(self, *args, **kwargs):
         '''Test helper for api_get errors'''
@@ -205,7 +379,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response.status_code = status_code
         mock_response.reason = 'reason'
         mock_response.text = 'text'
-        mock_response.json.return_value = {'error': 'error'}
+        mock_response.content = json_content({'error': 'error'})
         mock_request.return_value = mock_response
         response = self.fb.api_get('device')
         mock_request.assert_called_once_with(
@@ -239,7 +413,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response.status_code = 404
         mock_response.reason = 'reason'
         mock_response.text = 'error string'
-        mock_response.json.side_effect = JSONDecodeError('', '', 0)
+        mock_response.content = b'not json'
         mock_request.return_value = mock_response
         response = self.fb.api_get('device')
         mock_request.assert_called_once_with(
@@ -258,7 +432,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response.status_code = 404
         mock_response.reason = 'reason'
         mock_response.text = '<html><h1>error0</h1><h2>error1</h2></html>'
-        mock_response.json.side_effect = JSONDecodeError('', '', 0)
+        mock_response.content = b'not json'
         mock_request.return_value = mock_response
         response = self.fb.api_get('device')
         mock_request.assert_called_once_with(
@@ -275,7 +449,7 @@ class TestFarmbot(unittest.TestCase):
         '''POSITIVE TEST: function called with endpoint only'''
         mock_response = Mock()
         expected_response = {'device': 'info'}
-        mock_response.json.return_value = expected_response
+        mock_response.content = json_content(expected_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -293,7 +467,7 @@ class TestFarmbot(unittest.TestCase):
         '''Test api_get: with payload'''
         mock_response = Mock()
         expected_response = {'device': 'info'}
-        mock_response.json.return_value = expected_response
+        mock_response.content = json_content(expected_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -312,7 +486,7 @@ class TestFarmbot(unittest.TestCase):
         '''POSITIVE TEST: function called with valid ID'''
         mock_response = Mock()
         expected_response = {'peripheral': 'info'}
-        mock_response.json.return_value = expected_response
+        mock_response.content = json_content(expected_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -373,7 +547,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'name': 'new name'}
+        mock_response.content = json_content({'name': 'new name'})
         mock_request.return_value = mock_response
         device_info = self.fb.api_patch('device', {'name': 'new name'})
         mock_request.assert_has_calls([call(
@@ -382,7 +556,6 @@ class TestFarmbot(unittest.TestCase):
             **REQUEST_KWARGS_WITH_PAYLOAD,
             json={'name': 'new name'},
         ),
-            call().json(),
         ])
         self.assertEqual(device_info, {'name': 'new name'})
 
@@ -392,7 +565,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'name': 'new name'}
+        mock_response.content = json_content({'name': 'new name'})
         mock_request.return_value = mock_response
         point = self.fb.api_post('points', {'name': 'new name'})
         mock_request.assert_has_calls([call(
@@ -401,7 +574,6 @@ class TestFarmbot(unittest.TestCase):
             **REQUEST_KWARGS_WITH_PAYLOAD,
             json={'name': 'new name'},
         ),
-            call().json(),
         ])
         self.assertEqual(point, {'name': 'new name'})
 
@@ -411,7 +583,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'name': 'new name'}
+        mock_response.content = json_content({'name': 'new name'})
         mock_request.return_value = mock_response
         point = self.fb.api_post('points')
         mock_request.assert_has_calls([call(
@@ -419,7 +591,6 @@ class TestFarmbot(unittest.TestCase):
             url='https://my.farm.bot/api/points',
             **REQUEST_KWARGS,
         ),
-            call().json(),
         ])
         self.assertEqual(point, {'name': 'new name'})
 
@@ -429,7 +600,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'name': 'deleted'}
+        mock_response.content = json_content({'name': 'deleted'})
         mock_request.return_value = mock_response
         result = self.fb.api_delete('points', 12345)
         mock_request.assert_called_once_with(
@@ -445,7 +616,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'name': 'deleted'}
+        mock_response.content = json_content({'name': 'deleted'})
         mock_request.return_value = mock_response
         result = self.fb.api_delete(
             'points', 12345, payload={'key': 'value'})
@@ -470,10 +641,10 @@ class TestFarmbot(unittest.TestCase):
         '''get_curve function test helper'''
         mock_request = args[0]
         mock_response = Mock()
-        mock_response.json.return_value = {
+        mock_response.content = json_content({
             'name': 'Curve 0',
             **kwargs.get('api_data'),
-        }
+        })
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -531,7 +702,7 @@ class TestFarmbot(unittest.TestCase):
     def test_get_curve_error(self, mock_request):
         '''test get_curve function: error'''
         mock_response = Mock()
-        mock_response.json.return_value = None
+        mock_response.content = json_content(None)
         mock_response.status_code = 400
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -547,7 +718,7 @@ class TestFarmbot(unittest.TestCase):
     def test_safe_z(self, mock_request):
         '''test safe_z function'''
         mock_response = Mock()
-        mock_response.json.return_value = {'safe_height': 100}
+        mock_response.content = json_content({'safe_height': 100})
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -563,14 +734,14 @@ class TestFarmbot(unittest.TestCase):
     def test_garden_size(self, mock_request):
         '''test garden_size function'''
         mock_response = Mock()
-        mock_response.json.return_value = {
+        mock_response.content = json_content({
             'movement_axis_nr_steps_x': 1000,
             'movement_axis_nr_steps_y': 2000,
             'movement_axis_nr_steps_z': 40000,
             'movement_step_per_mm_x': 5,
             'movement_step_per_mm_y': 5,
             'movement_step_per_mm_z': 25,
-        }
+        })
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -588,7 +759,7 @@ class TestFarmbot(unittest.TestCase):
         mock_response = Mock()
         mock_response.status_code = 200
         mock_response.text = 'text'
-        mock_response.json.return_value = {'message': 'test message'}
+        mock_response.content = json_content({'message': 'test message'})
         mock_request.return_value = mock_response
         self.fb.log('test message', 'info', ['toast'])
         mock_request.assert_called_once_with(
@@ -630,13 +801,14 @@ class TestFarmbot(unittest.TestCase):
         '''Test listen command'''
         mock_client = Mock()
         mock_mqtt.return_value = mock_client
-        self.fb.listen()
 
         class MockMessage:
             '''Mock message class'''
             topic = 'bot/device_0/topic'
             payload = '{"message": "test message"}'
-        mock_client.on_message('', '', MockMessage())
+        mock_client.subscribe.side_effect = lambda _topic: mock_client.on_message(
+            '', '', MockMessage())
+        self.fb.listen()
         mock_client.username_pw_set.assert_called_once_with(
             username='device_0',
             password='encoded_token_value')
@@ -651,25 +823,39 @@ class TestFarmbot(unittest.TestCase):
             'topic': 'bot/device_0/topic',
             'content': {'message': 'test message'},
         }])
+        # Messages after listening ends aren't stored
+        self.fb.subscribe('topic', lambda _topic, _payload: None)
+        mock_client.on_message('', '', MockMessage())
+        self.assertEqual(len(self.fb.state.last_messages['topic']), 1)
 
     @patch('paho.mqtt.client.Client')
     def test_listen_diff_only(self, mock_mqtt):
         '''Test listen command: diff_only'''
         mock_client = Mock()
         mock_mqtt.return_value = mock_client
-        self.fb.listen(message_options={'diff_only': True})
 
         class MockMessageFirst:
             '''Mock message class'''
             topic = 'bot/device_0/topic'
             payload = '{"message": "test message", "i": 0}'
-        mock_client.on_message('', '', MockMessageFirst())
 
         class MockMessageSecond:
             '''Mock message class'''
             topic = 'bot/device_0/topic'
             payload = '{"message": "test message", "i": 1}'
-        mock_client.on_message('', '', MockMessageSecond())
+
+        class MockMessageThird:
+            '''Mock message class'''
+            topic = 'bot/device_0/topic'
+            payload = '{"i": 1}'
+
+        def deliver(_topic):
+            '''Deliver messages once subscribed'''
+            mock_client.on_message('', '', MockMessageFirst())
+            mock_client.on_message('', '', MockMessageSecond())
+            mock_client.on_message('', '', MockMessageThird())
+        mock_client.subscribe.side_effect = deliver
+        self.fb.listen(message_options={'diff_only': True})
         mock_client.username_pw_set.assert_called_once_with(
             username='device_0',
             password='encoded_token_value')
@@ -685,37 +871,883 @@ class TestFarmbot(unittest.TestCase):
              'content': {'message': 'test message', 'i': 0}},
             {'topic': 'bot/device_0/topic',
              'content': {'message': 'test message', 'i': 1}},
+            {'topic': 'bot/device_0/topic',
+             'content': {'i': 1}},
         ])
         self.assertEqual(self.fb.state.last_messages['topic_diffs'], [
             {'i': 1},
+            {'message': None},
+        ])
+
+    def test_codec(self):
+        '''Test JSON codec with installed and fallback libraries'''
+        value = {'kind': 'move', 'args': {'label': 'é/1', 'speed': 1.5}, 'body': [None, True]}
+        compact = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+        for backend in [codec.backend(), ('json', json)]:
+            with patch('farmbot.codec.backend', return_value=backend):
+                self.assertEqual(codec.encode(value), compact.encode('utf-8'))
+                self.assertEqual(codec.dumps(value), compact)
+                self.assertEqual(codec.dumps(value, indent=4), json.dumps(value, indent=4))
+                self.assertEqual(json.loads(codec.dumps(value, indent=2)), value)
+                self.assertEqual(codec.loads(codec.encode(value)), value)
+                self.assertEqual(codec.loads(compact), value)
+        mock_ujson = Mock()
+        mock_ujson.dumps.return_value = compact
+        with patch('farmbot.codec.backend', return_value=('ujson', mock_ujson)):
+            self.assertEqual(codec.encode(value), compact.encode('utf-8'))
+            self.assertEqual(codec.dumps(value, indent=4), compact)
+        self.assertEqual(mock_ujson.dumps.call_args_list, [
+            call(value, ensure_ascii=False, escape_forward_slashes=False),
+            call(value, indent=4, escape_forward_slashes=False),
+        ])
+        codec.backend.cache_clear()
+        try:
+            with patch('importlib.import_module', side_effect=ImportError):
+                self.assertEqual(codec.backend(), ('json', json))
+        finally:
+            codec.backend.cache_clear()
+
+    def test_outgoing_queue_rate(self):
+        '''Test outgoing message rate limit'''
+        queue = OutgoingQueue()
+        self.assertEqual(queue.acquire(), 0)
+        queue.set_rate(20, burst=2)
+        start = time.monotonic()
+        for _ in range(4):
+            queue.acquire()
+        self.assertGreater(time.monotonic() - start, 0.09)
+        with self.assertRaises(ValueError):
+            queue.set_rate(0)
+        with self.assertRaises(ValueError):
+            queue.set_rate(1, burst=0)
+        # Waiting senders go right away when the limit is removed
+        queue.set_rate(0.1)
+        queue.acquire()
+        waiting = threading.Thread(target=queue.acquire)
+        waiting.start()
+        time.sleep(0.05)
+        queue.set_rate(None)
+        waiting.join(1)
+        self.assertFalse(waiting.is_alive())
+
+    def test_outgoing_queue_priority(self):
+        '''Test high priority messages are sent first'''
+        queue = OutgoingQueue(rate=10)
+        queue.acquire()
+        order = []
+
+        def send(name, priority):
+            '''Wait for a turn to send'''
+            queue.acquire(priority)
+            order.append(name)
+        low = threading.Thread(target=send, args=('low', 0))
+        low.start()
+        time.sleep(0.02)
+        high = threading.Thread(target=send, args=('e_stop', 9000))
+        high.start()
+        low.join(1)
+        high.join(1)
+        self.assertEqual(order, ['e_stop', 'low'])
+
+    @patch('paho.mqtt.client.Client')
+    def test_set_rate_limit(self, mock_mqtt):
+        '''Test commands waiting for the outgoing rate limit'''
+        mock_mqtt.return_value = Mock()
+        self.fb.set_timeout(0)
+        self.fb.set_rate_limit(5)
+        for _ in range(3):
+            self.fb.wait(0)
+        histograms = self.fb.get_metrics()['histograms']
+        self.assertEqual(histograms['broker_queue_seconds'][0]['labels'], {'kind': 'wait'})
+        self.assertEqual(histograms['broker_queue_seconds'][0]['count'], 3)
+        self.assertGreater(histograms['broker_queue_seconds'][0]['sum'], 0.05)
+
+    def test_axis_seconds(self):
+        '''Test movement time estimates'''
+        self.assertAlmostEqual(axis_seconds(100, 50, 10, 10), 2 * 40 / 120 + 80 / 50)
+        self.assertAlmostEqual(axis_seconds(10, 50, 10, 10), 2 * (1300 ** 0.5 - 10) / 120)
+        self.assertEqual(axis_seconds(0, 50, 10, 10), 0)
+        self.assertEqual(axis_seconds(100, 50, 50, 10), 2)
+        self.assertEqual(axis_seconds(100, 50, 10, 0), 2)
+
+    def test_command_timeout_movements(self):
+        '''Test movement timeouts from firmware settings and position'''
+        self.fb.set_timeout(None, 'movements')
+        self.fb.set_timeout(15, 'listen')
+        firmware_config = {
+            f'movement_{key}_{axis}': value
+            for axis in 'xyz'
+            for key, value in [
+                ('step_per_mm', 5), ('max_spd', 400), ('min_spd', 50),
+                ('home_spd', 200), ('steps_acc_dec', 250), ('axis_nr_steps', 15000)]}
+        self.fb.state.save_cache('firmware_config', firmware_config)
+
+        def move(**kwargs):
+            '''Move command'''
+            return {'kind': 'move', 'args': {}, 'body': [
+                {'kind': 'axis_overwrite', 'args': {
+                    'axis': axis,
+                    'axis_operand': {'kind': 'numeric', 'args': {'number': number}}}}
+                for axis, number in kwargs.items()]}
+        def speed_overwrite(speed):
+            '''Speed overwrite body items'''
+            return [{'kind': 'speed_overwrite', 'args': {
+                'axis': axis,
+                'speed_setting': {'kind': 'numeric', 'args': {'number': speed}}}}
+                for axis in 'xyz']
+        broker = self.fb.broker
+        # Position unknown: whole axis length
+        self.assertEqual(broker.command_timeout(move(x=50)), 59.7)
+        self.fb.state.known_position.reported(
+            {'location_data': {'position': {'x': 0, 'y': 0, 'z': 0}}})
+        self.assertEqual(broker.command_timeout(move(x=50)), 4.2)
+        self.assertEqual(broker.command_timeout(move(x=50, y=2000)), 41.0)
+        slow_move = move(x=50)
+        slow_move['body'] += speed_overwrite(50)
+        self.assertEqual(broker.command_timeout(slow_move), 5.8)
+        safe_z_move = move(x=50)
+        safe_z_move['body'].append({'kind': 'safe_z', 'args': {}})
+        self.assertEqual(broker.command_timeout(safe_z_move), 119.7)
+        self.assertEqual(broker.command_timeout(
+            {'kind': 'find_home', 'args': {'axis': 'x', 'speed': 100}}), 116.8)
+        self.assertEqual(broker.command_timeout(
+            {'kind': 'calibrate', 'args': {'axis': 'all'}}), 690.5)
+        # Incomplete settings
+        self.fb.state.save_cache('firmware_config', {'movement_step_per_mm_x': 0})
+        self.assertEqual(broker.command_timeout(move(x=50)), 120)
+        self.fb.state.save_cache('firmware_config', {
+            'movement_step_per_mm_x': 5, 'movement_max_spd_x': 0,
+            'movement_axis_nr_steps_x': 100})
+        self.assertEqual(broker.command_timeout(move(x=50)), 120)
+        self.assertEqual(broker.command_timeout(
+            {'kind': 'find_home', 'args': {'axis': 'y'}}), 120)
+        self.fb.clear_cache('firmware_config')
+        self.assertEqual(broker.command_timeout(move(x=50)), 120)
+        # A set movements timeout is used instead of estimates
+        self.fb.state.known_position.reported(
+            {'location_data': {'position': {'x': 0, 'y': 0, 'z': 0}}})
+        self.fb.state.save_cache('firmware_config', firmware_config)
+        self.assertEqual(broker.command_timeout(move(x=50)), 4.2)
+        self.fb.set_timeout(30, 'movements')
+        self.assertEqual(broker.command_timeout(move(x=50)), 30)
+        self.assertEqual(broker.command_timeout(
+            {'kind': 'find_home', 'args': {'axis': 'x'}}), 30)
+        self.fb.set_timeout(None, 'all')
+        self.assertEqual(self.fb.state.timeout, {'api': 15, 'listen': 15, 'movements': 120})
+        self.assertEqual(broker.command_timeout(move(x=50)), 4.2)
+
+    @patch('paho.mqtt.client.Client')
+    def test_command_timeout_known_position(self, mock_mqtt):
+        '''Test movement timeouts from the last commanded position'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+
+        def respond(_topic, payload):
+            '''Respond to published commands'''
+            rpc = json.loads(payload)
+            if rpc['body'][0]['kind'] == 'read_status':
+                mock_client.on_message('', '', MockMessage(
+                    'bot/device_0/status',
+                    {'location_data': {'position': {'x': 0, 'y': 0, 'z': 0}}}))
+                return
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/from_device',
+                {'kind': 'rpc_ok', 'args': {'label': rpc['args']['label']}}))
+        mock_client.publish.side_effect = respond
+        self.fb.set_timeout(None, 'movements')
+        self.fb.state.save_cache('firmware_config', {
+            f'movement_{key}_{axis}': value
+            for axis in 'xyz'
+            for key, value in [
+                ('step_per_mm', 5), ('max_spd', 400), ('min_spd', 50),
+                ('steps_acc_dec', 250), ('axis_nr_steps', 15000)]})
+        move_home = {'kind': 'move', 'args': {}, 'body': [
+            {'kind': 'axis_overwrite', 'args': {
+                'axis': 'x', 'axis_operand': {'kind': 'numeric', 'args': {'number': 0}}}}]}
+        known_position = self.fb.state.known_position
+        self.fb.get_xyz()
+        self.assertEqual(known_position.get(), {'x': 0, 'y': 0, 'z': 0})
+        self.fb.move(x=2000, safe_z=True)
+        self.assertEqual(known_position.get(), {'x': 2000, 'y': 0, 'z': None})
+        # Not the position reported before the previous movement
+        self.assertEqual(self.fb.broker.command_timeout(move_home), 41.0)
+        # Positions reported during a movement are ignored
+        known_position.commanded({'kind': 'find_home', 'args': {'axis': 'x'}})
+        known_position.reported({'location_data': {'position': {'x': 5, 'y': 0, 'z': 0}}})
+        self.assertEqual(known_position.get()['x'], 0)
+        known_position.finished(False)
+        self.assertEqual(known_position.get(), {'x': None, 'y': None, 'z': None})
+        known_position.reported({'location_data': None})
+        known_position.reported(None)
+        self.assertEqual(known_position.get(), {'x': None, 'y': None, 'z': None})
+        known_position.commanded({'kind': 'calibrate', 'args': {'axis': 'all'}})
+        known_position.finished(True)
+        self.assertEqual(known_position.get(), {'x': 0, 'y': 0, 'z': 0})
+
+    def test_command_timeout_round_trips(self):
+        '''Test timeouts from recent round-trip times'''
+        self.fb.set_timeout(None, 'listen')
+        round_trips = self.fb.state.round_trips
+        read_pin = {'kind': 'read_pin', 'args': {}}
+        self.assertEqual(self.fb.broker.command_timeout(read_pin), 15)
+        for _ in range(19):
+            round_trips.add('read_pin', 0.2)
+        self.assertIsNone(round_trips.percentile(99, 'read_pin'))
+        round_trips.add('read_pin', 0.8)
+        self.assertEqual(round_trips.percentile(99, 'read_pin'), 0.8)
+        self.assertEqual(round_trips.percentile(50), 0.2)
+        self.assertEqual(self.fb.broker.command_timeout(read_pin), 2.4)
+        for _ in range(20):
+            round_trips.add('take_photo', 10)
+        self.assertEqual(self.fb.broker.command_timeout({'kind': 'take_photo'}), 15)
+        self.assertEqual(self.fb.broker.command_timeout({'kind': 'wait'}), 15)
+        # A set listen timeout is used instead of round-trip times
+        self.fb.set_timeout(60)
+        self.assertEqual(self.fb.broker.command_timeout(read_pin), 60)
+        self.fb.set_timeout(None)
+        self.assertEqual(self.fb.broker.command_timeout(read_pin), 2.4)
+        self.assertEqual(len(RoundTripTimes(samples=5).times), 0)
+
+    def test_difference(self):
+        '''Test difference: additions and changes'''
+        prev = {'a': {'b': 1, 'c': [1]}, 'd': 1, 'e': 0}
+        self.assertEqual(
+            difference({'a': {'b': 2, 'c': [1]}, 'd': 1, 'f': 1}, prev),
+            ({'a': {'b': 2}, 'f': 1}, True))
+        self.assertEqual(difference({'a': prev['a'], 'd': 1}, prev), ({}, True))
+        self.assertEqual(difference(dict(prev), prev), ({}, False))
+        self.assertEqual(difference(prev, prev), ({}, False))
+        self.assertEqual(difference(2, 1), (2, True))
+        self.assertEqual(
+            difference({'a': {'c': [1]}, 'd': 1}, prev, removed=True),
+            ({'a': {'b': None}, 'e': None}, True))
+
+    def test_json_patch(self):
+        '''Test json_patch and apply_patch'''
+        prev = {
+            'location_data': {'position': {'x': 0, 'y': 0}},
+            'pins': {'13': {'value': 0}},
+            'jobs': {'a/b~c': 1},
+            'list': [1, 2],
+        }
+        next_state = {
+            'location_data': {'position': {'x': 1, 'y': 0}},
+            'pins': prev['pins'],
+            'jobs': {},
+            'list': [1, 2, 3],
+            'new': None,
+        }
+        patch_operations = json_patch(prev, next_state)
+        self.assertEqual(patch_operations, [
+            {'op': 'replace', 'path': '/location_data/position/x', 'value': 1},
+            {'op': 'remove', 'path': '/jobs/a~1b~0c'},
+            {'op': 'replace', 'path': '/list', 'value': [1, 2, 3]},
+            {'op': 'add', 'path': '/new', 'value': None},
+        ])
+        result = apply_patch(prev, patch_operations)
+        self.assertEqual(result, next_state)
+        self.assertIs(result['pins'], prev['pins'])
+        self.assertEqual(prev['location_data']['position']['x'], 0)
+        self.assertEqual(prev['jobs'], {'a/b~c': 1})
+        self.assertEqual(json_patch(prev, prev), [])
+        self.assertEqual(json_patch(1, 2), [{'op': 'replace', 'path': '', 'value': 2}])
+        self.assertEqual(json_patch([1], [1]), [])
+
+    def test_apply_patch_lists_and_root(self):
+        '''Test apply_patch: list operations and root replacement'''
+        state = {'list': [1, 3]}
+        result = apply_patch(state, [
+            {'op': 'add', 'path': '/list/1', 'value': 2},
+            {'op': 'add', 'path': '/list/-', 'value': 4},
+            {'op': 'remove', 'path': '/list/0'},
+        ])
+        self.assertEqual(result, {'list': [2, 3, 4]})
+        self.assertEqual(state, {'list': [1, 3]})
+        value = {'a': {'b': 1}}
+        result = apply_patch(state, [
+            {'op': 'replace', 'path': '', 'value': value},
+            {'op': 'replace', 'path': '/a/b', 'value': 2},
+        ])
+        self.assertEqual(result, {'a': {'b': 2}})
+        self.assertEqual(value, {'a': {'b': 1}})
+        with self.assertRaises(ValueError) as cm:
+            apply_patch(state, [{'op': 'move', 'path': '/list'}])
+        self.assertEqual(
+            cm.exception.args[0],
+            "Invalid op: move not in ['add', 'replace', 'remove']")
+
+    @staticmethod
+    def helper_status(i):
+        '''Status tree at second i'''
+        return {
+            'location_data': {'position': {'x': i % 50, 'y': 0, 'z': 0}},
+            'informational_settings': {'uptime': i, 'busy': i % 10 == 0},
+            'pins': {str(pin): {'mode': 0, 'value': 0} for pin in range(70)},
+            'configuration': {f'setting_{n}': n for n in range(100)},
+        }
+
+    def test_status_history(self):
+        '''Test StatusHistory: random access and memory use'''
+        history = StatusHistory(keyframe_interval=60)
+        for i in range(300):
+            history.append(self.helper_status(i), timestamp=1000 + i)
+        self.assertEqual(len(history), 300)
+        self.assertEqual(history.keyframes, [0, 60, 120, 180, 240])
+        self.assertIsNone(history.at(999))
+        for i in [0, 1, 59, 60, 61, 150, 299]:
+            self.assertEqual(history.at(1000 + i), self.helper_status(i))
+        self.assertEqual(history.at(1000.5), self.helper_status(0))
+        self.assertEqual(history.at(5000), self.helper_status(299))
+        usage = history.memory_usage()
+        self.assertEqual(usage['entries'], 300)
+        self.assertEqual(usage['keyframes'], 5)
+        self.assertLess(usage['bytes'], usage['full_snapshots_bytes'] / 10)
+        # Earlier timestamps (i.e., after a clock change) are moved up
+        history.append({'moved': True}, timestamp=0)
+        self.assertEqual(history.timestamps[-1], 1299)
+        self.assertEqual(history.at(1299), {'moved': True})
+        with self.assertRaises(ValueError):
+            StatusHistory(keyframe_interval=0)
+
+    @patch('paho.mqtt.client.Client')
+    def test_status_history_from_broker(self, mock_mqtt):
+        '''Test recording status history from received messages'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        history = self.fb.start_status_history(keyframe_interval=2)
+        mock_client.subscribe.assert_called_once_with('bot/device_0/status')
+        mock_client.loop_start.assert_called()
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+        for i in range(3):
+            self.fb.broker._on_message(
+                None, None, MockMessage('bot/device_0/status', self.helper_status(i)))
+        self.fb.broker._on_message(
+            None, None, MockMessage('bot/device_0/logs', {'message': 'log'}))
+        self.assertIs(self.fb.stop_status_history(), history)
+        self.assertIsNone(self.fb.state.status_history)
+        self.assertEqual(self.fb.broker.subscribers, {})
+        mock_client.loop_stop.assert_called_once()
+        self.assertIsNone(self.fb.stop_status_history())
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.keyframes, [0, 2])
+        self.assertIsInstance(history.entries[1], list)
+        self.assertEqual(history.at(history.timestamps[-1]), self.helper_status(2))
+
+    @patch('paho.mqtt.client.Client')
+    def test_watch(self, mock_mqtt):
+        '''Test status tree watchers sharing one subscription'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        positions = []
+        pins = []
+        far = []
+        position_id = self.fb.watch('location_data.position', positions.append)
+        self.fb.watch('pins.13.value', pins.append)
+        self.fb.watch(
+            'location_data.position.x', far.append, predicate=lambda x: x > 1)
+        mock_client.subscribe.assert_called_once_with('bot/device_0/status')
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, x, pin):
+                self.topic = 'bot/device_0/status'
+                self.payload = json.dumps({
+                    'location_data': {'position': {'x': x, 'y': 0, 'z': 0}},
+                    'pins': {'13': {'value': pin}},
+                    'uptime': x + pin,
+                })
+        for x, pin in [(0, 0), (0, 1), (1, 1), (2, 1), (2, 1)]:
+            mock_client.on_message('', '', MockMessage(x, pin))
+        self.assertEqual(positions, [
+            {'x': 0, 'y': 0, 'z': 0},
+            {'x': 1, 'y': 0, 'z': 0},
+            {'x': 2, 'y': 0, 'z': 0},
+        ])
+        self.assertEqual(pins, [0, 1])
+        self.assertEqual(far, [2])
+
+        self.fb.unwatch(position_id)
+        mock_client.on_message('', '', MockMessage(3, 1))
+        self.assertEqual(len(positions), 3)
+        self.assertEqual(far, [2, 3])
+
+        # Missing values and failing callbacks
+        values = []
+
+        def fail(value):
+            '''Failing watcher callback'''
+            values.append(value)
+            raise ValueError('watcher error')
+        self.fb.watch('uptime.seconds', fail)
+        mock_client.on_message('', '', MockMessage(4, 1))
+        self.assertEqual(values, [None])
+        self.assertEqual(far, [2, 3, 4])
+        for watch_id in list(self.fb.broker.watchers):
+            self.fb.unwatch(watch_id)
+        mock_client.loop_stop.assert_called_once()
+        self.assertEqual(self.fb.broker.subscribers, {})
+
+    @patch('paho.mqtt.client.Client')
+    def test_stream(self, mock_mqtt):
+        '''Test streaming messages as they arrive'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+        messages = self.fb.stream(
+            'logs', filters={'content': {'type': 'info'}}, path='message')
+        mock_client.subscribe.assert_called_once_with('bot/device_0/logs')
+        for i in range(3):
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/logs', {'type': 'info', 'message': f'log {i}'}))
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/logs', {'type': 'error', 'message': 'skipped'}))
+        mock_client.on_message('', '', MockMessage('bot/device_0/status', {}))
+        received = []
+        for message in messages:
+            received.append(message)
+            if len(received) == 2:
+                break
+        self.assertEqual(received, [
+            {'topic': 'bot/device_0/logs', 'content': 'log 0'},
+            {'topic': 'bot/device_0/logs', 'content': 'log 1'},
+        ])
+        self.assertEqual(self.fb.broker.subscribers, {})
+        mock_client.loop_stop.assert_called_once()
+
+        messages = self.fb.stream(
+            '#', filters={'topic': 'logs', 'content': {'args.label': 'a'}}, path='message')
+        messages.put('bot/device_0/status', {'args': {'label': 'a'}})
+        messages.put('bot/device_0/logs', {'args': 'a'})
+        messages.put('bot/device_0/logs', {'args': {'label': 'a'}})
+        self.assertIsNone(messages.get(timeout=0.01))
+        messages.close()
+        messages.put('bot/device_0/logs', {'args': {'label': 'a'}, 'message': 'log'})
+        self.assertIsNone(messages.get())
+
+        # Multi-level channels
+        messages = self.fb.stream('sync/#')
+        mock_client.subscribe.assert_called_with('bot/device_0/sync/#')
+        mock_client.on_message('', '', MockMessage(
+            'bot/device_0/sync/Point/1', {'body': {'id': 1}}))
+        self.assertEqual(messages.get(timeout=1), {
+            'topic': 'bot/device_0/sync/Point/1', 'content': {'body': {'id': 1}}})
+        messages.close()
+
+    @patch('paho.mqtt.client.Client')
+    def test_stream_backpressure(self, mock_mqtt):
+        '''Test stream buffer limit and duration'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+        statuses = []
+        self.fb.subscribe('status', lambda _topic, payload: statuses.append(payload))
+        messages = self.fb.stream('logs', duration=0.5, max_size=1)
+        for i in range(3):
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/logs', {'message': f'log {i}'}))
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/status', {'uptime': i}))
+        self.assertEqual(statuses, [{'uptime': 0}, {'uptime': 1}, {'uptime': 2}])
+        self.assertEqual(messages.get()['content'], {'message': 'log 0'})
+        self.assertEqual(self.fb.get_metrics()['counters']['broker_stream_dropped_total'], [
+            {'labels': {'channel': 'logs'}, 'value': 2},
         ])
+        self.assertEqual(len(list(messages)), 0)
+        self.assertTrue(messages.closed.is_set())
+        with self.assertRaises(ValueError):
+            self.fb.stream('logs', max_size=0)
+
+    @patch('paho.mqtt.client.Client')
+    def test_stream_async(self, mock_mqtt):
+        '''Test streaming messages with an async iterator'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            topic = 'bot/device_0/from_device'
+            payload = '{"kind": "rpc_ok"}'
+
+        async def consume():
+            received = []
+            with self.fb.stream('from_device', duration=1) as messages:
+                mock_client.on_message('', '', MockMessage())
+                async for message in messages:
+                    received.append(message)
+                    break
+            return received[0]
+        message = asyncio.run(consume())
+        self.assertEqual(message['content'], {'kind': 'rpc_ok'})
+        self.assertEqual(self.fb.broker.subscribers, {})
+
+        async def consume_all():
+            with self.fb.stream('from_device', duration=0.05) as messages:
+                return [message async for message in messages]
+        self.assertEqual(asyncio.run(consume_all()), [])
+
+    @patch('paho.mqtt.client.Client')
+    def test_broker_session(self, mock_mqtt):
+        '''Test commands waiting on persistent session subscriptions'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+
+        def respond(_topic, payload):
+            '''Respond to published commands'''
+            rpc = json.loads(payload)
+            if rpc['body'][0]['kind'] == 'read_status':
+                mock_client.on_message('', '', MockMessage(
+                    'bot/device_0/status', {'location_data': {'position': {'x': 1}}}))
+                return
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/from_device',
+                {'kind': 'rpc_ok', 'args': {'label': rpc['args']['label']}}))
+        mock_client.publish.side_effect = respond
+        self.fb.start_broker_session()
+        self.assertEqual(mock_client.subscribe.mock_calls, [
+            call('bot/device_0/from_device'),
+            call('bot/device_0/status'),
+            call('bot/device_0/logs'),
+        ])
+        self.fb.unlock()
+        self.assertIsNone(self.fb.state.error)
+        self.fb.e_stop()
+        self.assertIsNone(self.fb.state.error)
+        self.assertEqual(self.fb.read_status('location_data.position.x'), 1)
+        self.assertEqual(mock_client.publish.call_count, 3)
+        self.assertEqual(mock_client.subscribe.call_count, 3)
+        mock_client.loop_stop.assert_not_called()
+        self.assertEqual(self.fb.broker.waiters, [])
+
+        # The last response stays, and test labels are all the same
+        self.assertEqual(len(self.fb.state.last_messages['from_device']), 1)
+        self.fb.state.last_messages['from_device'] = []
+        mock_client.publish.side_effect = None
+        self.fb.set_timeout(0.1)
+        self.fb.e_stop()
+        self.assertEqual(self.fb.state.error, 'Timed out waiting for RPC response.')
+        self.assertEqual(self.fb.broker.waiters, [])
+
+        self.fb.end_broker_session()
+        self.assertIsNone(self.fb.state.broker_session)
+        self.assertEqual(mock_client.unsubscribe.call_count, 3)
+        mock_client.loop_stop.assert_called_once()
+
+    @patch('paho.mqtt.client.Client')
+    def test_broker_reconnect_replay(self, mock_mqtt):
+        '''Test resubscribing and resending a command after reconnecting'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            topic = 'bot/device_0/from_device'
+            payload = json.dumps({'kind': 'rpc_ok', 'args': {'label': 'test'}})
+
+        def reconnect():
+            '''Drop and restore the connection'''
+            mock_client.on_disconnect(None, None, 1)
+            mock_client.on_disconnect(None, None, 1)
+            mock_client.on_connect(None, None, {}, 0)
+
+        def publish(_topic, payload):
+            '''Fail the first publish, then respond'''
+            if mock_client.publish.call_count == 1:
+                threading.Timer(0.05, reconnect).start()
+                return Mock(rc=4)
+            mock_client.on_message('', '', MockMessage())
+            return Mock(rc=0)
+        mock_client.publish.side_effect = publish
+        self.fb.start_broker_session()
+        mock_client.reconnect_delay_set.assert_called_once_with(
+            min_delay=1, max_delay=60)
+        # First connection
+        mock_client.on_connect(None, None, {}, 0)
+        self.assertNotIn('broker_reconnects_total', self.fb.get_metrics()['counters'])
+        self.fb.set_timeout(5)
+        self.fb.write_pin(13, 1)
+        self.assertIsNone(self.fb.state.error)
+        self.assertEqual(mock_client.publish.call_count, 2)
+        self.assertEqual(mock_client.subscribe.call_count, 6)
+        self.assertEqual(mock_client.subscribe.mock_calls[3:], [
+            call('bot/device_0/from_device'),
+            call('bot/device_0/logs'),
+            call('bot/device_0/status'),
+        ])
+        counters = self.fb.get_metrics()['counters']
+        self.assertEqual(counters['broker_disconnects_total'][0]['value'], 1)
+        self.assertEqual(counters['broker_reconnects_total'][0]['value'], 1)
+        self.assertIn('broker_downtime_seconds_total', counters)
+        self.assertEqual(counters['broker_rpc_replays_total'], [
+            {'labels': {'kind': 'write_pin'}, 'value': 1}])
+        self.assertEqual(self.fb.broker.in_flight, {})
+
+    @patch('paho.mqtt.client.Client')
+    def test_broker_disconnect_fails_in_flight(self, mock_mqtt):
+        '''Test failing sent commands when the connection drops'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        def publish(_topic, payload):
+            '''Drop the connection after sending'''
+            self.assertIn(b'write_pin', payload)
+            threading.Timer(
+                0.05, mock_client.on_disconnect, args=(None, None, 1)).start()
+            return Mock(rc=0)
+        mock_client.publish.side_effect = publish
+        self.fb.set_timeout(5)
+        start = time.monotonic()
+        self.fb.write_pin(13, 1)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.fb.state.error, 'Lost connection to message broker.')
+        counters = self.fb.get_metrics()['counters']
+        self.assertEqual(counters['broker_rpc_failures_total'], [
+            {'labels': {'kind': 'write_pin'}, 'value': 1}])
+        self.assertEqual(self.fb.peripherals.broker.failed_labels, set())
+        # Waiting on a session subscription
+        self.fb.start_broker_session()
+        start = time.monotonic()
+        self.fb.write_pin(13, 1)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(self.fb.state.error, 'Lost connection to message broker.')
+        self.assertEqual(self.fb.broker.waiters, [])
+        self.fb.end_broker_session()
+
+    @patch('paho.mqtt.client.Client')
+    def test_decode_after_filter(self, mock_mqtt):
+        '''Test only decoding messages that will be read'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = payload
+        archive = []
+        decoded = []
+        subscription_id = self.fb.subscribe(
+            '#', lambda topic, payload: archive.append(payload), raw=True)
+        self.fb.subscribe('logs', lambda topic, payload: decoded.append(payload))
+        mock_client.on_message('', '', MockMessage('bot/device_0/status', b'{invalid'))
+        mock_client.on_message('', '', MockMessage('bot/device_0/logs', b'{"message": "log"}'))
+        self.assertEqual(archive, [b'{invalid', b'{"message": "log"}'])
+        self.assertEqual(decoded, [{'message': 'log'}])
+        self.fb.unsubscribe(subscription_id)
+        mock_client.on_message('', '', MockMessage('bot/device_0/logs', b'{"message": "log"}'))
+        self.assertEqual(len(archive), 2)
+        self.assertEqual(len(decoded), 2)
+
+    @patch('paho.mqtt.client.Client')
+    def test_e_stop_now(self, mock_mqtt):
+        '''Test e-stop via the pre-connected control channel'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            topic = 'bot/device_0/from_device'
+            payload = json.dumps({'kind': 'rpc_ok', 'args': {'label': 'test'}})
+        self.fb.open_control_channel()
+        mock_client.subscribe.assert_called_once_with('bot/device_0/from_device')
+        with patch('time.sleep') as mock_sleep:
+            future = self.fb.e_stop_now(timeout=5)
+        mock_sleep.assert_not_called()
+        mock_client.publish.assert_called_once_with(
+            'bot/device_0/from_clients',
+            payload=json.dumps({
+                'kind': 'rpc_request',
+                'args': {'label': 'test', 'priority': 9000},
+                'body': [{'kind': 'emergency_lock', 'args': {}}],
+            }, separators=(',', ':')).encode(),
+            qos=1)
+        self.assertFalse(future.done())
+        mock_client.on_message('', '', MockMessage())
+        self.assertEqual(future.result(1), {'kind': 'rpc_ok', 'args': {'label': 'test'}})
+        histograms = self.fb.get_metrics()['histograms']
+        self.assertEqual(histograms['broker_rpc_seconds'], [{
+            'labels': {'kind': 'emergency_lock'},
+            'count': 1,
+            'sum': histograms['broker_rpc_seconds'][0]['sum'],
+            'buckets': histograms['broker_rpc_seconds'][0]['buckets'],
+        }])
+
+        timed_out = self.fb.e_stop_now(timeout=0.05)
+        self.assertIsInstance(timed_out.exception(1), TimeoutError)
+        self.assertEqual(self.fb.state.control_channel.waiters, [])
+        self.assertEqual(mock_mqtt.call_count, 1)
+        self.fb.close_control_channel()
+        self.assertIsNone(self.fb.state.control_channel)
+        mock_client.disconnect.assert_called_once()
+
+    @patch('paho.mqtt.client.Client')
+    def test_publish_now_dry_run_and_label(self, mock_mqtt):
+        '''Test control channel commands: dry run and generated labels'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        self.fb.state.dry_run = True
+        future = self.fb.broker.publish_now({'kind': 'read_status', 'args': {}})
+        self.assertIsNone(future.result(0))
+        mock_mqtt.assert_not_called()
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, args):
+                self.topic = 'bot/device_0/from_device'
+                self.payload = json.dumps({'kind': 'rpc_ok', 'args': args})
+        self.fb.state.dry_run = False
+        self.fb.state.test_env = False
+        self.fb.set_timeout(5)
+        future = self.fb.broker.publish_now({'kind': 'read_status', 'args': {}})
+        label = json.loads(mock_client.publish.call_args.kwargs['payload'])['args']['label']
+        self.assertEqual(len(label), 32)
+        mock_client.on_message('', '', MockMessage('no label'))
+        mock_client.on_message('', '', Mock(topic='bot/device_0/from_device', payload='[]'))
+        self.assertFalse(future.done())
+        mock_client.on_message('', '', MockMessage({'label': label}))
+        self.assertEqual(future.result(1), {'kind': 'rpc_ok', 'args': {'label': label}})
+        self.fb.close_control_channel()
+
+    @patch('paho.mqtt.client.Client')
+    def test_listen_shared_messages(self, mock_mqtt):
+        '''Test listeners storing each message once, only from their channel'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        self.fb.state.test_env = False
+        self.fb.set_timeout(5)
+        self.fb.state.last_messages['logs'] = [{'topic': 'old', 'content': {}}]
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, topic, payload):
+                self.topic = topic
+                self.payload = json.dumps(payload)
+
+        def deliver(_seconds):
+            '''Deliver messages to two listeners of the same channel'''
+            broker = self.fb.broker
+            broker.handlers['other'] = broker.handlers[threading.get_ident()]
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/status', {'uptime': 1}))
+            mock_client.on_message('', '', MockMessage(
+                'bot/device_0/logs', {'message': 'log'}))
+            del broker.handlers['other']
+        with patch('time.sleep', side_effect=deliver):
+            self.fb.listen('logs')
+        self.assertEqual(self.fb.state.last_messages['logs'], [{
+            'topic': 'bot/device_0/logs',
+            'content': {'message': 'log'},
+        }])
+        self.assertNotIn('status', self.fb.state.last_messages)
+
+    def test_listen_start_during_stop(self):
+        '''Test the network loop runs for a listener started while another stops'''
+
+        class MockClient:
+            '''Mock client with a network loop that takes time to stop'''
+            def __init__(self):
+                self.running = False
+                self.stopping = threading.Event()
+
+            def loop_start(self):
+                '''Start the loop unless it is still running'''
+                self.running = True
+
+            def loop_stop(self):
+                '''Stop the loop after a delay'''
+                self.stopping.set()
+                time.sleep(0.2)
+                self.running = False
+
+            def subscribe(self, _topic):
+                '''Subscribe'''
+        mock_client = MockClient()
+        broker = self.fb.broker
+        broker.client = mock_client
+        stopping = threading.Thread(target=broker.stop_listen)
+        stopping.start()
+        mock_client.stopping.wait(1)
+        broker.start_listen('logs')
+        stopping.join()
+        self.assertIn(threading.get_ident(), broker.handlers)
+        self.assertTrue(mock_client.running)
+        broker.stop_listen()
+        self.assertFalse(mock_client.running)
+
+    @patch('paho.mqtt.client.Client')
+    def test_broker_session_other_channels(self, mock_mqtt):
+        '''Test commands answered on channels outside the session'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            topic = 'bot/device_0/status'
+            payload = json.dumps({'uptime': 1})
+        mock_client.publish.side_effect = lambda *_args, **_kwargs: mock_client.on_message(
+            '', '', MockMessage())
+        self.fb.start_broker_session(channels=['from_device'])
+        self.assertEqual(self.fb.read_status(), {'uptime': 1})
+        self.assertEqual(self.fb.broker.waiters, [])
+        self.fb.broker.disconnect()
+        self.assertIsNone(self.fb.state.broker_session)
 
     @patch('paho.mqtt.client.Client')
     def test_listen_with_filters(self, mock_mqtt):
         '''Test listen command with filters'''
         mock_client = Mock()
         mock_mqtt.return_value = mock_client
-        self.fb.listen(message_options={'filters': {
-            'topic': 'sync/Point',
-            'content': {'body.pointerType': 'Plant'}}})
 
         class MockMessageMiss:
             '''Mock message class'''
             topic = 'bot/device_0/topic'
             payload = '{"message": "test message"}'
-        mock_client.on_message('', '', MockMessageMiss())
 
         class MockMessageAlsoMiss:
             '''Mock message class'''
             topic = 'bot/device_0/sync/Point/123'
             payload = json.dumps({'body': {'pointerType': 'Weed'}})
-        mock_client.on_message('', '', MockMessageAlsoMiss())
 
         class MockMessageMatch:
             '''Mock message class'''
             topic = 'bot/device_0/sync/Point/1234'
             payload = json.dumps({'body': {'pointerType': 'Plant'}})
-        mock_client.on_message('', '', MockMessageMatch())
+
+        def deliver(_topic):
+            '''Deliver messages once subscribed'''
+            mock_client.on_message('', '', MockMessageMiss())
+            mock_client.on_message('', '', MockMessageAlsoMiss())
+            mock_client.on_message('', '', MockMessageMatch())
+        mock_client.subscribe.side_effect = deliver
+        self.fb.listen(message_options={'filters': {
+            'topic': 'sync/Point',
+            'content': {'body.pointerType': 'Plant'}}})
         mock_client.username_pw_set.assert_called_once_with(
             username='device_0',
             password='encoded_token_value')
@@ -794,7 +1826,7 @@ class TestFarmbot(unittest.TestCase):
             {'x': 1, 'y': 11},
             {'extra': {'idx': 2}, 'x': 2, 'y': 12},
             {'extra': {'idx': 3}, 'x': 3, 'y': 13},
-            {'x': 4, 'y': 14},
+            {'extra': None, 'x': 4, 'y': 14},
         ])
         self.assertEqual(self.fb.state.last_messages['status_excerpt'], [
             {'x': 0, 'y': 10, 'z': 100},
@@ -889,7 +1921,7 @@ class TestFarmbot(unittest.TestCase):
         mock_client = Mock()
         mock_mqtt.return_value = mock_client
         mock_response = Mock()
-        mock_response.json.return_value = mock_api_response
+        mock_response.content = json_content(mock_api_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -919,7 +1951,7 @@ class TestFarmbot(unittest.TestCase):
         mock_client.loop_start.assert_called()
         mock_client.publish.assert_called_once_with(
             'bot/device_0/from_clients',
-            payload=json.dumps(expected_payload))
+            payload=json.dumps(expected_payload, separators=(',', ':')).encode())
         if not error:
             self.assertNotEqual(
                 self.fb.state.error,
@@ -1291,10 +2323,10 @@ class TestFarmbot(unittest.TestCase):
         mock_client = Mock()
         mock_mqtt.return_value = mock_client
         mock_response = Mock()
-        mock_response.json.return_value = [
+        mock_response.content = json_content([
             {'label': 'Peripheral 4', 'id': 123},
             {'label': 'Peripheral 5', 'id': 456}
-        ]
+        ])
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -1618,6 +2650,211 @@ class TestFarmbot(unittest.TestCase):
             self.fb.state.error,
             "ERROR: 'My Sequence' not in sequences: ['Water'].")
 
+    def helper_plan(self):
+        '''Record a plan with two steps'''
+        with self.fb.plan('Water') as plan:
+            self.fb.write_pin(7, 1)
+            self.fb.wait(100)
+        return plan
+
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def test_plan_record(self, mock_mqtt, mock_request):
+        '''Test plan: commands are recorded instead of sent'''
+        plan = self.helper_plan()
+        mock_mqtt.assert_not_called()
+        mock_request.assert_not_called()
+        self.assertEqual(plan.body, [
+            {'kind': 'write_pin', 'args': {
+                'pin_value': 1, 'pin_mode': 0, 'pin_number': 7}},
+            {'kind': 'wait', 'args': {'milliseconds': 100}},
+        ])
+        self.assertIsNone(self.fb.state.recording)
+        self.assertEqual(plan.sequence_name(), f'Water [{plan.content_hash()[:8]}]')
+
+    @patch('paho.mqtt.client.Client')
+    def test_plan_record_unrecordable(self, mock_mqtt):
+        '''Test plan: priority commands are sent and reads raise'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        with self.fb.plan('Water') as plan:
+            self.fb.e_stop()
+            self.fb.unlock()
+            with self.assertRaises(ValueError) as cm:
+                self.fb.get_xyz()
+            self.assertEqual(
+                cm.exception.args[0],
+                "Can't record read_status: its response is read when sent.")
+            with self.assertRaises(ValueError):
+                self.fb.read_pin(13)
+        self.assertEqual(plan.body, [])
+        kinds = [json.loads(c.kwargs['payload'])['body'][0]['kind']
+                 for c in mock_client.publish.mock_calls]
+        self.assertEqual(kinds, ['emergency_lock', 'emergency_unlock'])
+        self.assertIsNone(self.fb.state.recording)
+
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def test_plan_run(self, mock_mqtt, mock_request):
+        '''Test plan: upload once and execute by id'''
+        plan = self.helper_plan()
+        responses = {'GET': [{'name': 'Other', 'id': 1}], 'POST': {'id': 123}}
+
+        def respond(method, **_kwargs):
+            response = Mock()
+            response.status_code = 200
+            response.text = 'text'
+            response.content = json_content(responses[method])
+            return response
+        mock_request.side_effect = respond
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        for _ in range(2):
+            plan.run()
+        methods = [c.kwargs['method'] for c in mock_request.call_args_list]
+        self.assertEqual(methods, ['GET', 'POST'])
+        posted = mock_request.call_args_list[1].kwargs['json']
+        self.assertEqual(posted['name'], plan.sequence_name())
+        self.assertEqual(posted['body'], plan.body)
+        self.assertEqual(mock_client.publish.call_count, 2)
+        payload = mock_client.publish.call_args.kwargs['payload']
+        self.assertEqual(json.loads(payload)['body'], [
+            {'kind': 'execute', 'args': {'sequence_id': 123}}])
+
+    @patch('requests.request')
+    def test_plan_upload_existing(self, mock_request):
+        '''Test plan upload: sequence already uploaded'''
+        plan = self.helper_plan()
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = json_content([
+            {'name': plan.sequence_name(), 'id': 456}])
+        mock_request.return_value = mock_response
+        self.assertEqual(plan.upload(), 456)
+        mock_request.assert_called_once()
+
+    @patch('requests.request')
+    def test_plan_upload_error(self, mock_request):
+        '''Test plan upload: API error'''
+        plan = self.helper_plan()
+        mock_response = Mock()
+        mock_response.status_code = 404
+        mock_response.reason = 'Not Found'
+        mock_response.text = 'text'
+        mock_response.content = b'not json'
+        mock_request.return_value = mock_response
+        self.assertIsNone(plan.upload())
+        self.assertEqual(self.fb.state.plan_ids, {})
+
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def test_plan_run_error(self, mock_mqtt, mock_request):
+        '''Test plan run: upload error'''
+        plan = self.helper_plan()
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = json_content([{'name': 'Other', 'id': 1}])
+        mock_request.side_effect = [mock_response, Mock(
+            status_code=500, text='error', content=b'error')]
+        plan.run()
+        mock_mqtt.assert_not_called()
+
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def helper_handle(self, calls, api_response, *args):
+        '''Run handle calls, returning API requests and published messages'''
+        mock_mqtt, mock_request = args
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = json_content(api_response)
+        mock_request.return_value = mock_response
+        calls()
+        published = [json.loads(c.kwargs['payload'])['body'][0]
+                     for c in mock_client.publish.call_args_list]
+        return mock_request.call_count, published
+
+    def test_peripheral_handle(self):
+        '''Test peripheral handle: one lookup for repeated calls'''
+        handle = self.fb.peripheral('New Peripheral')
+
+        def calls():
+            handle.write(1)
+            handle.write(255, 'analog')
+            handle.toggle()
+        request_count, published = self.helper_handle(
+            calls, [{'label': 'New Peripheral', 'id': 123, 'mode': 0}])
+        self.assertEqual(request_count, 1)
+        pin = {
+            'kind': 'named_pin',
+            'args': {'pin_type': 'Peripheral', 'pin_id': 123},
+        }
+        self.assertEqual(published, [
+            {'kind': 'write_pin', 'args': {
+                'pin_value': 1, 'pin_mode': 0, 'pin_number': pin}},
+            {'kind': 'write_pin', 'args': {
+                'pin_value': 255, 'pin_mode': 1, 'pin_number': pin}},
+            {'kind': 'toggle_pin', 'args': {'pin_number': pin}},
+        ])
+
+    def test_sensor_handle(self):
+        '''Test sensor handle: one lookup for repeated reads'''
+        handle = self.fb.sensor('Tool Verification')
+
+        def calls():
+            handle.read()
+            handle.read()
+        request_count, published = self.helper_handle(
+            calls, [{'label': 'Tool Verification', 'id': 123, 'mode': 0}])
+        self.assertEqual(request_count, 1)
+        self.assertEqual(published, [{
+            'kind': 'read_pin',
+            'args': {
+                'pin_mode': 0,
+                'label': '---',
+                'pin_number': {
+                    'kind': 'named_pin',
+                    'args': {'pin_type': 'Sensor', 'pin_id': 123},
+                },
+            },
+        }] * 2)
+
+    def test_sequence_handle(self):
+        '''Test sequence handle: one lookup for repeated runs'''
+        handle = self.fb.sequence_handle('My Sequence')
+
+        def calls():
+            handle.run()
+            handle.run(cs_body=[])
+            handle.reset()
+            handle.run()
+        request_count, published = self.helper_handle(
+            calls, [{'name': 'My Sequence', 'id': 123}])
+        # after reset, the sequence is found in the cache
+        self.assertEqual(request_count, 1)
+        self.assertEqual(published, [
+            {'kind': 'execute', 'args': {'sequence_id': 123}},
+            {'kind': 'execute', 'args': {'sequence_id': 123}, 'body': []},
+            {'kind': 'execute', 'args': {'sequence_id': 123}},
+        ])
+
+    def test_handle_not_found(self):
+        '''Test handles: resource not found'''
+        def calls():
+            self.fb.peripheral('Water').write(1)
+            self.fb.peripheral('Water').toggle()
+            self.fb.sensor('Water').read()
+            self.fb.sequence_handle('Water').run()
+        request_count, published = self.helper_handle(calls, [])
+        self.assertEqual(request_count, 4)
+        self.assertEqual(published, [])
+        self.assertEqual(
+            self.fb.state.error, "ERROR: 'Water' not in sequences: [].")
+
     def test_take_photo(self):
         '''Test take_photo command'''
         def exec_command():
@@ -1876,7 +3113,7 @@ class TestFarmbot(unittest.TestCase):
                 **tray_data,
             },
         ]
-        mock_response.json.return_value = mock_api_response
+        mock_response.content = json_content(mock_api_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -1887,13 +3124,11 @@ class TestFarmbot(unittest.TestCase):
                 url='https://my.farm.bot/api/tools',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
             call(
                 method='GET',
                 url='https://my.farm.bot/api/points',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
         ])
         self.assertEqual(cell, expected_xyz, kwargs)
 
@@ -1964,7 +3199,7 @@ class TestFarmbot(unittest.TestCase):
                 **tray_data,
             },
         ]
-        mock_response.json.return_value = mock_api_response
+        mock_response.content = json_content(mock_api_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -1977,13 +3212,11 @@ class TestFarmbot(unittest.TestCase):
                 url='https://my.farm.bot/api/tools',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
             call(
                 method='GET',
                 url='https://my.farm.bot/api/points',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
         ])
 
     def test_get_seed_tray_cell_invalid_cell_name(self):
@@ -2007,7 +3240,7 @@ class TestFarmbot(unittest.TestCase):
         '''Test get_seed_tray_cell: no seed tray'''
         mock_response = Mock()
         mock_api_response = []
-        mock_response.json.return_value = mock_api_response
+        mock_response.content = json_content(mock_api_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -2018,7 +3251,6 @@ class TestFarmbot(unittest.TestCase):
                 url='https://my.farm.bot/api/tools',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
         ])
         self.assertIsNone(result)
 
@@ -2031,7 +3263,7 @@ class TestFarmbot(unittest.TestCase):
             'name': 'Seed Tray',
             'pointer_type': '',  # not an actual data field,
         }]
-        mock_response.json.return_value = mock_api_response
+        mock_response.content = json_content(mock_api_response)
         mock_response.status_code = 200
         mock_response.text = 'text'
         mock_request.return_value = mock_response
@@ -2042,7 +3274,6 @@ class TestFarmbot(unittest.TestCase):
                 url='https://my.farm.bot/api/tools',
                 **REQUEST_KWARGS,
             ),
-            call().json(),
         ])
         self.assertIsNone(result)
 
@@ -2250,6 +3481,539 @@ class TestFarmbot(unittest.TestCase):
             self.fb.state.error,
             "ERROR: 'Watering Sequence' not in sequences: [].")
 
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def test_if_statement_resolves_endpoints_once(self, mock_mqtt, mock_request):
+        '''Test if_statement command: each endpoint downloaded once'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        records = {
+            'peripherals': [{'label': 'Lights', 'id': 1}],
+            'sequences': [
+                {'name': 'Watering Sequence', 'id': 2},
+                {'name': 'Drying Sequence', 'id': 3},
+            ],
+        }
+
+        def respond(url, **_kwargs):
+            response = Mock()
+            response.status_code = 200
+            response.text = 'text'
+            response.content = json_content(records[url.split('/')[-1]])
+            return response
+        mock_request.side_effect = respond
+        self.fb.if_statement(
+            'Lights', 'is', 0,
+            'Watering Sequence', 'Drying Sequence',
+            named_pin_type='Peripheral')
+        urls = sorted(c.kwargs['url'] for c in mock_request.call_args_list)
+        self.assertEqual(urls, [
+            'https://my.farm.bot/api/peripherals',
+            'https://my.farm.bot/api/sequences',
+        ])
+        payload = json.loads(mock_client.publish.call_args.kwargs['payload'])
+        args = payload['body'][0]['args']
+        self.assertEqual(args['lhs']['args']['pin_id'], 1)
+        self.assertEqual(args['_then']['args']['sequence_id'], 2)
+        self.assertEqual(args['_else']['args']['sequence_id'], 3)
+
+    @patch('requests.request')
+    def test_resolve_many_cached(self, mock_request):
+        '''Test resolve_many: cached endpoints are not downloaded'''
+        self.fb.state.save_cache('sequences', [{'name': 'Mow', 'id': 1}])
+        resources = self.fb.info.resolve_many([('sequences', 'Mow', 'name')])
+        self.assertEqual(resources, [{'name': 'Mow', 'id': 1}])
+        mock_request.assert_not_called()
+
+    @patch('requests.request')
+    def test_resolve_many_synced_and_mirrored(self, mock_request):
+        '''Test resolve_many: expired records synced, mirrored records not downloaded'''
+        records = [
+            {'id': 1, 'label': 'Lights', 'updated_at': 'a'},
+            {'id': 2, 'label': 'Water', 'updated_at': 'b'},
+        ]
+        manifest = {'peripherals': [[r['id'], r['updated_at']] for r in records]}
+        self.helper_sync_cache(mock_request, manifest, records)
+        self.fb.state.save_cache('peripherals', records[:1])
+        self.fb.state.expire_cache('peripherals')
+        with tempfile.TemporaryDirectory() as directory:
+            self.fb.set_mirror(os.path.join(directory, 'mirror.sqlite3'))
+            self.fb.state.mirror.sync('sequences', [{'id': 3, 'name': 'Mow'}])
+            resources = self.fb.info.resolve_many([
+                ('peripherals', 'Water', 'label'),
+                ('sequences', 'Mow', 'name'),
+            ])
+            self.fb.state.mirror.close()
+        self.assertEqual([resource['id'] for resource in resources], [2, 3])
+        urls = [c.kwargs['url'] for c in mock_request.call_args_list]
+        self.assertEqual(urls, [
+            'https://my.farm.bot/api/device/sync',
+            'https://my.farm.bot/api/peripherals/2',
+        ])
+
+    @patch('requests.request')
+    def test_resolve_many_error(self, mock_request):
+        '''Test resolve_many: download error'''
+        mock_response = Mock()
+        mock_response.status_code = 404
+        mock_response.reason = 'Not Found'
+        mock_response.text = 'text'
+        mock_response.content = b'not json'
+        mock_request.return_value = mock_response
+        resources = self.fb.info.resolve_many([
+            ('sequences', 'Mow', 'name'),
+            ('peripherals', 'Lights', 'label'),
+        ])
+        self.assertIsNone(resources)
+        self.assertEqual(
+            self.fb.state.error,
+            'CLIENT ERROR 404: The specified endpoint does not exist. (text)')
+        self.assertEqual(self.fb.state.resource_cache, {})
+
+    @patch('requests.Session.request')
+    def test_preload(self, mock_request):
+        '''Test preload: endpoints downloaded concurrently with a session'''
+        def respond(url, **_kwargs):
+            endpoint = url.split('/')[-1]
+            response = Mock()
+            response.status_code = 200
+            response.text = 'text'
+            response.content = json_content({
+                'fbos_config': {'safe_height': 100},
+            }.get(endpoint, [{'name': endpoint}]))
+            return response
+        mock_request.side_effect = respond
+        self.assertTrue(self.fb.preload())
+        self.assertEqual(mock_request.call_count, 7)
+        self.assertEqual(self.fb.state.fetch_cache('tools'), [{'name': 'tools'}])
+        self.assertEqual(self.fb.safe_z(), 100)
+        self.assertEqual(mock_request.call_count, 7)
+        self.assertTrue(self.fb.preload(['tools']))
+        self.assertEqual(mock_request.call_count, 7)
+        self.assertIsNotNone(self.fb.state.session)
+
+    @patch('requests.request')
+    def test_mirror(self, mock_request):
+        '''Test local mirror: sync, lookups, queries and warm start'''
+        records = {
+            'peripherals': [
+                {'id': 1, 'label': 'Lights', 'mode': 0, 'updated_at': 'a'},
+                {'id': 2, 'label': 'Water', 'mode': 0, 'updated_at': 'a'},
+            ],
+            'points': [
+                {'id': 3, 'name': 'Weed', 'pointer_type': 'Weed',
+                 'x': 10, 'y': 20, 'updated_at': 'a'},
+                {'id': 4, 'name': 'Carrot', 'pointer_type': 'Plant',
+                 'x': 200, 'y': 20, 'updated_at': 'a'},
+            ],
+        }
+
+        def respond(url, **_kwargs):
+            response = Mock()
+            response.status_code = 200
+            response.text = 'text'
+            path = url.split('/api/')[-1]
+            if path == 'device/sync':
+                response.content = json_content({
+                    endpoint: [[r['id'], r['updated_at']] for r in endpoint_records]
+                    for endpoint, endpoint_records in records.items()})
+            elif path in records:
+                response.content = json_content(records[path])
+            else:
+                endpoint, record_id = path.split('/')
+                response.content = json_content([
+                    r for r in records[endpoint] if r['id'] == int(record_id)][0])
+            return response
+        mock_request.side_effect = respond
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'mirror.sqlite3')
+            self.fb.set_mirror(path)
+            changes = self.fb.sync_mirror(['peripherals', 'points'])
+            self.assertEqual(changes, {
+                'peripherals': {'updated': 2, 'removed': 0},
+                'points': {'updated': 2, 'removed': 0},
+            })
+            records['peripherals'] = [
+                {'id': 1, 'label': 'Lights', 'mode': 1, 'updated_at': 'b'}]
+            mock_request.reset_mock()
+            changes = self.fb.sync_mirror(['peripherals', 'points'])
+            self.assertEqual(changes, {
+                'peripherals': {'updated': 1, 'removed': 1},
+                'points': {'updated': 0, 'removed': 0},
+            })
+            # Only the manifest and changed records are downloaded
+            urls = [c.kwargs['url'] for c in mock_request.call_args_list]
+            self.assertEqual(urls, [
+                'https://my.farm.bot/api/device/sync',
+                'https://my.farm.bot/api/peripherals/1',
+            ])
+            mock_request.reset_mock()
+
+            self.fb.set_mirror(path)
+            peripheral = self.fb.info.get_resource_by_name('peripherals', 'Lights')
+            self.assertEqual(peripheral['mode'], 1)
+            weeds = self.fb.query_mirror('points', pointer_type='Weed', x=(0, 100))
+            self.assertEqual([point['id'] for point in weeds], [3])
+            self.assertEqual(self.fb.query_mirror('points', name='Carrot', y=20)[0]['id'], 4)
+            # Filters on keys without a column
+            self.assertEqual(self.fb.query_mirror('points', radius=(0, 10)), [])
+            self.assertEqual(self.fb.query_mirror('points', plant_stage='planted'), [])
+            mock_request.assert_not_called()
+            # Records added since the last sync are downloaded
+            records['points'].append(
+                {'id': 5, 'name': 'Lights', 'pointer_type': 'GenericPointer',
+                 'x': 0, 'y': 0, 'updated_at': 'b'})
+            found = self.fb.info.get_resource_by_name('points', 'Lights', 'name')
+            self.assertEqual(found['id'], 5)
+            mock_request.assert_called_once()
+            mock_request.reset_mock()
+            missing = self.fb.info.get_resource_by_name('peripherals', 'Fan')
+            self.assertIsNone(missing)
+            self.assertEqual(
+                self.fb.state.error,
+                "ERROR: 'Fan' not in peripherals: ['Lights'].")
+            mock_request.assert_called_once()
+            self.fb.state.mirror.close()
+
+    @patch('requests.request')
+    def test_sync_mirror_errors(self, mock_request):
+        '''Test sync_mirror: manifest, record and endpoint errors'''
+        error_response = Mock()
+        error_response.status_code = 404
+        error_response.reason = 'Not Found'
+        error_response.text = 'text'
+        error_response.content = b'not json'
+        manifest_response = Mock()
+        manifest_response.status_code = 200
+        manifest_response.text = 'text'
+        manifest_response.content = json_content(None)
+
+        def respond(url, **_kwargs):
+            if url.endswith('device/sync') and manifest_response.content != b'null':
+                return manifest_response
+            return error_response
+        mock_request.side_effect = respond
+        with tempfile.TemporaryDirectory() as directory:
+            self.fb.set_mirror(os.path.join(directory, 'mirror.sqlite3'))
+            self.fb.state.mirror.sync('peripherals', [{'id': 1, 'updated_at': 'a'}])
+            # manifest error
+            self.assertIsNone(self.fb.sync_mirror(['peripherals']))
+            # record error
+            manifest_response.content = json_content({'peripherals': [[1, 'b']]})
+            self.assertIsNone(self.fb.sync_mirror(['peripherals']))
+            # endpoint error
+            manifest_response.content = json_content({
+                'peripherals': [[i, 'b'] for i in range(20)]})
+            self.assertIsNone(self.fb.sync_mirror(['peripherals']))
+            self.assertEqual(
+                self.fb.state.mirror.versions('peripherals'), [{'id': 1, 'updated_at': 'a'}])
+            self.fb.state.mirror.close()
+
+    def test_sync_mirror_without_mirror(self):
+        '''Test sync_mirror and query_mirror: no mirror set'''
+        self.assertIsNone(self.fb.sync_mirror())
+        self.assertEqual(
+            self.fb.state.error,
+            'ERROR: No local mirror, please call `set_mirror` first.')
+        self.fb.state.error = None
+        self.assertIsNone(self.fb.query_mirror('points', x=(0, 100)))
+        self.assertEqual(
+            self.fb.state.error,
+            'ERROR: No local mirror, please call `set_mirror` first.')
+
+    def helper_sync_cache(self, mock_request, manifest, records):
+        '''Respond to manifest and record requests'''
+        def respond(url, **_kwargs):
+            response = Mock()
+            response.status_code = 200
+            response.text = 'text'
+            path = url.split('/api/')[-1]
+            if path == 'device/sync':
+                response.content = json_content(manifest)
+            elif path == 'peripherals':
+                response.content = json_content(records)
+            else:
+                record_id = int(path.split('/')[-1])
+                response.content = json_content([
+                    r for r in records if r['id'] == record_id][0])
+            return response
+        mock_request.side_effect = respond
+
+    @patch('requests.request')
+    def test_sync_cache(self, mock_request):
+        '''Test sync_cache: only changed records downloaded'''
+        self.fb.state.save_cache('peripherals', [
+            {'id': 1, 'label': 'A', 'updated_at': 'a'},
+            {'id': 2, 'label': 'B', 'updated_at': 'a'},
+            {'id': 3, 'label': 'C', 'updated_at': 'a'},
+        ])
+        records = [
+            {'id': 1, 'label': 'A', 'updated_at': 'a'},
+            {'id': 2, 'label': 'B2', 'updated_at': 'b'},
+            {'id': 4, 'label': 'D', 'updated_at': 'b'},
+        ]
+        manifest = {'peripherals': [[r['id'], r['updated_at']] for r in records]}
+        self.helper_sync_cache(mock_request, manifest, records)
+        changes = self.fb.sync_cache()
+        self.assertEqual(changes, {'peripherals': {'updated': 2, 'removed': 1}})
+        self.assertEqual(self.fb.state.fetch_cache('peripherals'), records)
+        urls = [c.kwargs['url'] for c in mock_request.call_args_list]
+        self.assertEqual(urls, [
+            'https://my.farm.bot/api/device/sync',
+            'https://my.farm.bot/api/peripherals/2',
+            'https://my.farm.bot/api/peripherals/4',
+        ])
+
+    @patch('requests.request')
+    def test_sync_cache_many_changes(self, mock_request):
+        '''Test sync_cache: whole endpoint downloaded for many changes'''
+        self.fb.state.save_cache('peripherals', [])
+        records = [{'id': i, 'label': str(i), 'updated_at': 'a'} for i in range(20)]
+        manifest = {'peripherals': [[r['id'], r['updated_at']] for r in records]}
+        self.helper_sync_cache(mock_request, manifest, records)
+        self.fb.sync_cache(['peripherals', 'tools'])
+        self.assertEqual(self.fb.state.fetch_cache('peripherals'), records)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch('requests.request')
+    def test_get_resource_by_name_syncs_expired_cache(self, mock_request):
+        '''Test get_resource_by_name: sync records after a cache miss'''
+        self.fb.state.save_cache('peripherals', [
+            {'id': 1, 'label': 'A', 'updated_at': 'a'}])
+        self.assertIsNone(self.fb.info.get_resource_by_name('peripherals', 'B'))
+        mock_request.assert_not_called()
+        records = [
+            {'id': 1, 'label': 'A', 'updated_at': 'a'},
+            {'id': 2, 'label': 'B', 'updated_at': 'a'},
+        ]
+        manifest = {'peripherals': [[r['id'], r['updated_at']] for r in records]}
+        self.helper_sync_cache(mock_request, manifest, records)
+        resource = self.fb.info.get_resource_by_name('peripherals', 'B')
+        self.assertEqual(resource['id'], 2)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @patch('requests.request')
+    def test_sync_cache_errors(self, mock_request):
+        '''Test sync_cache: request errors'''
+        self.fb.state.save_cache('peripherals', [{'id': 1, 'updated_at': 'a'}])
+        error_response = Mock()
+        error_response.status_code = 404
+        error_response.reason = 'Not Found'
+        error_response.text = 'text'
+        error_response.content = b'not json'
+        manifest_response = Mock()
+        manifest_response.status_code = 200
+        manifest_response.text = 'text'
+        manifest_response.content = json_content(None)
+
+        def respond(url, **_kwargs):
+            if url.endswith('device/sync') and manifest_response.content != b'null':
+                return manifest_response
+            return error_response
+        mock_request.side_effect = respond
+        # manifest error
+        self.assertIsNone(self.fb.sync_cache())
+        # record error
+        manifest_response.content = json_content({'peripherals': [[1, 'b']]})
+        self.assertIsNone(self.fb.sync_cache())
+        # endpoint error
+        manifest_response.content = json_content({
+            'peripherals': [[i, 'b'] for i in range(20)]})
+        self.assertIsNone(self.fb.sync_cache())
+        self.assertEqual(
+            self.fb.state.fetch_cache('peripherals'), [{'id': 1, 'updated_at': 'a'}])
+
+    @patch('requests.request')
+    def test_get_points_table(self, mock_request):
+        '''Test get_points_table'''
+        points = [
+            {'id': 1, 'name': 'Carrot', 'pointer_type': 'Plant', 'x': 100,
+             'y': 200, 'z': 0, 'radius': 25, 'plant_stage': 'planned',
+             'openfarm_slug': 'carrot', 'meta': {'color': 'red'}},
+            {'id': 2, 'name': 'Carrot', 'pointer_type': 'Plant', 'x': 300.5,
+             'y': 200, 'z': 0, 'radius': 25, 'plant_stage': 'planted',
+             'openfarm_slug': 'carrot', 'meta': {}},
+            {'id': 3, 'name': 'Weed', 'pointer_type': 'Weed', 'x': 10,
+             'y': None, 'z': 0, 'radius': 5, 'meta': {}},
+        ]
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = json_content(points)
+        mock_request.return_value = mock_response
+        table = self.fb.get_points_table()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.to_dicts(), points)
+        self.assertEqual(table[2], points[2])
+        self.assertEqual(table.column('x'), [100, 300.5, 10])
+        self.assertEqual(table.column('y'), [200, 200, None])
+        self.assertEqual(table.column('id'), [1, 2, 3])
+        self.assertEqual(table.column('plant_stage'), ['planned', 'planted', None])
+        self.assertEqual(table.column('meta'), [{'color': 'red'}, {}, {}])
+        self.assertEqual(len(table.strings['name'].values), 2)
+        plants = table.filter(pointer_type='Plant', openfarm_slug='carrot')
+        self.assertEqual(plants.column('id'), [1, 2])
+        planted = table.filter(pointer_type='Plant', plant_stage='planted')
+        self.assertEqual(planted.to_dicts(), [points[1]])
+        self.assertEqual(len(table.filter(pointer_type='ToolSlot')), 0)
+        with self.assertRaises(ValueError) as cm:
+            table.filter(meta={})
+        self.assertEqual(
+            cm.exception.args[0],
+            "Invalid filter: meta not in "
+            "['name', 'pointer_type', 'plant_stage', 'openfarm_slug']")
+
+    @patch('requests.request')
+    def test_get_points_table_error(self, mock_request):
+        '''Test get_points_table: API error'''
+        mock_response = Mock()
+        mock_response.status_code = 404
+        mock_response.reason = 'Not Found'
+        mock_response.text = 'text'
+        mock_response.content = b'not json'
+        mock_request.return_value = mock_response
+        self.assertIsNone(self.fb.get_points_table())
+
+    def helper_export(self, mock_request, path, export_format=None):
+        '''Export streamed records'''
+        text = json.dumps([
+            {'id': 1, 'label': 'Moisture', 'value': 512, 'meta': {'a': 1}},
+            {'id': 2, 'label': 'Température', 'value': 20.5},
+            {'id': 3, 'label': None, 'value': None, 'pin': 59},
+        ], ensure_ascii=False).encode('utf-8')
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.iter_content.return_value = [
+            text[i:i + 7] for i in range(0, len(text), 7)]
+        mock_request.return_value = mock_response
+        count = self.fb.export('sensor_readings', path, export_format)
+        self.assertEqual(mock_request.call_args.kwargs['stream'], True)
+        mock_response.close.assert_called_once()
+        self.assertEqual(count, 3)
+        received = self.fb.get_metrics()['counters']['api_bytes_received_total']
+        self.assertEqual(received[0]['value'], len(text))
+
+    @patch('requests.request')
+    def test_export_csv(self, mock_request):
+        '''Test export: CSV'''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'readings.csv')
+            self.helper_export(mock_request, path)
+            with open(path, encoding='utf-8') as csv_file:
+                self.assertEqual(csv_file.read().splitlines(), [
+                    'id,label,value,meta,pin',
+                    '1,Moisture,512,"{""a"":1}",',
+                    '2,Température,20.5,,',
+                    '3,,,,59',
+                ])
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'requires numpy')
+    @patch('requests.request')
+    def test_export_npz(self, mock_request):
+        '''Test export: NumPy'''
+        import numpy
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'readings.data')
+            self.helper_export(mock_request, path, 'npz')
+            with numpy.load(path + '.npz') as data:
+                self.assertEqual(data['id'].tolist(), [1, 2, 3])
+                self.assertEqual(data['label'].tolist(), ['Moisture', 'Température', ''])
+                self.assertTrue(numpy.isnan(data['value'][2]))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'requires pyarrow')
+    @patch('requests.request')
+    def test_export_parquet(self, mock_request):
+        '''Test export: Parquet'''
+        import pyarrow.parquet
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'readings.parquet')
+            self.helper_export(mock_request, path)
+            table = pyarrow.parquet.read_table(path)
+            self.assertEqual(table.column('value').to_pylist(), [512, 20.5, None])
+
+    @patch('requests.request')
+    def test_export_npz_columns(self, mock_request):
+        '''Test export: NumPy arrays by column kind'''
+        mock_numpy = Mock()
+        with patch.dict(sys.modules, {'numpy': mock_numpy}):
+            self.helper_export(mock_request, 'readings.npz')
+        self.assertEqual(mock_numpy.array.call_args_list, [
+            call([1, 2, 3], dtype=mock_numpy.int64),
+            call(['Moisture', 'Température', ''], dtype=str),
+            call([512, 20.5, mock_numpy.nan], dtype=mock_numpy.float64),
+            call(['{"a":1}', '', ''], dtype=str),
+            call([mock_numpy.nan, mock_numpy.nan, 59], dtype=mock_numpy.float64),
+        ])
+        self.assertEqual(mock_numpy.savez.call_args.args, ('readings.npz',))
+        self.assertEqual(
+            list(mock_numpy.savez.call_args.kwargs), ['id', 'label', 'value', 'meta', 'pin'])
+
+    @patch('requests.request')
+    def test_export_parquet_columns(self, mock_request):
+        '''Test export: Arrow arrays by column kind'''
+        mock_pyarrow = Mock()
+        modules = {'pyarrow': mock_pyarrow, 'pyarrow.parquet': mock_pyarrow.parquet}
+        with patch.dict(sys.modules, modules):
+            self.helper_export(mock_request, 'readings.parquet')
+        string = mock_pyarrow.string()
+        self.assertEqual(mock_pyarrow.array.call_args_list, [
+            call([1, 2, 3]),
+            call(['Moisture', 'Température', None], type=string),
+            call([512, 20.5, None]),
+            call(['{"a":1}', None, None], type=string),
+            call([None, None, 59]),
+        ])
+        mock_pyarrow.parquet.write_table.assert_called_once_with(
+            mock_pyarrow.table.return_value, 'readings.parquet')
+
+    def test_export_missing_dependency(self):
+        '''Test export: optional dependency not installed'''
+        columns = ColumnBuilder()
+        columns.append({'id': 1})
+        with patch.dict(sys.modules, {'numpy': None, 'pyarrow': None}):
+            with self.assertRaises(ImportError) as cm:
+                columns.write('readings.npz', 'npz')
+            self.assertEqual(cm.exception.args[0], 'Exporting .npz files requires numpy.')
+            with self.assertRaises(ImportError) as cm:
+                columns.write('readings.parquet', 'parquet')
+            self.assertEqual(
+                cm.exception.args[0], 'Exporting .parquet files requires pyarrow.')
+
+    @patch('requests.request')
+    def test_export_error(self, mock_request):
+        '''Test export: API error'''
+        mock_response = Mock()
+        mock_response.status_code = 404
+        mock_response.reason = 'Not Found'
+        mock_response.text = 'text'
+        mock_response.content = b'not json'
+        mock_request.return_value = mock_response
+        self.assertIsNone(self.fb.export('sensor_readings', 'readings.csv'))
+        self.assertEqual(
+            self.fb.state.error,
+            'CLIENT ERROR 404: The specified endpoint does not exist. (text)')
+        mock_request.side_effect = requests.exceptions.Timeout
+        self.assertIsNone(self.fb.export('sensor_readings', 'readings.csv'))
+        self.assertEqual(self.fb.state.error, 'ERROR: The request timed out.')
+
+    def test_export_invalid_format(self):
+        '''Test export: invalid format'''
+        with self.assertRaises(ValueError) as cm:
+            self.fb.export('points', 'points.xlsx')
+        self.assertEqual(
+            cm.exception.args[0],
+            "Invalid format: xlsx not in ['csv', 'npz', 'parquet']")
+
+    def test_iter_json_array_invalid(self):
+        '''Test iter_json_array: invalid arrays'''
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['{"a": 1}']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[{"a": 1}, {"a"']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array(decode_chunks([b'[1, '])))
+        self.assertEqual(list(iter_json_array([' [', ']'])), [])
+
     def test_if_statement_invalid_operator(self):
         '''Test if_statement command: invalid operator'''
         def exec_command():
@@ -2360,3 +4124,389 @@ class TestFarmbot(unittest.TestCase):
         call_strings = [s.split('(')[0].strip('`') for s in call_strings]
         self.assertIn('[\n    "testing"\n]', call_strings)
         self.assertIn('test_print_status', call_strings)
+
+    @patch('paho.mqtt.client.Client')
+    @patch('builtins.print')
+    def test_print_status_nested(self, mock_print, _mock_mqtt):
+        '''Test print_status: nested calls are indented.'''
+        self.fb.set_verbosity(1)
+        self.fb.lua('return')
+        call_strings = self.helper_get_print_strings(mock_print)
+        self.assertIn('Running Lua code', call_strings)
+        self.assertIn("    Publishing to 'from_clients'", call_strings)
+
+    @patch('paho.mqtt.client.Client')
+    @patch('inspect.currentframe')
+    @patch('builtins.print')
+    def test_print_status_disabled(self, mock_print, mock_currentframe, _mock_mqtt):
+        '''Test print_status: no work done when output is disabled.'''
+        self.fb.set_verbosity(0)
+        self.fb.lua('return')
+        mock_print.assert_not_called()
+        mock_currentframe.assert_not_called()
+
+    @patch('paho.mqtt.client.Client')
+    @patch('builtins.print')
+    def test_print_status_listen(self, mock_print, mock_mqtt):
+        '''Test print_status: listen descriptions only built when shown.'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+
+        class MockMessage:
+            '''Mock message class'''
+            def __init__(self, x):
+                self.topic = 'bot/device_0/status'
+                self.payload = json.dumps({'location_data': {'x': x}})
+
+        def deliver(_topic):
+            '''Deliver messages once subscribed'''
+            for x in range(2):
+                mock_client.on_message('', '', MockMessage(x))
+        mock_client.subscribe.side_effect = deliver
+        options = {'diff_only': True, 'path': 'location_data', 'filters': {
+            'topic': 'status', 'content': {'location_data.x': 1}}}
+        with patch('farmbot.functions.broker.datetime') as mock_datetime:
+            self.fb.listen('status', 5, message_options=options)
+            mock_datetime.now.assert_not_called()
+        mock_print.assert_not_called()
+
+        self.fb.set_verbosity(1)
+        mock_client.subscribe.side_effect = deliver
+        self.fb.listen('status', 5, message_options=options)
+        call_strings = self.helper_get_print_strings(mock_print)
+        self.assertIn(
+            "Listening to message broker channel 'status' for 5 seconds"
+            " for `status` in topic and for `1` in `location_data.x`"
+            " for diffs at path `location_data`"
+            " until 1 message is received...", call_strings)
+        new_messages = [string.strip() for string in call_strings
+                        if string.strip().startswith('New message')]
+        self.assertEqual(len(new_messages), 1)
+        self.assertTrue(new_messages[0].startswith(
+            'New message location_data diff from bot/device_0/status ('))
+
+    @patch('paho.mqtt.client.Client')
+    def test_set_output_logging(self, _mock_mqtt):
+        '''Test set_output: logging.'''
+        self.fb.set_verbosity(2)
+        self.fb.set_output('logging')
+        with self.assertLogs('farmbot', level='INFO') as logs:
+            self.fb.lua('return')
+        messages = [record.getMessage() for record in logs.records]
+        self.assertTrue(messages[0].startswith("`lua(lua_code='return')`"))
+        self.assertIn('Running Lua code', messages)
+        self.assertNotIn('.', messages)
+        self.assertNotIn('', messages)
+        self.fb.state.output.logger.setLevel('WARNING')
+        with patch.object(self.fb.state.output.logger, 'log') as mock_log:
+            self.fb.lua('return')
+        mock_log.assert_not_called()
+        self.fb.state.output.logger.setLevel('NOTSET')
+
+    def test_set_output_custom(self):
+        '''Test set_output: custom output and invalid output.'''
+        output = Mock(spec=['write'])
+        self.fb.set_verbosity(1)
+        self.fb.set_output(output)
+        self.fb.state.print_status(description='testing')
+        output.write.assert_called_with('testing', end='\n')
+        self.fb.set_output('print')
+        with self.assertRaises(ValueError):
+            self.fb.set_output(None)
+
+    @patch('requests.request')
+    def test_metrics_api(self, mock_request):
+        '''Test API request metrics.'''
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = b'{"name": "new name"}'
+        mock_response.request.body = b'{"name": "name"}'
+        mock_response.content = json_content({'name': 'new name'})
+        mock_request.return_value = mock_response
+        self.fb.api_patch('device', {'name': 'name'})
+        mock_request.return_value = None
+        self.fb.api_get('points')
+        metrics = self.fb.get_metrics()
+        labels = {'method': 'PATCH', 'endpoint': 'device'}
+        self.assertEqual(metrics['counters']['api_requests_total'], [
+            {'labels': {**labels, 'status': 200}, 'value': 1},
+            {'labels': {'method': 'GET', 'endpoint': 'points', 'status': 'none'},
+             'value': 1},
+        ])
+        self.assertEqual(metrics['counters']['api_bytes_received_total'], [
+            {'labels': labels, 'value': 20}])
+        self.assertEqual(metrics['counters']['api_bytes_sent_total'], [
+            {'labels': labels, 'value': 16}])
+        self.assertEqual(metrics['counters']['api_errors_total'], [
+            {'labels': {'method': 'GET', 'endpoint': 'points'}, 'value': 1}])
+        histogram = metrics['histograms']['api_request_seconds'][0]
+        self.assertEqual(histogram['labels'], labels)
+        self.assertEqual(histogram['count'], 1)
+        self.assertEqual(histogram['buckets']['+Inf'], 1)
+        self.fb.reset_metrics()
+        self.assertEqual(self.fb.get_metrics(),
+                         {'counters': {}, 'histograms': {}})
+
+    @patch('paho.mqtt.client.Client')
+    def test_metrics_broker(self, mock_mqtt):
+        '''Test message broker metrics.'''
+        mock_mqtt.return_value = Mock()
+        self.fb.state.last_messages['from_device'] = [{
+            'topic': '',
+            'content': {'kind': 'rpc_ok', 'args': {'label': 'test'}},
+        }]
+        self.fb.wait(100)
+        self.fb.state.last_messages['from_device'] = [{
+            'topic': '',
+            'content': {'kind': 'rpc_error', 'args': {'label': 'test'}},
+        }]
+        self.fb.wait(100)
+        self.fb.state.last_messages['from_device'] = []
+        self.fb.e_stop()
+        counters = self.fb.get_metrics()['counters']
+        self.assertEqual(counters['broker_publish_total'], [
+            {'labels': {'kind': 'wait'}, 'value': 2},
+            {'labels': {'kind': 'emergency_lock'}, 'value': 1},
+        ])
+        self.assertEqual(counters['broker_rpc_errors_total'], [
+            {'labels': {'kind': 'wait'}, 'value': 1}])
+        self.assertEqual(counters['broker_rpc_timeouts_total'], [
+            {'labels': {'kind': 'emergency_lock'}, 'value': 1}])
+        self.assertEqual(counters['broker_bytes_sent_total'][0]['value'], 198)
+        histograms = self.fb.get_metrics()['histograms']
+        self.assertEqual(histograms['broker_rpc_seconds'][0]['count'], 2)
+
+    @patch('paho.mqtt.client.Client')
+    def test_metrics_broker_received(self, mock_mqtt):
+        '''Test message broker metrics: received messages.'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        self.fb.listen()
+
+        class MockMessage:
+            '''Mock message class'''
+            topic = 'bot/device_0/logs'
+            payload = '{"message": "test message"}'
+        mock_client.on_message('', '', MockMessage())
+        counters = self.fb.get_metrics()['counters']
+        self.assertEqual(counters['broker_messages_received_total'], [
+            {'labels': {'channel': 'logs'}, 'value': 1}])
+        self.assertEqual(counters['broker_bytes_received_total'], [
+            {'labels': {'channel': 'logs'}, 'value': 27}])
+
+    def test_export_metrics(self):
+        '''Test export_metrics.'''
+        self.fb.state.metrics.increment('api_errors_total', {'endpoint': 'a"b'})
+        self.fb.state.metrics.observe('broker_rpc_seconds', 0.3, {'kind': 'move'})
+        self.fb.state.metrics.observe('broker_rpc_seconds', 200, {'kind': 'move'})
+        expected_lines = [
+            '# TYPE farmbot_api_errors_total counter',
+            'farmbot_api_errors_total{endpoint="a\\"b"} 1',
+            '# TYPE farmbot_broker_rpc_seconds histogram',
+            'farmbot_broker_rpc_seconds_bucket{kind="move",le="0.25"} 0',
+            'farmbot_broker_rpc_seconds_bucket{kind="move",le="0.5"} 1',
+            'farmbot_broker_rpc_seconds_bucket{kind="move",le="+Inf"} 2',
+            'farmbot_broker_rpc_seconds_sum{kind="move"} 200.3',
+            'farmbot_broker_rpc_seconds_count{kind="move"} 2',
+        ]
+        text = self.fb.export_metrics()
+        for line in expected_lines:
+            self.assertIn(line, text.split('\n'))
+        handler = Mock()
+        self.fb.export_metrics(handler)
+        handler.assert_called_once_with(text)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'farmbot.prom')
+            self.fb.export_metrics(path)
+            with open(path, encoding='utf-8') as metrics_file:
+                self.assertEqual(metrics_file.read(), text)
+        self.fb.reset_metrics()
+        self.fb.state.metrics.increment('unlabeled_total')
+        self.assertIn('farmbot_unlabeled_total 1', self.fb.export_metrics())
+
+    @patch('requests.request')
+    @patch('paho.mqtt.client.Client')
+    def test_tracing(self, mock_mqtt, mock_request):
+        '''Test tracing spans.'''
+        mock_mqtt.return_value = Mock()
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = 'text'
+        mock_response.content = json_content([{'label': 'Water', 'id': 123}])
+        mock_request.return_value = mock_response
+        exported = []
+        self.fb.start_tracing(exported.append)
+        self.fb.water(123)
+        self.fb.toggle_peripheral('Water')
+        spans = self.fb.stop_tracing()
+        self.assertEqual(spans, exported)
+        by_id = {span.span_id: span for span in spans}
+
+        def path(span):
+            names = [span.name]
+            while span.parent_id is not None:
+                span = by_id[span.parent_id]
+                names.insert(0, span.name)
+            return names
+        paths = [path(span) for span in spans]
+        self.assertIn([
+            'ToolControls.water', 'Resources.lua',
+            'BrokerConnect.publish', 'BrokerConnect.listen'], paths)
+        self.assertIn([
+            'Peripherals.toggle_peripheral', 'Information.get_resource_by_name',
+            'Information.api_get', 'ApiConnect.request'], paths)
+        # Helpers called while waiting or handling messages aren't traced
+        self.assertEqual(
+            sorted({span.name for span in spans if span.name.startswith('BrokerConnect')}),
+            ['BrokerConnect.connect', 'BrokerConnect.listen', 'BrokerConnect.publish',
+             'BrokerConnect.start_listen', 'BrokerConnect.stop_listen'])
+        request_span = [s for s in spans if s.name == 'ApiConnect.request'][0]
+        self.assertEqual(request_span.attributes, {
+            'method': 'GET', 'endpoint': 'peripherals', 'status': 200})
+        publish_span = [s for s in spans if s.name == 'BrokerConnect.publish'][0]
+        self.assertEqual(publish_span.attributes['kind'], 'lua')
+        water_span = [s for s in spans if s.name == 'ToolControls.water'][0]
+        self.assertGreaterEqual(water_span.end_time, water_span.start_time)
+        self.assertEqual(water_span.to_dict()['name'], water_span.name)
+        self.assertEqual(self.fb.stop_tracing(), [])
+
+    def test_tracing_chrome_trace(self):
+        '''Test tracing: Chrome trace-event output and errors.'''
+        self.fb.start_tracing()
+        with self.assertRaises(ValueError):
+            self.fb.find_home(axis='nope')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            spans = self.fb.stop_tracing(path)
+            with open(path, encoding='utf-8') as trace_file:
+                trace = json.load(trace_file)
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0].attributes['error'],
+                         "ValueError(\"Invalid axis: nope not in ['x', 'y', 'z', 'all']\")")
+        event = trace['traceEvents'][0]
+        self.assertEqual(event['name'], 'MovementControls.find_home')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['pid'], os.getpid())
+
+    def test_state_error_per_thread(self):
+        '''Test errors are tracked per thread.'''
+        self.fb.state.error = 'main thread error'
+        errors = []
+
+        def run():
+            errors.append(self.fb.state.error)
+            self.fb.state.error = 'other thread error'
+            errors.append(self.fb.state.error)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(errors, [None, 'other thread error'])
+        self.assertEqual(self.fb.state.error, 'main thread error')
+
+    @patch('paho.mqtt.client.Client')
+    def test_publish_concurrent(self, mock_mqtt):
+        '''Test publishing from multiple threads with one instance.'''
+        mock_client = Mock()
+        mock_mqtt.return_value = mock_client
+        self.fb.state.test_env = False
+        self.fb.set_timeout(5)
+
+        def respond(_topic, payload):
+            rpc = json.loads(payload)
+            pin = rpc['body'][0]['args']['pin_number']
+
+            class MockMessage:
+                '''Mock message class'''
+                topic = 'bot/device_0/from_device'
+                payload = json.dumps({
+                    'kind': 'rpc_error' if pin == 3 else 'rpc_ok',
+                    'args': {'label': rpc['args']['label']},
+                })
+            timer = threading.Timer(
+                0.05, mock_client.on_message, ('', '', MockMessage()))
+            timer.start()
+        mock_client.publish.side_effect = respond
+        results = {}
+
+        def run(pin):
+            self.fb.read_pin(pin)
+            published_pin = self.fb.state.last_published['body'][0]['args']['pin_number']
+            results[pin] = (self.fb.state.error, published_pin)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {
+            0: (None, 0),
+            1: (None, 1),
+            2: (None, 2),
+            3: ('RPC error response received.', 3),
+        })
+        self.assertEqual(mock_client.publish.call_count, 4)
+        self.assertEqual(len(self.fb.state.last_messages['from_device']), 1)
+        self.assertEqual(self.fb.state.pending_labels, set())
+        mock_client.loop_stop.assert_called()
+        # The response stays in last_messages; finished responses are dropped
+        self.fb.read_pin(1)
+        label = self.fb.state.last_published['args']['label']
+        self.assertEqual(self.fb.state.last_messages['from_device'], [{
+            'topic': 'bot/device_0/from_device',
+            'content': {'kind': 'rpc_ok', 'args': {'label': label}},
+        }])
+
+    @patch('paho.mqtt.client.Client')
+    def test_publish_gets_response_while_pending(self, mock_mqtt):
+        '''Test responses are gotten before their labels stop being pending.'''
+        mock_mqtt.return_value = Mock()
+        get_response = self.fb.state.get_response
+        pending = []
+
+        def get(label):
+            pending.append(label in self.fb.state.pending_labels)
+            return get_response(label)
+        with patch.object(self.fb.state, 'get_response', side_effect=get):
+            self.fb.e_stop()
+        self.assertEqual(pending, [True])
+        self.assertEqual(self.fb.state.pending_labels, set())
+
+    def test_lazy_subsystems(self):
+        '''Test subsystems are constructed on first use.'''
+        fb = Farmbot()
+        self.assertNotIn('broker', vars(fb))
+        self.assertNotIn('info', vars(fb))
+        broker = fb.broker
+        self.assertIs(fb.broker, broker)
+        self.assertIs(fb.broker.state, fb.state)
+        self.assertNotIn('api', vars(fb.info))
+        self.assertIs(fb.info.api.state, fb.state)
+        self.assertIsInstance(type(fb).broker, type(type(fb).info))
+
+    @patch('paho.mqtt.client.Client')
+    def test_handles_share_subsystems(self, mock_mqtt):
+        '''Test handles and plans use the Farmbot's subsystems.'''
+        mock_mqtt.return_value = Mock()
+        self.fb.state.save_cache('sensors', [
+            {'label': 'Soil Sensor', 'id': 1, 'mode': 0}])
+        for _ in range(3):
+            self.fb.sensor('Soil Sensor').read()
+        mock_mqtt.assert_called_once()
+        handle = self.fb.sequence_handle('My Sequence')
+        self.assertIs(handle.broker, self.fb.broker)
+        self.assertIs(handle.info, self.fb.info)
+        self.assertIs(handle.resources, self.fb.resources)
+        plan = self.fb.plan('Plan')
+        self.assertIs(plan.info, self.fb.info)
+        self.assertIs(plan.resources, self.fb.resources)
+        self.assertNotIn('resources', vars(plan))
+
+    def test_import_defers_dependencies(self):
+        '''Test `import farmbot` does not import requests, paho, or hashlib.'''
+        script = 'import sys, farmbot; farmbot.Farmbot(); print(sorted(' \
+            'm for m in ("requests", "paho.mqtt.client", "hashlib") if m in sys.modules))'
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')